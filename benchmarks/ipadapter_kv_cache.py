@@ -0,0 +1,120 @@
+"""Micro-benchmark of the lookups of the IPAdapter key and value cache of ComfyUI.
+
+Compares, per attention layer call under torch.inference_mode(), projecting the image
+embeddings, validating the cached projections by comparing sampled elements of the inference
+tensors, as the cache did before, and looking them up with the per-sampling validation.
+
+Run it where ComfyUI is importable:
+    python3 benchmarks/ipadapter_kv_cache.py --device cuda --iters 1000
+"""
+
+import argparse
+import importlib.util
+import os
+import time
+
+import torch
+
+_CROSS_ATTENTION_PATCH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "onediff_comfy_nodes",
+    "modules",
+    "oneflow",
+    "infer_compiler_registry",
+    "register_comfy",
+    "CrossAttentionPatch.py",
+)
+
+# The number of evenly spaced elements of each tensor compared by the sampled validation
+_SAMPLED_ELEMENTS = 64
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--iters", type=int, default=1000)
+    parser.add_argument("--warmups", type=int, default=10)
+    return parser.parse_args()
+
+
+def load_cross_attention_patch():
+    spec = importlib.util.spec_from_file_location(
+        "CrossAttentionPatch", _CROSS_ATTENTION_PATCH
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def benchmark(fn, iters, warmups, device):
+    for _ in range(warmups):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def sample_elements(tensors):
+    samples = []
+    for tensor in tensors:
+        flat = tensor.detach().reshape(-1)
+        step = max(1, flat.numel() // _SAMPLED_ELEMENTS)
+        samples.append(flat[::step][:_SAMPLED_ELEMENTS].float())
+    return torch.cat(samples)
+
+
+def main():
+    args = parse_args()
+    patch = load_cross_attention_patch()
+
+    with torch.inference_mode():
+        # The embeddings and the projections of a layer of an SDXL IPAdapter Plus
+        cond = torch.randn(1, 16, 2048, device=args.device, dtype=torch.float16)
+        uncond = torch.zeros_like(cond)
+        to_k = torch.nn.Linear(2048, 1280, bias=False).to(args.device, torch.float16)
+        to_v = torch.nn.Linear(2048, 1280, bias=False).to(args.device, torch.float16)
+        sources = [cond, uncond, to_k.weight, None, to_v.weight, None]
+
+        def project():
+            return (
+                torch.cat([to_k(cond), to_k(uncond)]),
+                torch.cat([to_v(cond), to_v(uncond)]),
+            )
+
+        tensors = [t for t in sources if t is not None]
+        cached_samples = sample_elements(tensors)
+        kv_cache = patch.IPAdapterKVCache()
+        kv_cache.get("layer", sources, project)
+
+        results = {
+            "projection": benchmark(project, args.iters, args.warmups, args.device),
+            "sampled validation": benchmark(
+                lambda: torch.equal(sample_elements(tensors), cached_samples),
+                args.iters,
+                args.warmups,
+                args.device,
+            ),
+            "cache lookup": benchmark(
+                lambda: kv_cache.get("layer", sources, project),
+                args.iters,
+                args.warmups,
+                args.device,
+            ),
+        }
+
+    for name, cost in results.items():
+        print(f"{name:<20} {cost:10.2f} us/call")
+    assert kv_cache.misses == 1
+
+
+if __name__ == "__main__":
+    main()
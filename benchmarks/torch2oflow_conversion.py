@@ -0,0 +1,141 @@
+"""CPU benchmark of converting a deep UNet-like module tree with torch2oflow.
+
+Usage:
+    python3 benchmarks/torch2oflow_conversion.py --depth 4 --blocks 3 --workers 4
+    ONEDIFF_CLASS_PROXY_CACHE_FILE=/tmp/class_proxies.json \
+        python3 benchmarks/torch2oflow_conversion.py --model diffusers
+
+The classes of the synthetic tree are defined in this script, so only torch classes are mocked.
+`--model diffusers` converts a small UNet2DConditionModel, whose classes are resolved by the
+mocker: run it twice with ONEDIFF_CLASS_PROXY_CACHE_FILE set to compare a cold start with a warm
+start that reads the persisted class proxies.
+"""
+
+import argparse
+import os
+import time
+
+import torch
+import oneflow as flow  # usort: skip
+
+from onediff.infer_compiler.backends.oneflow.transform.builtin_transform import (
+    torch2oflow,
+)
+from onediff.infer_compiler.backends.oneflow.transform.manager import transform_mgr
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model", choices=["synthetic", "diffusers"], default="synthetic"
+    )
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--blocks", type=int, default=3)
+    parser.add_argument("--channels", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4)
+    return parser.parse_args()
+
+
+class ResBlock(torch.nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.norm1 = torch.nn.GroupNorm(8, channels)
+        self.conv1 = torch.nn.Conv2d(channels, channels, 3, padding=1)
+        self.norm2 = torch.nn.GroupNorm(8, channels)
+        self.conv2 = torch.nn.Conv2d(channels, channels, 3, padding=1)
+        self.act = torch.nn.SiLU()
+
+    def forward(self, x):
+        h = self.conv1(self.act(self.norm1(x)))
+        h = self.conv2(self.act(self.norm2(h)))
+        return x + h
+
+
+class AttentionBlock(torch.nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(channels)
+        self.to_q = torch.nn.Linear(channels, channels)
+        self.to_k = torch.nn.Linear(channels, channels)
+        self.to_v = torch.nn.Linear(channels, channels)
+        self.to_out = torch.nn.ModuleList(
+            [torch.nn.Linear(channels, channels), torch.nn.Dropout(0.0)]
+        )
+
+
+class Stage(torch.nn.Module):
+    def __init__(self, channels, blocks):
+        super().__init__()
+        self.resnets = torch.nn.ModuleList([ResBlock(channels) for _ in range(blocks)])
+        self.attentions = torch.nn.ModuleList(
+            [AttentionBlock(channels) for _ in range(blocks)]
+        )
+
+
+class SyntheticUNet(torch.nn.Module):
+    def __init__(self, depth, blocks, channels):
+        super().__init__()
+        self.conv_in = torch.nn.Conv2d(4, channels, 3, padding=1)
+        self.down_blocks = torch.nn.ModuleList(
+            [Stage(channels, blocks) for _ in range(depth)]
+        )
+        self.mid_block = Stage(channels, 1)
+        self.up_blocks = torch.nn.ModuleList(
+            [Stage(channels, blocks + 1) for _ in range(depth)]
+        )
+        self.conv_out = torch.nn.Conv2d(channels, 4, 3, padding=1)
+
+
+def build_diffusers_unet(args):
+    from diffusers import UNet2DConditionModel
+
+    return UNet2DConditionModel(
+        block_out_channels=(args.channels,) * args.depth,
+        layers_per_block=args.blocks,
+        down_block_types=("CrossAttnDownBlock2D",) * (args.depth - 1)
+        + ("DownBlock2D",),
+        up_block_types=("UpBlock2D",) + ("CrossAttnUpBlock2D",) * (args.depth - 1),
+        cross_attention_dim=args.channels,
+        attention_head_dim=8,
+        norm_num_groups=8,
+    )
+
+
+def convert(model, workers):
+    os.environ["ONEDIFF_CONVERT_WORKERS"] = str(workers)
+    start = time.perf_counter()
+    torch2oflow(model)
+    return time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    if args.model == "diffusers":
+        model = build_diffusers_unet(args).eval()
+    else:
+        model = SyntheticUNet(args.depth, args.blocks, args.channels).eval()
+    num_modules = sum(1 for _ in model.modules())
+    print(f"{type(model).__name__} with {num_modules} modules")
+
+    proxy_cache_file = os.getenv("ONEDIFF_CLASS_PROXY_CACHE_FILE", None)
+    if proxy_cache_file:
+        state = "warm" if os.path.exists(proxy_cache_file) else "cold"
+        print(f"Class proxy cache {proxy_cache_file} ({state} start)")
+    # Resolving the class proxies is the cost of a process start, the cache shortens it
+    start = time.perf_counter()
+    transform_mgr.prefetch_class_proxies({type(m) for m in model.modules()})
+    print(
+        f"{'resolve class proxies':<32} {(time.perf_counter() - start) * 1000:10.2f} ms"
+    )
+    transform_mgr.save_class_proxies()
+
+    results = {
+        "conversion (1 worker)": convert(model, 1),
+        f"conversion ({args.workers} workers)": convert(model, args.workers),
+    }
+    for name, cost in results.items():
+        print(f"{name:<32} {cost * 1000:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
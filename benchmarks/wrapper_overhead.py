@@ -0,0 +1,117 @@
+"""Micro-benchmark of the per-call Python overhead of the OneflowDeployableModule wrapper stack.
+
+Usage:
+    python3 benchmarks/wrapper_overhead.py --device cpu --iters 1000
+"""
+
+import argparse
+import time
+
+import torch
+import oneflow as flow  # usort: skip
+from onediff.infer_compiler import oneflow_compile
+from onediff.infer_compiler.backends.oneflow.args_tree_util import (
+    _flatten_and_map,
+    _get_structure_key,
+    _torch_to_oflow,
+)
+from onediff.infer_compiler.backends.oneflow.utils.hash_utils import (
+    generate_input_structure_key,
+)
+from oneflow.framework.args_tree import ArgsTree
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--iters", type=int, default=1000)
+    parser.add_argument("--warmups", type=int, default=10)
+    return parser.parse_args()
+
+
+class TinyUNet(torch.nn.Module):
+    """Takes the same arguments as an SDXL UNet, but does almost no computation."""
+
+    def __init__(self):
+        super().__init__()
+        self.proj = torch.nn.Linear(4, 4)
+
+    def forward(self, sample, timestep, encoder_hidden_states, added_cond_kwargs):
+        out = self.proj(sample.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        return (out + added_cond_kwargs["time_ids"].sum(),)
+
+
+def make_inputs(device):
+    args = (
+        torch.randn(2, 4, 8, 8, device=device),
+        torch.tensor([999.0, 999.0], device=device),
+        torch.randn(2, 77, 32, device=device),
+    )
+    kwargs = {
+        "added_cond_kwargs": {
+            "text_embeds": torch.randn(2, 32, device=device),
+            "time_ids": torch.randn(2, 6, device=device),
+        }
+    }
+    return args, kwargs
+
+
+def benchmark(fn, iters, warmups):
+    for _ in range(warmups):
+        fn()
+    flow._oneflow_internal.eager.Sync()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    flow._oneflow_internal.eager.Sync()
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def main():
+    args = parse_args()
+    inputs, kwargs = make_inputs(args.device)
+
+    def args_tree_input_processing():
+        args_tree = ArgsTree((inputs, kwargs), False, tensor_type=torch.Tensor)
+        generate_input_structure_key(args_tree)
+        args_tree.map_leaf(_torch_to_oflow)
+
+    def fast_input_processing():
+        layout = []
+        _flatten_and_map((inputs, kwargs), layout, _torch_to_oflow)
+        _get_structure_key(layout)
+
+    model = TinyUNet().to(args.device)
+    compiled_model = oneflow_compile(TinyUNet().to(args.device))
+    compiled_model(*inputs, **kwargs)
+    graph = compiled_model.get_graph()
+    of_inputs, of_kwargs = _flatten_and_map((inputs, kwargs), [], _torch_to_oflow)
+
+    def run_graph():
+        graph(*of_inputs, **of_kwargs)
+
+    with torch.no_grad():
+        results = {
+            "ArgsTree input processing": benchmark(
+                args_tree_input_processing, args.iters, args.warmups
+            ),
+            "fast input processing": benchmark(
+                fast_input_processing, args.iters, args.warmups
+            ),
+            "eager torch call": benchmark(
+                lambda: model(*inputs, **kwargs), args.iters, args.warmups
+            ),
+            "oneflow graph call": benchmark(run_graph, args.iters, args.warmups),
+            "deployable module call": benchmark(
+                lambda: compiled_model(*inputs, **kwargs), args.iters, args.warmups
+            ),
+        }
+
+    for name, cost in results.items():
+        print(f"{name:<28} {cost:10.2f} us/call")
+    overhead = results["deployable module call"] - results["oneflow graph call"]
+    print(f"{'wrapper stack overhead':<28} {overhead:10.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
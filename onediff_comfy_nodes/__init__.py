@@ -58,3 +58,7 @@ def lazy_load_extra_nodes():
 
 # Lazy load all extra nodes when needed
 lazy_load_extra_nodes()
+
+from .modules.booster_cache import register_stats_route
+
+register_stats_route()
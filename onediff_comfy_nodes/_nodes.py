@@ -1,4 +1,3 @@
-import uuid
 from typing import Optional, Tuple
 
 import folder_paths
@@ -67,7 +66,7 @@ class SpeedupMixin:
             Tuple: Tuple containing the optimized model.
         """
         if booster_settings is None and not hasattr(self, "booster_settings"):
-            self.booster_settings = BoosterSettings(tmp_cache_key=str(uuid.uuid4()))
+            self.booster_settings = BoosterSettings()
 
         if custom_booster:
             booster = custom_booster
@@ -231,8 +230,8 @@ class OneDiffCheckpointLoaderSimple(CheckpointLoaderSimple, SpeedupMixin):
 
     def __init__(self) -> None:
         super().__init__()
-        self.unet_booster_settings = BoosterSettings(tmp_cache_key=str(uuid.uuid4()))
-        self.vae_booster_settings = BoosterSettings(tmp_cache_key=str(uuid.uuid4()))
+        self.unet_booster_settings = BoosterSettings()
+        self.vae_booster_settings = BoosterSettings()
 
     @torch.inference_mode()
     def onediff_load_checkpoint(
@@ -242,6 +241,8 @@ class OneDiffCheckpointLoaderSimple(CheckpointLoaderSimple, SpeedupMixin):
         custom_booster: BoosterScheduler = None,
     ):
         modelpatcher, clip, vae = self.load_checkpoint(ckpt_name)
+        self.unet_booster_settings.ckpt_name = ckpt_name
+        self.vae_booster_settings.ckpt_name = ckpt_name
         modelpatcher = self.speedup(
             modelpatcher,
             inplace=True,
@@ -6,6 +6,7 @@ import folder_paths
 import torch
 from comfy import model_management
 from comfy.cli_args import args
+from onediff.infer_compiler import DeployableModule
 from onediff.infer_compiler.backends.oneflow.utils.version_util import (
     is_community_version,
 )
@@ -20,6 +21,8 @@ from ..modules.oneflow import (
 )
 from ..modules.oneflow.config import ONEDIFF_QUANTIZED_OPTIMIZED_MODELS
 from ..modules.oneflow.utils import load_graph, OUTPUT_FOLDER, save_graph
+from ..modules.oneflow.utils.booster_utils import set_compiled_options
+from ..modules.oneflow.utils.graph_path import get_model_patcher_patches, GraphPathIndex
 
 if is_onediff_quant_available() and not is_community_version():
     from ..modules.oneflow.booster_quantization import (
@@ -412,19 +415,50 @@ class SVDSpeedup:
 
 
 ########################## For downward compatibility, it is retained ###################
-class VaeGraphLoader:
-    @classmethod
-    def INPUT_TYPES(s):
-        vae_folder = os.path.join(OUTPUT_FOLDER, "vae")
+AUTO_GRAPH = "auto"
+
+
+def list_graph_choices(subfolder, kind):
+    """The graphs saved by the graph saver nodes, then those in the graph path index."""
+    folder = os.path.join(OUTPUT_FOLDER, subfolder)
+    graph_files = []
+    if os.path.isdir(folder):
         graph_files = [
             f
-            for f in os.listdir(vae_folder)
-            if os.path.isfile(os.path.join(vae_folder, f)) and f.endswith(".graph")
+            for f in os.listdir(folder)
+            if os.path.isfile(os.path.join(folder, f)) and f.endswith(".graph")
         ]
+    indexed_graphs = GraphPathIndex().list(kind=kind)
+    return [AUTO_GRAPH] + sorted(graph_files) + sorted(indexed_graphs)
+
+
+def load_indexed_graph(deploy_module, torch_model, graph, patches=None):
+    """Sets the graph path of `graph` in the index, or of the most recently used compatible
+    graph for `AUTO_GRAPH`. The graph is loaded at the first run, if the inputs match.
+    """
+    if not isinstance(deploy_module, DeployableModule):
+        raise NotImplementedError(f"Unsupported: {type(deploy_module)}")
+    index = GraphPathIndex()
+    compatible = index.find_compatible(torch_model, patches=patches)
+    if graph == AUTO_GRAPH:
+        if not compatible:
+            print(f"No compatible graph of {type(torch_model).__name__} is saved.")
+            return
+        graph = compatible[0]
+    elif graph not in compatible:
+        print(f"Graph {graph} is not compatible with the model, skip loading.")
+        return
+    print(f"Using graph {graph}")
+    set_compiled_options(deploy_module, index.get_graph_path(graph))
+
+
+class VaeGraphLoader:
+    @classmethod
+    def INPUT_TYPES(s):
         return {
             "required": {
                 "vae": ("VAE",),
-                "graph": (sorted(graph_files),),
+                "graph": (list_graph_choices("vae", kind="vae"),),
             },
         }
 
@@ -437,6 +471,11 @@ class VaeGraphLoader:
             f"Warning: {type(self).__name__} will be deleted. Please use it with caution."
         )
         vae_model = vae.first_stage_model
+        if not graph.endswith(".graph"):
+            load_indexed_graph(
+                vae_model, getattr(vae_model, "_torch_module", vae_model), graph
+            )
+            return (vae,)
         device = model_management.vae_offload_device()
         load_graph(vae_model, graph, device, subfolder="vae")
         return (vae,)
@@ -472,16 +511,10 @@ class VaeGraphSaver:
 class ModelGraphLoader:
     @classmethod
     def INPUT_TYPES(s):
-        unet_folder = os.path.join(OUTPUT_FOLDER, "unet")
-        graph_files = [
-            f
-            for f in os.listdir(unet_folder)
-            if os.path.isfile(os.path.join(unet_folder, f)) and f.endswith(".graph")
-        ]
         return {
             "required": {
                 "model": ("MODEL",),
-                "graph": (sorted(graph_files),),
+                "graph": (list_graph_choices("unet", kind="unet"),),
             },
         }
 
@@ -495,6 +528,14 @@ class ModelGraphLoader:
         )
 
         diffusion_model = model.model.diffusion_model
+        if not graph.endswith(".graph"):
+            load_indexed_graph(
+                diffusion_model,
+                model.model,
+                graph,
+                patches=get_model_patcher_patches(model),
+            )
+            return (model,)
 
         load_graph(diffusion_model, graph, "cuda", subfolder="unet")
         return (model,)
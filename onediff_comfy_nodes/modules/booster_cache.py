@@ -1,39 +1,223 @@
+"""A bounded cache of compiled models, shared by the booster nodes.
+
+Entries are keyed by the architecture of the model, the identity of its checkpoint, i.e. its
+name or a fingerprint of its weights, and the compile settings of the booster, so nodes loading
+the same checkpoint with the same settings share one compiled model.
+
+The cache has two tiers. The most recently used entries stay on the device, within
+ONEDIFF_COMFY_CACHE_DEVICE_BYTES and ONEDIFF_COMFY_CACHE_MAX_ENTRIES (default 5). Entries evicted
+from the device are offloaded to the host, within ONEDIFF_COMFY_CACHE_HOST_BYTES and
+ONEDIFF_COMFY_CACHE_MAX_HOST_ENTRIES (default 2), and dropped from there. Unset byte budgets are
+unlimited. Models compiled by oneflow are dropped instead of offloaded, since their graphs hold
+device tensors and share the weights of the torch modules.
+
+When a checkpoint isn't cached and the device tier is full, the weights of the new checkpoint
+are loaded into the least recently used entry of the same architecture and settings, so its
+compiled graph is reused instead of compiling another one. Only the tensors whose sampled
+fingerprints differ are copied, e.g. a few of them between fine-tunes of the same base model.
+Entries still used by a live model, e.g. the output of another loader node, are never switched.
+"""
+
+import collections
+import dataclasses
+import hashlib
+import threading
+import time
+import weakref
 from collections import OrderedDict
 from functools import singledispatch
+from typing import Dict, List, Optional, Tuple
 
 import torch
+from comfy import model_management
 from comfy.model_patcher import ModelPatcher
 from comfy.sd import VAE
 from onediff.torch_utils.module_operations import get_sub_module
+from onediff.utils import logger, parse_integer_from_env
+from onediff.utils.import_utils import is_oneflow_available
+
+from .._config import is_disable_oneflow_backend
+
+# The number of evenly spaced elements hashed in the fingerprint of a tensor
+_FINGERPRINT_SAMPLED_ELEMENTS = parse_integer_from_env(
+    "ONEDIFF_COMFY_FINGERPRINT_SAMPLES", 256
+)
+
+# module -> the fingerprints of its tensors, computed once per loaded model
+_module_fingerprints = weakref.WeakKeyDictionary()
+
+_swap_lock = threading.Lock()
+_swap_totals = {
+    "swaps": 0,
+    "copied_tensors": 0,
+    "copied_bytes": 0,
+    "total_bytes": 0,
+    "seconds": 0.0,
+}
+
+
+def compute_tensor_fingerprints(module: torch.nn.Module) -> Dict[str, bytes]:
+    """Returns a sampled hash of each tensor of the state dict of the module.
+
+    A hash covers the shape, the dtype and evenly spaced elements of the tensor. The samples of
+    the tensors on a device are copied to the host at once.
+    """
+    state_dict = module.state_dict()
+    samples_by_device = collections.defaultdict(list)
+    for name, tensor in state_dict.items():
+        flat = tensor.detach().reshape(-1)
+        step = max(1, flat.numel() // _FINGERPRINT_SAMPLED_ELEMENTS)
+        samples_by_device[flat.device].append(
+            (name, flat[::step][:_FINGERPRINT_SAMPLED_ELEMENTS])
+        )
+
+    fingerprints = {}
+    for samples in samples_by_device.values():
+        host_samples = torch.cat([s.float() for _, s in samples]).cpu().numpy()
+        offset = 0
+        for name, sample in samples:
+            tensor = state_dict[name]
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(f"{tuple(tensor.shape)}:{tensor.dtype}".encode("utf-8"))
+            hasher.update(host_samples[offset : offset + sample.numel()].tobytes())
+            offset += sample.numel()
+            fingerprints[name] = hasher.digest()
+    return fingerprints
+
+
+def get_tensor_fingerprints(module: torch.nn.Module) -> Dict[str, bytes]:
+    """The fingerprints of a loaded model, whose weights don't change until it's cached."""
+    fingerprints = _module_fingerprints.get(module, None)
+    if fingerprints is None:
+        fingerprints = _module_fingerprints[module] = compute_tensor_fingerprints(
+            module
+        )
+    return fingerprints
+
+
+@dataclasses.dataclass
+class WeightSwapReport:
+    copied_tensors: int
+    total_tensors: int
+    copied_bytes: int
+    total_bytes: int
+    seconds: float
+
+
+def _batched_copy(dsts: List[torch.Tensor], srcs: List[torch.Tensor]) -> None:
+    foreach_copy = getattr(torch, "_foreach_copy_", None)
+    try:
+        if foreach_copy is None:
+            raise NotImplementedError
+        foreach_copy(dsts, srcs, non_blocking=True)
+    except (NotImplementedError, RuntimeError, TypeError):
+        for dst, src in zip(dsts, srcs):
+            dst.copy_(src, non_blocking=True)
+    # The sources may be freed once the copies are done
+    for device in {dst.device for dst in dsts if dst.device.type == "cuda"}:
+        torch.cuda.synchronize(device)
+
+
+def copy_changed_weights(
+    dst_module: torch.nn.Module,
+    src_module: torch.nn.Module,
+    dst_fingerprints: Optional[Dict[str, bytes]] = None,
+) -> WeightSwapReport:
+    """Copies the tensors of `src_module` whose fingerprints differ from those of `dst_module`.
+
+    `dst_fingerprints` are the fingerprints of the tensors of `dst_module`, computed if empty,
+    and updated to those of `src_module`. The state dicts must have the same keys.
+    """
+    start = time.perf_counter()
+    if dst_fingerprints is None:
+        dst_fingerprints = {}
+    if not dst_fingerprints:
+        dst_fingerprints.update(compute_tensor_fingerprints(dst_module))
+    src_state_dict = src_module.state_dict()
+    mismatched_keys = set(dst_fingerprints).symmetric_difference(src_state_dict)
+    if mismatched_keys:
+        raise KeyError(f"Mismatched keys of the state dicts: {sorted(mismatched_keys)}")
+    src_fingerprints = get_tensor_fingerprints(src_module)
+
+    dsts, srcs = [], []
+    copied_bytes = total_bytes = 0
+    for name, src in src_state_dict.items():
+        nbytes = src.numel() * src.element_size()
+        total_bytes += nbytes
+        if src_fingerprints[name] == dst_fingerprints[name]:
+            continue
+        dst: torch.Tensor = get_sub_module(dst_module, name)
+        if dst.shape != src.shape:
+            raise ValueError(
+                f"Shape mismatch of {name}: expected {tuple(dst.shape)}, got {tuple(src.shape)}"
+            )
+        dsts.append(dst)
+        srcs.append(src)
+        copied_bytes += nbytes
+    with torch.no_grad():
+        _batched_copy(dsts, srcs)
+    dst_fingerprints.clear()
+    dst_fingerprints.update(src_fingerprints)
+    # The fingerprints of the old weights are stale
+    _module_fingerprints[dst_module] = dict(src_fingerprints)
+
+    report = WeightSwapReport(
+        copied_tensors=len(dsts),
+        total_tensors=len(src_state_dict),
+        copied_bytes=copied_bytes,
+        total_bytes=total_bytes,
+        seconds=time.perf_counter() - start,
+    )
+    with _swap_lock:
+        _swap_totals["swaps"] += 1
+        _swap_totals["copied_tensors"] += report.copied_tensors
+        _swap_totals["copied_bytes"] += report.copied_bytes
+        _swap_totals["total_bytes"] += report.total_bytes
+        _swap_totals["seconds"] += report.seconds
+    logger.info(
+        f"Copied {report.copied_tensors}/{report.total_tensors} tensors, "
+        f"{report.copied_bytes / 2**20:.1f}/{report.total_bytes / 2**20:.1f} MiB "
+        f"in {report.seconds:.3f}s to switch to the cached model"
+    )
+    return report
 
 
 @singledispatch
-def switch_to_cached_model(new_model, cached_model):
+def switch_to_cached_model(
+    new_model, cached_model, copy_weights=True, fingerprints=None
+):
+    """Makes the new model use the cached model, with the weights of the new model if `copy_weights`.
+
+    Only the tensors that differ are copied, `fingerprints` are those of the cached weights,
+    see copy_changed_weights.
+    """
     raise NotImplementedError(type(new_model))
 
 
 @switch_to_cached_model.register
-def _(new_model: ModelPatcher, cached_model):
+def _(new_model: ModelPatcher, cached_model, copy_weights=True, fingerprints=None):
     if type(new_model.model) != type(cached_model):
         raise TypeError(
             f"Model type mismatch: expected {type(cached_model)}, got {type(new_model.model)}"
         )
 
-    cached_model.diffusion_model.load_state_dict(
-        new_model.model.diffusion_model.state_dict(), strict=True
-    )
+    if (
+        copy_weights
+        and new_model.model.diffusion_model is not cached_model.diffusion_model
+    ):
+        copy_changed_weights(
+            cached_model.diffusion_model, new_model.model.diffusion_model, fingerprints
+        )
     new_model.model.diffusion_model = cached_model.diffusion_model
     new_model.weight_inplace_update = True
     return new_model
 
 
 @switch_to_cached_model.register
-def _(new_model: VAE, cached_model):
+def _(new_model: VAE, cached_model, copy_weights=True, fingerprints=None):
     assert type(new_model.first_stage_model) == type(cached_model)
-    for k, v in new_model.first_stage_model.state_dict().items():
-        cached_v: torch.Tensor = get_sub_module(cached_model, k)
-        assert v.dtype == cached_v.dtype
-        cached_v.copy_(v)
+    if copy_weights and new_model.first_stage_model is not cached_model:
+        copy_changed_weights(cached_model, new_model.first_stage_model, fingerprints)
     new_model.first_stage_model = cached_model
     return new_model
 
@@ -61,29 +245,374 @@ def _(model: VAE):
     return model.first_stage_model
 
 
+@singledispatch
+def get_weights_module(model) -> Optional[torch.nn.Module]:
+    """The module whose weights identify the checkpoint of a model."""
+    return None
+
+
+@get_weights_module.register
+def _(model: ModelPatcher):
+    return model.model.diffusion_model
+
+
+@get_weights_module.register
+def _(model: VAE):
+    return model.first_stage_model
+
+
+def _module_bytes(module: torch.nn.Module) -> int:
+    return sum(
+        t.numel() * t.element_size()
+        for t in list(module.parameters()) + list(module.buffers())
+    )
+
+
+def _architecture_signature(module: torch.nn.Module) -> str:
+    hasher = hashlib.sha256(type(module).__qualname__.encode("utf-8"))
+    for name, tensor in module.state_dict().items():
+        hasher.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype};".encode("utf-8"))
+    return hasher.hexdigest()[:16]
+
+
+def _weights_fingerprint(module: torch.nn.Module) -> str:
+    hasher = hashlib.sha256()
+    for name, fingerprint in sorted(get_tensor_fingerprints(module).items()):
+        hasher.update(name.encode("utf-8"))
+        hasher.update(fingerprint)
+    return hasher.hexdigest()[:16]
+
+
+def _freeze_settings(value):
+    """Returns a hashable and stable form of a compile setting, objects by their type."""
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (tuple, list)):
+        return tuple(_freeze_settings(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze_settings(v)) for k, v in value.items()))
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return (type(value).__name__, _freeze_settings(dataclasses.asdict(value)))
+    return type(value).__name__
+
+
+def settings_signature(booster_executors, **settings) -> Tuple:
+    """The compile settings of the executors, their types and their plain attributes."""
+    return tuple(
+        (type(executor).__name__, _freeze_settings(vars(executor)))
+        for executor in booster_executors
+    ) + (_freeze_settings(settings),)
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheKey:
+    kind: str
+    architecture: str
+    checkpoint: str
+    settings: Tuple
+
+    @property
+    def family(self) -> Tuple:
+        """The entries of a family can switch to the weights of each other."""
+        return (self.kind, self.architecture, self.settings)
+
+
+@dataclasses.dataclass
+class _CacheEntry:
+    model: torch.nn.Module
+    nbytes: int
+    # The fingerprints of the unpatched weights, computed on the first switch
+    fingerprints: Dict[str, bytes] = dataclasses.field(default_factory=dict)
+    # The ModelPatchers or VAEs the model was cached or switched for
+    owners: weakref.WeakSet = dataclasses.field(default_factory=weakref.WeakSet)
+
+    @property
+    def weights(self) -> torch.nn.Module:
+        """The diffusion model of a cached BaseModel, or the first stage model of a VAE."""
+        return getattr(self.model, "diffusion_model", self.model)
+
+    def is_owned(self) -> bool:
+        """Whether a live owner still uses the model, so its weights can't be switched."""
+        weights = self.weights
+        return any(get_weights_module(owner) is weights for owner in self.owners)
+
+
+def _is_oneflow_compiled(module: torch.nn.Module) -> bool:
+    if not is_oneflow_available() or is_disable_oneflow_backend():
+        return False
+    from .oneflow.utils.booster_utils import is_using_oneflow_backend
+
+    try:
+        return is_using_oneflow_backend(module)
+    except RuntimeError:
+        # Neither a model nor a compiled module
+        return False
+
+
+def _uses_weights(patcher, weights: torch.nn.Module) -> bool:
+    module = getattr(patcher, "model", None)
+    # After a switch, the BaseModel of the patcher is not the cached one, only its weights are
+    return module is weights or getattr(module, "diffusion_model", None) is weights
+
+
+def _unload_from_comfy(weights: torch.nn.Module, offload=True) -> None:
+    """Unloads the loaded models of ComfyUI using the weights, so they are reloaded on use.
+
+    If not `offload`, the patches, e.g. of LoRAs, are only removed from the weights, which stay
+    on their device.
+    """
+    loaded_models = getattr(model_management, "current_loaded_models", [])
+    for i in reversed(range(len(loaded_models))):
+        patcher = getattr(loaded_models[i], "model", None)
+        if _uses_weights(patcher, weights):
+            loaded_model = loaded_models.pop(i)
+            if offload:
+                loaded_model.model_unload()
+            else:
+                patcher.unpatch_model()
+
+
 class BoosterCacheService:
-    _cache = OrderedDict()
+    """BoosterCacheService
+
+    All instances share the cache. The budgets are read from the environment on first use,
+    or set by `configure`.
+    """
+
+    _lock = threading.RLock()
+    _device_cache: Dict[CacheKey, _CacheEntry] = OrderedDict()
+    _host_cache: Dict[CacheKey, _CacheEntry] = OrderedDict()
+    _limits = None
+    _stats = {
+        "hits": 0,
+        "host_hits": 0,
+        "switches": 0,
+        "misses": 0,
+        "offloads": 0,
+        "evictions": 0,
+    }
+
+    @classmethod
+    def configure(
+        cls,
+        max_device_bytes: Optional[int] = None,
+        max_entries: int = 5,
+        max_host_bytes: Optional[int] = None,
+        max_host_entries: int = 2,
+    ) -> None:
+        with cls._lock:
+            cls._limits = {
+                "device": (max_entries, max_device_bytes),
+                "host": (max_host_entries, max_host_bytes),
+            }
+            cls._evict()
 
-    def put(self, key, model):
+    @classmethod
+    def _get_limits(cls):
+        if cls._limits is None:
+            cls.configure(
+                max_device_bytes=parse_integer_from_env(
+                    "ONEDIFF_COMFY_CACHE_DEVICE_BYTES", None
+                ),
+                max_entries=parse_integer_from_env(
+                    "ONEDIFF_COMFY_CACHE_MAX_ENTRIES", 5
+                ),
+                max_host_bytes=parse_integer_from_env(
+                    "ONEDIFF_COMFY_CACHE_HOST_BYTES", None
+                ),
+                max_host_entries=parse_integer_from_env(
+                    "ONEDIFF_COMFY_CACHE_MAX_HOST_ENTRIES", 2
+                ),
+            )
+        return cls._limits
+
+    @staticmethod
+    def make_key(
+        model, booster_executors=(), ckpt_name=None, **settings
+    ) -> Optional[CacheKey]:
+        """Returns the key of a model before it's compiled, None if it can't be cached."""
+        module = get_weights_module(model)
+        if module is None:
+            return None
+        return CacheKey(
+            kind=type(model).__name__,
+            architecture=_architecture_signature(module),
+            checkpoint=ckpt_name or _weights_fingerprint(module),
+            settings=settings_signature(booster_executors, **settings),
+        )
+
+    @classmethod
+    def _is_over(cls, tier: str, cache, extra_bytes: int = 0) -> bool:
+        max_entries, max_bytes = cls._get_limits()[tier]
+        if len(cache) > max_entries:
+            return True
+        total_bytes = sum(entry.nbytes for entry in cache.values()) + extra_bytes
+        return max_bytes is not None and total_bytes > max_bytes
+
+    @classmethod
+    def _evict(cls) -> None:
+        num_offloads, num_evictions = cls._stats["offloads"], cls._stats["evictions"]
+        while cls._device_cache and cls._is_over("device", cls._device_cache):
+            key, entry = cls._device_cache.popitem(last=False)
+            if entry.is_owned():
+                # A live owner still uses the weights on the device, it frees them when it's done
+                cls._stats["evictions"] += 1
+                logger.info(f"Evicted the cached model {key.checkpoint} still in use")
+                continue
+            _unload_from_comfy(entry.weights)
+            if _is_oneflow_compiled(entry.model):
+                # Moving the weights neither frees the device tensors of the graph nor keeps
+                # them shared with it
+                cls._stats["evictions"] += 1
+                logger.info(f"Evicted the cached oneflow model {key.checkpoint}")
+                continue
+            entry.model.to(model_management.unet_offload_device())
+            cls._host_cache[key] = entry
+            cls._stats["offloads"] += 1
+            logger.info(f"Offloaded the cached model {key.checkpoint} to the host")
+        while cls._host_cache and cls._is_over("host", cls._host_cache):
+            key, entry = cls._host_cache.popitem(last=False)
+            _unload_from_comfy(entry.weights)
+            cls._stats["evictions"] += 1
+            logger.info(f"Evicted the cached model {key.checkpoint}")
+        if (num_offloads, num_evictions) != (
+            cls._stats["offloads"],
+            cls._stats["evictions"],
+        ):
+            model_management.soft_empty_cache()
+
+    def put(self, key: Optional[CacheKey], model):
         if key is None:
             return
         # oneflow backends output image error
         cached_model = get_cached_model(model)
-        if cached_model:
-            self._cache[key] = cached_model
-
-    def get(self, key, default=None):
-        return self._cache.get(key, default)
-
-    def get_cached_model(self, key, model):
-        cached_model = self.get(key, None)
-        print(f"Cache lookup: Key='{key}', Cached Model Type='{type(cached_model)}'")
-        if cached_model is not None:
-            try:
-                return switch_to_cached_model(model, cached_model)
-            except Exception as e:
-                print(f"An exception occurred when switching to cached model:")
-                del self._cache[key]
-                torch.cuda.empty_cache()
-
-        return None
+        if cached_model is None:
+            return
+        entry = _CacheEntry(cached_model, _module_bytes(cached_model))
+        entry.owners.add(model)
+        with self._lock:
+            self._host_cache.pop(key, None)
+            self._device_cache[key] = entry
+            self._device_cache.move_to_end(key)
+            self._evict()
+
+    def get(self, key: CacheKey, default=None):
+        with self._lock:
+            for cache in (self._device_cache, self._host_cache):
+                if key in cache:
+                    return cache[key].model
+        return default
+
+    def _pop_entry(
+        self, key: CacheKey, model
+    ) -> Tuple[Optional[CacheKey], Optional[_CacheEntry]]:
+        """Pops the entry of the key, or of another checkpoint to switch to if the device is full.
+
+        Only entries without a live owner are switched to another checkpoint.
+        """
+        if key in self._device_cache:
+            self._stats["hits"] += 1
+            return key, self._device_cache.pop(key)
+        if key in self._host_cache:
+            self._stats["host_hits"] += 1
+            return key, self._host_cache.pop(key)
+
+        module = get_weights_module(model)
+        new_bytes = _module_bytes(module) if module is not None else 0
+        if not self._is_over("device", self._device_cache, new_bytes) and (
+            len(self._device_cache) < self._get_limits()["device"][0]
+        ):
+            # Room for another compiled model
+            return None, None
+        for cache in (self._host_cache, self._device_cache):
+            for other_key, entry in cache.items():
+                if other_key.family == key.family and not entry.is_owned():
+                    self._stats["switches"] += 1
+                    return other_key, cache.pop(other_key)
+        return None, None
+
+    def get_cached_model(self, key: Optional[CacheKey], model):
+        if key is None:
+            return None
+        with self._lock:
+            cached_key, entry = self._pop_entry(key, model)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+        logger.info(
+            f"Cache lookup: {key.kind} {key.checkpoint}, reusing the compiled model of {cached_key.checkpoint}"
+        )
+        try:
+            copy_weights = cached_key != key
+            if copy_weights:
+                # The fingerprints are those of the unpatched weights
+                _unload_from_comfy(entry.weights, offload=False)
+            # The same checkpoint has the same weights
+            switched_model = switch_to_cached_model(
+                model,
+                entry.model,
+                copy_weights=copy_weights,
+                fingerprints=entry.fingerprints,
+            )
+        except Exception as e:
+            logger.warning(
+                f"An exception occurred when switching to cached model {cached_key.checkpoint}: {e}"
+            )
+            _unload_from_comfy(entry.weights)
+            model_management.soft_empty_cache()
+            return None
+        entry.owners.add(model)
+        with self._lock:
+            # Re-keyed by the checkpoint its weights are now from
+            self._device_cache[key] = entry
+            self._evict()
+        return switched_model
+
+    @classmethod
+    def stats(cls) -> Dict:
+        with cls._lock:
+            max_entries, max_bytes = cls._get_limits()["device"]
+            max_host_entries, max_host_bytes = cls._get_limits()["host"]
+
+            def entries(cache):
+                return [
+                    {"kind": k.kind, "checkpoint": k.checkpoint, "bytes": e.nbytes}
+                    for k, e in cache.items()
+                ]
+
+            return dict(
+                cls._stats,
+                device_entries=entries(cls._device_cache),
+                host_entries=entries(cls._host_cache),
+                device_bytes=sum(e.nbytes for e in cls._device_cache.values()),
+                host_bytes=sum(e.nbytes for e in cls._host_cache.values()),
+                max_entries=max_entries,
+                max_device_bytes=max_bytes,
+                max_host_entries=max_host_entries,
+                max_host_bytes=max_host_bytes,
+                weight_swaps=dict(_swap_totals),
+            )
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            for cache in (cls._device_cache, cls._host_cache):
+                for entry in cache.values():
+                    _unload_from_comfy(entry.weights)
+                cache.clear()
+            model_management.soft_empty_cache()
+
+
+def register_stats_route() -> None:
+    """Serves the stats of the cache at GET /onediff/booster_cache/stats of the ComfyUI server."""
+    try:
+        from aiohttp import web
+        from server import PromptServer
+    except ImportError:
+        return
+    if getattr(PromptServer, "instance", None) is None:
+        return
+
+    @PromptServer.instance.routes.get("/onediff/booster_cache/stats")
+    async def booster_cache_stats(request):
+        return web.json_response(BoosterCacheService.stats())
@@ -24,7 +24,10 @@ class BoosterExecutor(ABC):
 
 @dataclasses.dataclass
 class BoosterSettings:
+    # Separates the cached models of nodes that must not share them, None shares them
     tmp_cache_key: str = None
+    # Identifies the checkpoint of the model, a fingerprint of its weights if None
+    ckpt_name: str = None
 
 
 if __name__ == "__main__":
@@ -16,7 +16,13 @@ def auto_cache_model(func):
     def wrapper(self: "BoosterScheduler", model=None, *args, **kwargs):
         if self.settings is None:
             return func(self, model, *args, **kwargs)
-        cached_model_key = self.settings.tmp_cache_key
+        cached_model_key = self.cache_service.make_key(
+            model,
+            self.booster_executors,
+            ckpt_name=self.settings.ckpt_name,
+            namespace=self.settings.tmp_cache_key,
+            inplace=self.inplace,
+        )
         cached_model = self.cache_service.get_cached_model(cached_model_key, model)
         if cached_model is not None:
             return cached_model
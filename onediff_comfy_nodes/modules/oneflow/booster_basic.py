@@ -19,7 +19,7 @@ from .utils.booster_utils import (
     set_compiled_options,
     set_environment_for_svd_img2vid,
 )
-from .utils.graph_path import generate_graph_path
+from .utils.graph_path import generate_graph_path, get_model_patcher_patches
 
 
 class BasicOneFlowBoosterExecutor(BoosterExecutor):
@@ -45,7 +45,9 @@ class BasicOneFlowBoosterExecutor(BoosterExecutor):
 
         model.model.diffusion_model = compiled_model
 
-        graph_file = generate_graph_path(f"{type(model).__name__}", model=model.model)
+        graph_file = generate_graph_path(
+            ckpt_name, model.model, patches=get_model_patcher_patches(model)
+        )
         set_compiled_options(compiled_model, graph_file)
 
         model.weight_inplace_update = True
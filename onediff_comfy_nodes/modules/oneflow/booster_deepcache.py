@@ -7,7 +7,7 @@ from comfy.model_patcher import ModelPatcher
 from ..booster_interface import BoosterExecutor
 from .utils.booster_utils import set_compiled_options
 from .utils.deep_cache_speedup import deep_cache_speedup
-from .utils.graph_path import generate_graph_path
+from .utils.graph_path import generate_graph_path, get_model_patcher_patches
 
 
 @dataclass
@@ -41,12 +41,17 @@ class DeepcacheBoosterExecutor(BoosterExecutor):
             use_oneflow_deepcache_speedup_modelpatcher=False,
         )[0]
         if ckpt_name:
+            patches = get_model_patcher_patches(model)
+            patches["deepcache"] = {
+                "cache_layer_id": self.cache_layer_id,
+                "cache_block_id": self.cache_block_id,
+            }
             graph_file = generate_graph_path(
-                ckpt_name, model.fast_deep_cache_unet._torch_module
+                ckpt_name, model.fast_deep_cache_unet._torch_module, patches=patches
             )
             set_compiled_options(model.fast_deep_cache_unet, graph_file)
             graph_file = generate_graph_path(
-                ckpt_name, model.deep_cache_unet._torch_module
+                ckpt_name, model.deep_cache_unet._torch_module, patches=patches
             )
             set_compiled_options(model.deep_cache_unet, graph_file)
 
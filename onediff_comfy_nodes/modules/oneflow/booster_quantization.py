@@ -1,5 +1,5 @@
 import os
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from functools import partial, singledispatchmethod
 from typing import Any, Dict, Optional, Union
 
@@ -26,7 +26,7 @@ from .utils.booster_utils import (
     set_compiled_options,
     set_environment_for_svd_img2vid,
 )
-from .utils.graph_path import generate_graph_path
+from .utils.graph_path import generate_graph_path, get_model_patcher_patches
 
 
 class SubQuantizationPercentileCalculator(QuantizationMetricsCalculator):
@@ -178,8 +178,15 @@ class OnelineQuantizationBoosterExecutor(BoosterExecutor):
 
             compiled_model.apply_online_quant(quant_config)
             if ckpt_name:
-                cache_key = f"{ckpt_name}_{type(torch_model).__name__}"
-                graph_file = generate_graph_path(cache_key, torch_model)
+                patches = {"quantization": asdict(self)}
+                graph_model = torch_model
+                if isinstance(model, ModelPatcher):
+                    patches.update(get_model_patcher_patches(model))
+                    # As the basic booster, so the graph is indexed as a "unet"
+                    graph_model = model.model
+                graph_file = generate_graph_path(
+                    ckpt_name, graph_model, patches=patches
+                )
                 quant_config.cache_dir = os.path.dirname(graph_file)
                 set_compiled_options(compiled_model, graph_file)
 
@@ -4,6 +4,8 @@ https://github.com/cubiq/ComfyUI_IPAdapter_plus/blob/main/CrossAttentionPatch.py
 """
 
 import math
+import weakref
+from collections import OrderedDict
 
 import torch
 import torch.nn.functional as F
@@ -30,6 +32,114 @@ def get_weight_subidxs(weight,ad_params,sub_idxs):
     return weight[ad_params[sub_idxs]]
 
 
+def _tensor_version(tensor):
+    try:
+        return tensor._version
+    except (AttributeError, RuntimeError):
+        # Inference tensors and oneflow tensors have no version counter
+        return None
+
+
+def _tensor_state(tensor):
+    """The version of the tensor, or its data pointer if it has no version counter."""
+    version = _tensor_version(tensor)
+    return ("data_ptr", tensor.data_ptr()) if version is None else version
+
+
+def _tensor_stamp(tensor):
+    """A weak reference to the tensor, not to keep replaced tensors alive, and its state."""
+    if tensor is None:
+        return None, None
+    try:
+        ref = weakref.ref(tensor)
+    except TypeError:
+        ref = lambda: tensor
+    return ref, _tensor_state(tensor)
+
+
+def _is_same_tensor(stamp, tensor):
+    ref, state = stamp
+    if ref is None:
+        return tensor is None
+    return ref() is tensor and _tensor_state(tensor) == state
+
+
+class IPAdapterKVCache:
+    """The projected IPAdapter keys and values of the attention layers.
+
+    They only depend on the image embeddings, the projection weights and the batch
+    layout, so they are computed at the first step of a sampling and reused by the next
+    steps. An entry is recomputed when any of its source tensors is replaced, or updated
+    in place as seen by the version counter. Tensors without one, e.g. the inference
+    tensors created under torch.inference_mode(), are compared by their data pointer, and
+    the entries are dropped at the start of each sampling, so in-place updates between
+    samplings are seen without synchronizing with the device. Lazy tensors, i.e. while
+    tracing a graph, are never cached.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._sample_sigmas = None
+        self._sigmas = None
+        self._sigma = None
+
+    def update_run(self, extra_options):
+        """Drops the entries when a new sampling starts.
+
+        A sampling is identified by the `sample_sigmas` of the transformer options, or starts
+        when the sigma increases if they aren't given.
+        """
+        sample_sigmas = extra_options.get("sample_sigmas", None)
+        if sample_sigmas is not None:
+            if sample_sigmas is not self._sample_sigmas:
+                self._sample_sigmas = sample_sigmas
+                self.clear()
+            return
+        sigmas = extra_options.get("sigmas", None)
+        if (
+            sigmas is None
+            or sigmas is self._sigmas
+            or getattr(sigmas, "is_lazy", False)
+        ):
+            # The layers of a step share the sigmas
+            return
+        self._sigmas = sigmas
+        if isinstance(sigmas, torch.Tensor):
+            sigma = sigmas.max().item()
+        else:
+            sigma = float(sigmas)
+        if self._sigma is not None and sigma > self._sigma:
+            self.clear()
+        self._sigma = sigma
+
+    def get(self, key, sources, compute):
+        if any(getattr(t, "is_lazy", False) for t in sources):
+            return compute()
+        entry = self.entries.get(key, None)
+        if (
+            entry is not None
+            and len(sources) == len(entry[0])
+            and all(_is_same_tensor(stamp, t) for stamp, t in zip(entry[0], sources))
+        ):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = compute()
+        self.entries[key] = ([_tensor_stamp(t) for t in sources], value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+
 class Attn2Replace:
     def __init__(self, callback=None, **kwargs):
         self.callback = [callback]
@@ -40,6 +150,7 @@ class Attn2Replace:
         self.cache_map = {}  # {ui_index, index}
         self._bind_model = None
         self.optimized_attention = optimized_attention
+        self.kv_cache = IPAdapterKVCache()
 
     def get_bind_model(self):
         return self._bind_model
@@ -57,6 +168,8 @@ class Attn2Replace:
         sigma = extra_options["sigmas"] if "sigmas" in extra_options else 999999999.9
 
         patch_kwargs = extra_options["_attn2"].get(self.forward_patch_key)
+        if self.kv_cache is not None:
+            self.kv_cache.update_run(extra_options)
         for i, callback in enumerate(self.callback):
             if (
                 sigma <= self.kwargs[i]["sigma_start"]
@@ -69,6 +182,7 @@ class Attn2Replace:
                     v,
                     extra_options,
                     optimized_attention=self.optimized_attention,
+                    kv_cache=self.kv_cache,
                     **self.kwargs[i],
                     **patch_kwargs[i]
                 )
@@ -80,6 +194,54 @@ class Attn2Replace:
         return self
 
 
+def _project_ip_kv(
+    ipadapter,
+    k_key,
+    v_key,
+    cond,
+    uncond,
+    cond_or_uncond,
+    batch_prompt,
+    unfold_batch,
+    ad_params,
+):
+    """Projects the image embeddings to the keys and values of the batch."""
+    if unfold_batch:
+        # Check AnimateDiff context window
+        if ad_params is not None and ad_params["sub_idxs"] is not None:
+            # if image length matches or exceeds full_length get sub_idx images
+            if cond.shape[0] >= ad_params["full_length"]:
+                cond = get_weight_subidxs(cond,ad_params,"sub_idxs")
+                uncond = get_weight_subidxs(uncond,ad_params,"sub_idxs")
+            # otherwise get sub_idxs images
+            else:
+                cond = tensor_to_size(cond, ad_params["full_length"])
+                uncond = tensor_to_size(uncond, ad_params["full_length"])
+                cond = cond[ad_params["sub_idxs"]]
+                uncond = uncond[ad_params["sub_idxs"]]
+        else:
+            cond = tensor_to_size(cond, batch_prompt)
+            uncond = tensor_to_size(uncond, batch_prompt)
+
+        k_cond = ipadapter.ip_layers.to_kvs[k_key](cond)
+        k_uncond = ipadapter.ip_layers.to_kvs[k_key](uncond)
+        v_cond = ipadapter.ip_layers.to_kvs[v_key](cond)
+        v_uncond = ipadapter.ip_layers.to_kvs[v_key](uncond)
+    else:
+        k_cond = ipadapter.ip_layers.to_kvs[k_key](cond).repeat(batch_prompt, 1, 1)
+        k_uncond = ipadapter.ip_layers.to_kvs[k_key](uncond).repeat(batch_prompt, 1, 1)
+        v_cond = ipadapter.ip_layers.to_kvs[v_key](cond).repeat(batch_prompt, 1, 1)
+        v_uncond = ipadapter.ip_layers.to_kvs[v_key](uncond).repeat(batch_prompt, 1, 1)
+
+    if len(cond_or_uncond) == 3:  # TODO: conxl, I need to check this
+        ip_k = torch.cat([(k_cond, k_uncond, k_cond)[i] for i in cond_or_uncond], dim=0)
+        ip_v = torch.cat([(v_cond, v_uncond, v_cond)[i] for i in cond_or_uncond], dim=0)
+    else:
+        ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0)
+        ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0)
+    return ip_k, ip_v
+
+
 def ipadapter_attention(
     out,
     q,
@@ -99,9 +261,13 @@ def ipadapter_attention(
     unfold_batch=False,
     embeds_scaling="V only",
     optimized_attention=None,
+    kv_cache=None,
     **kwargs
 ):
     dtype = q.dtype
+    # The embeddings the keys and values are projected from, and how they are altered
+    embeds = [cond, uncond]
+    embeds_variant = None
     cond_or_uncond = extra_options["cond_or_uncond"]
     block_type = extra_options["block"][0]
     # block_id = extra_options["block"][1]
@@ -144,89 +310,76 @@ def ipadapter_attention(
             if layers == 11 and t_idx == 3:
                 uncond = cond
                 cond = cond * 0
+                embeds_variant = "zero_cond"
             elif layers == 16 and (t_idx == 4 or t_idx == 5):
                 uncond = cond
                 cond = cond * 0
+                embeds_variant = "zero_cond"
 
         elif weight_type == "composition precise":
             if layers == 11 and t_idx != 3:
                 uncond = cond
                 cond = cond * 0
+                embeds_variant = "zero_cond"
             elif layers == 16 and (t_idx != 4 and t_idx != 5):
                 uncond = cond
                 cond = cond * 0
+                embeds_variant = "zero_cond"
 
         weight = weight[t_idx]
 
         if cond_alt is not None and t_idx in cond_alt:
             cond = cond_alt[t_idx]
+            embeds.append(cond)
             del cond_alt
 
-    if unfold_batch:
+    # TODO: should we always convert the weights to a tensor?
+    if isinstance(weight, torch.Tensor) and weight.dim() != 0:
         # Check AnimateDiff context window
-        if ad_params is not None and ad_params["sub_idxs"] is not None:
-            if isinstance(weight, torch.Tensor) and weight.dim() != 0:
-                weight = tensor_to_size(weight, ad_params["full_length"])
-                weight = get_weight_subidxs(weight,ad_params,"sub_idxs")
-                # if torch.all(weight == 0):
-                #     return 0
-                weight = weight.repeat(
-                    len(cond_or_uncond), 1, 1
-                )  # repeat for cond and uncond
-            # elif weight == 0:
-            #     return 0
-
-            # if image length matches or exceeds full_length get sub_idx images
-            if cond.shape[0] >= ad_params["full_length"]:
-                cond = get_weight_subidxs(cond,ad_params,"sub_idxs")
-                uncond = get_weight_subidxs(uncond,ad_params,"sub_idxs")
-            # otherwise get sub_idxs images
-            else:
-                cond = tensor_to_size(cond, ad_params["full_length"])
-                uncond = tensor_to_size(uncond, ad_params["full_length"])
-                cond = cond[ad_params["sub_idxs"]]
-                uncond = uncond[ad_params["sub_idxs"]]
+        if unfold_batch and ad_params is not None and ad_params["sub_idxs"] is not None:
+            weight = tensor_to_size(weight, ad_params["full_length"])
+            weight = get_weight_subidxs(weight, ad_params, "sub_idxs")
         else:
-            if isinstance(weight, torch.Tensor) and weight.dim() != 0:
-                weight = tensor_to_size(weight, batch_prompt)
-                # if torch.all(weight == 0):
-                #     return 0
-                weight = weight.repeat(
-                    len(cond_or_uncond), 1, 1
-                )  # repeat for cond and uncond
-            # elif weight == 0:
-            #     return 0
-
-            cond = tensor_to_size(cond, batch_prompt)
-            uncond = tensor_to_size(uncond, batch_prompt)
-
-        k_cond = ipadapter.ip_layers.to_kvs[k_key](cond)
-        k_uncond = ipadapter.ip_layers.to_kvs[k_key](uncond)
-        v_cond = ipadapter.ip_layers.to_kvs[v_key](cond)
-        v_uncond = ipadapter.ip_layers.to_kvs[v_key](uncond)
-    else:
-        # TODO: should we always convert the weights to a tensor?
-        if isinstance(weight, torch.Tensor) and weight.dim() != 0:
             weight = tensor_to_size(weight, batch_prompt)
-            # if torch.all(weight == 0):
-            #     return 0
-            weight = weight.repeat(
-                len(cond_or_uncond), 1, 1
-            )  # repeat for cond and uncond
-        # elif weight == 0:
-        #     return 0
-
-        k_cond = ipadapter.ip_layers.to_kvs[k_key](cond).repeat(batch_prompt, 1, 1)
-        k_uncond = ipadapter.ip_layers.to_kvs[k_key](uncond).repeat(batch_prompt, 1, 1)
-        v_cond = ipadapter.ip_layers.to_kvs[v_key](cond).repeat(batch_prompt, 1, 1)
-        v_uncond = ipadapter.ip_layers.to_kvs[v_key](uncond).repeat(batch_prompt, 1, 1)
-
-    if len(cond_or_uncond) == 3:  # TODO: conxl, I need to check this
-        ip_k = torch.cat([(k_cond, k_uncond, k_cond)[i] for i in cond_or_uncond], dim=0)
-        ip_v = torch.cat([(v_cond, v_uncond, v_cond)[i] for i in cond_or_uncond], dim=0)
+        weight = weight.repeat(len(cond_or_uncond), 1, 1)  # repeat for cond and uncond
+
+    project_args = (
+        ipadapter,
+        k_key,
+        v_key,
+        cond,
+        uncond,
+        cond_or_uncond,
+        batch_prompt,
+        unfold_batch,
+        ad_params,
+    )
+    if kv_cache is None:
+        ip_k, ip_v = _project_ip_kv(*project_args)
     else:
-        ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0)
-        ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0)
+        to_k = ipadapter.ip_layers.to_kvs[k_key]
+        to_v = ipadapter.ip_layers.to_kvs[v_key]
+        sub_idxs = None
+        if ad_params is not None and ad_params["sub_idxs"] is not None:
+            sub_idxs = (tuple(ad_params["sub_idxs"]), ad_params["full_length"])
+        cache_key = (
+            module_key,
+            id(ipadapter),
+            embeds_variant,
+            tuple(cond_or_uncond),
+            batch_prompt,
+            unfold_batch,
+            sub_idxs,
+        )
+        sources = embeds + [
+            to_k.weight,
+            getattr(to_k, "bias", None),
+            to_v.weight,
+            getattr(to_v, "bias", None),
+        ]
+        ip_k, ip_v = kv_cache.get(
+            cache_key, sources, lambda: _project_ip_kv(*project_args)
+        )
 
     if embeds_scaling == "K+mean(V) w/ C penalty":
         scaling = float(ip_k.shape[2]) / 1280.0
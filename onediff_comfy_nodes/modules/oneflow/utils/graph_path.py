@@ -1,27 +1,263 @@
+"""Content-keyed graph file paths of the compiled ComfyUI models.
+
+A graph path is `<graph_dir>/graphs/<ModelClass>/<checkpoint>_<key>`, where the key is a digest
+of everything that changes the compiled graph and is known when the model is compiled: the
+model class and config, the parameter shapes, the dtype, the patches (DeepCache, quantization,
+IPAdapter), the onediff and oneflow versions and an optional input shape class. The graph
+repository of the oneflow backend adds the key of the concrete inputs to the file name, so
+each resolution gets its own file.
+
+The resolved paths and their metadata are recorded in `<graph_dir>/graphs/graph_paths.json`,
+which the graph loader nodes read to list and pick the graphs compatible with a model without
+scanning or loading graph files.
+"""
+
 import hashlib
+import json
 import os
+import re
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Dict, List, Optional
 
 # ComfyUI
 from folder_paths import get_input_directory
 
 # onediff
 from onediff import __version__ as onediff_version
+from onediff.utils import logger
 from oneflow import __version__ as oneflow_version
 
+try:
+    import fcntl
+except ImportError:  # fcntl is not available on Windows
+    fcntl = None
+
+INDEX_FILE_NAME = "graph_paths.json"
+LOCK_FILE_NAME = "graph_paths.lock"
+_INDEX_VERSION = 1
+
 
 def generate_short_sha256(string: str) -> str:
     return hashlib.sha256(string.encode("utf-8")).hexdigest()[:10]
 
 
-def generate_graph_path(ckpt_name, model) -> Path:
-    # get_save_graph_directory
+def get_graph_dir() -> Path:
     default_dir = get_input_directory()
     input_dir = os.getenv("COMFYUI_ONEDIFF_SAVE_GRAPH_DIR", default_dir)
+    return Path(input_dir) / "graphs"
+
+
+def get_model_kind(model) -> str:
+    """Returns "unet" for ComfyUI models, "vae" for VAEs, otherwise the class name."""
+    if hasattr(model, "diffusion_model"):
+        return "unet"
+    if hasattr(model, "encode") and hasattr(model, "decode"):
+        return "vae"
+    return type(model).__name__
+
+
+def _get_torch_module(model):
+    return getattr(model, "_torch_module", model)
+
+
+def get_model_dtype(model) -> str:
+    model = _get_torch_module(model)
+    for param in model.parameters():
+        return str(param.dtype)
+    return "none"
+
+
+def generate_model_fingerprint(model) -> str:
+    """Digest of the class, the config and the parameter shapes of a model, not its weights."""
+    model = _get_torch_module(model)
+    cls = type(model)
+    # ComfyUI models keep their config in `model_config`, diffusers models in `config`
+    config = getattr(getattr(model, "model_config", None), "unet_config", None)
+    if config is None:
+        config = getattr(model, "config", None)
+    shapes = [(name, tuple(param.shape)) for name, param in model.named_parameters()]
+    content = json.dumps(
+        [f"{cls.__module__}.{cls.__qualname__}", config, shapes],
+        sort_keys=True,
+        default=str,
+    )
+    return generate_short_sha256(content)
+
+
+def get_model_patcher_patches(model_patcher) -> Dict:
+    """Returns the patches of a ModelPatcher that are compiled into the graph."""
+    patches = {}
+    transformer_options = model_patcher.model_options.get("transformer_options", {})
+    attn2 = transformer_options.get("patches_replace", {}).get("attn2", {})
+    if attn2:
+        # IPAdapter replaces the cross attention of the patched blocks
+        patches["ipadapter"] = sorted(str(key) for key in attn2)
+    return patches
+
+
+def _checkpoint_stem(ckpt_name) -> str:
+    if not ckpt_name:
+        return "model"
+    stem = Path(str(ckpt_name)).stem
+    return re.sub(r"[^\w.-]", "_", stem)[:64]
+
+
+class GraphPathIndex:
+    """GraphPathIndex
+
+    The metadata of the resolved graph paths, keyed by their path relative to `graph_dir`.
+    It is written to a temporary file and renamed into place while holding a lock, so several
+    ComfyUI workers can share one graph directory.
+
+    __init__ args:
+        `graph_dir`: The graph directory, `get_graph_dir()` by default.
+    """
+
+    def __init__(self, graph_dir: Optional[Path] = None):
+        self.graph_dir = Path(graph_dir) if graph_dir else get_graph_dir()
+        self.index_path = self.graph_dir / INDEX_FILE_NAME
+        self.lock_path = self.graph_dir / LOCK_FILE_NAME
+
+    @contextmanager
+    def lock(self):
+        os.makedirs(self.graph_dir, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def read(self) -> Dict:
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Failed to read graph index {self.index_path}, reset it. {e=}"
+            )
+            return {}
+        if index.get("version") != _INDEX_VERSION:
+            return {}
+        return index["entries"]
+
+    def _write(self, entries: Dict) -> None:
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"version": _INDEX_VERSION, "entries": entries},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, self.index_path)
+
+    def register(self, name: str, metadata: Dict) -> None:
+        with self.lock():
+            entries = self.read()
+            entry = entries.get(name, None)
+            now = time.time()
+            if entry is None:
+                entry = dict(metadata, created=now)
+                entries[name] = entry
+            entry["last_used"] = now
+            self._write(entries)
+
+    def _saved_names(self, entries: Dict) -> set:
+        """The entries with at least one graph file saved by the graph repository."""
+        files_of_dir = {}
+        saved = set()
+        for name in entries:
+            sub_dir, prefix = os.path.split(name)
+            if sub_dir not in files_of_dir:
+                try:
+                    files_of_dir[sub_dir] = os.listdir(self.graph_dir / sub_dir)
+                except FileNotFoundError:
+                    files_of_dir[sub_dir] = []
+            if any(
+                f.startswith(f"{prefix}_") and f.endswith(".graph")
+                for f in files_of_dir[sub_dir]
+            ):
+                saved.add(name)
+        return saved
+
+    def list(
+        self, kind: Optional[str] = None, saved_only: bool = True
+    ) -> Dict[str, Dict]:
+        """Returns the entries of `kind`, by default only those with saved graph files."""
+        entries = self.read()
+        if kind is not None:
+            entries = {k: v for k, v in entries.items() if v.get("kind") == kind}
+        if saved_only:
+            saved = self._saved_names(entries)
+            entries = {k: v for k, v in entries.items() if k in saved}
+        return entries
+
+    def find_compatible(self, model, patches: Optional[Dict] = None) -> List[str]:
+        """Returns the saved graphs compatible with `model`, the most recently used first."""
+        metadata = generate_graph_metadata(None, model, patches=patches)
+        keys = (
+            "kind",
+            "fingerprint",
+            "dtype",
+            "patches",
+            "onediff_version",
+            "oneflow_version",
+        )
+        compatible = [
+            (entry["last_used"], name)
+            for name, entry in self.list(kind=metadata["kind"]).items()
+            if all(entry.get(k) == metadata[k] for k in keys)
+        ]
+        return [name for _, name in sorted(compatible, reverse=True)]
+
+    def get_graph_path(self, name: str) -> Path:
+        return self.graph_dir / name
+
+
+def generate_graph_metadata(
+    ckpt_name, model, patches: Optional[Dict] = None, shape_class=None
+) -> Dict:
+    # Round-trip through json, so the metadata compares equal to the indexed one
+    patches = json.loads(json.dumps(patches or {}, sort_keys=True, default=str))
+    return {
+        "kind": get_model_kind(_get_torch_module(model)),
+        "model_class": type(_get_torch_module(model)).__name__,
+        "ckpt_name": str(ckpt_name) if ckpt_name else None,
+        "fingerprint": generate_model_fingerprint(model),
+        "dtype": get_model_dtype(model),
+        "patches": patches,
+        "shape_class": None if shape_class is None else str(shape_class),
+        "onediff_version": onediff_version,
+        "oneflow_version": oneflow_version,
+    }
+
 
-    input_dir = Path(input_dir)
-    graph_dir = input_dir / "graphs"
+def generate_graph_path(
+    ckpt_name, model, *, patches: Optional[Dict] = None, shape_class=None
+) -> Path:
+    """Returns the graph path of `model` compiled from `ckpt_name`, and records it in the index.
 
-    file_name = f"{type(model).__name__}"
+    `patches` are the options of the patches compiled into the graph, e.g.
+    `{"deepcache": {...}}`. `shape_class` separates graphs of the same model that are compiled
+    for different input shapes, e.g. a resolution bucket.
+    """
+    metadata = generate_graph_metadata(
+        ckpt_name, model, patches=patches, shape_class=shape_class
+    )
+    key_parts = {k: v for k, v in metadata.items() if k != "kind"}
+    key = generate_short_sha256(json.dumps(key_parts, sort_keys=True))
+    name = f"{metadata['model_class']}/{_checkpoint_stem(ckpt_name)}_{key}"
 
-    return graph_dir / file_name
+    index = GraphPathIndex()
+    try:
+        index.register(name, metadata)
+    except OSError as e:
+        logger.warning(f"Failed to record the graph path {name}. {e=}")
+    return index.get_graph_path(name)
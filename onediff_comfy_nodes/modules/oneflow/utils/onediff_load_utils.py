@@ -18,11 +18,12 @@ def onediff_load_quant_checkpoint_advanced(
     Loads a quantized and potentially optimized model checkpoint, applies quantization,
     optionally compiles the model, and applies VAE speedup if enabled.
     """
-    ckpt_name = f"{ckpt_name}_quant_{model_path}"
+    graph_file = generate_graph_path(
+        ckpt_name, modelpatcher.model, patches={"quantization": model_path}
+    )
     model_path = (
         Path(folder_paths.models_dir) / ONEDIFF_QUANTIZED_OPTIMIZED_MODELS / model_path
     )
-    graph_file = generate_graph_path(ckpt_name, modelpatcher.model)
 
     calibrate_info = torch.load(model_path)
 
@@ -1,7 +1,10 @@
+import hashlib
+import inspect
+import json
 import os
 import time
 from contextlib import contextmanager
-from typing import Dict
+from typing import Callable, Dict, List, Optional
 
 # ComfyUI
 import folder_paths
@@ -23,6 +26,7 @@ from onediff_quant.utils import (
 )
 
 # onediff_comfy_nodes
+from ...booster_cache import compute_tensor_fingerprints
 from .model_patcher import OneFlowDeepCacheSpeedUpModelPatcher
 
 
@@ -103,6 +107,241 @@ class quantized_model_patcher:
         return False
 
 
+def _input_channel_power(module, x):
+    """Mean square of the input of `module` per input channel, or overall for grouped convs."""
+    x = x.detach().float()
+    if isinstance(module, nn.Linear):
+        return x.pow(2).reshape(-1, x.shape[-1]).mean(0)
+    if module.groups == 1:
+        return x.pow(2).transpose(0, 1).reshape(x.shape[1], -1).mean(1)
+    return x.pow(2).mean().reshape(1)
+
+
+def estimate_quantize_error(weight, bits, input_power) -> float:
+    """Noise to signal ratio of the output of a layer with per channel quantized weights.
+
+    Treats the input channels as uncorrelated, so the output power is the sum over the input
+    channels of the weight energy times the input power of the channel.
+    """
+    weight = weight.detach().float()
+    reduce_dims = list(range(1, weight.dim()))
+    maxq = 2 ** (bits - 1) - 1
+    scale = weight.abs().amax(dim=reduce_dims, keepdim=True).clamp(min=1e-8) / maxq
+    error = torch.clamp(torch.round(weight / scale), -maxq - 1, maxq) * scale - weight
+
+    def energy(w):
+        w = w.pow(2).sum(dim=0)
+        if input_power.numel() == 1:
+            return w.sum()
+        return w.reshape(w.shape[0], -1).sum(dim=1)
+
+    input_power = input_power.to(weight.device)
+    signal = (energy(weight) * input_power).sum()
+    noise = (energy(error) * input_power).sum()
+    return (noise / signal.clamp(min=1e-12)).item()
+
+
+def _update_digest(hasher, value) -> None:
+    """Hashes the content of sampling args, e.g. the tensors of conditionings and latents."""
+    if isinstance(value, torch.Tensor):
+        hasher.update(f"tensor{tuple(value.shape)}:{value.dtype};".encode("utf-8"))
+        data = value.detach().reshape(-1).cpu().contiguous()
+        hasher.update(data.view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, dict):
+        hasher.update(b"{")
+        for key in sorted(value, key=str):
+            hasher.update(f"{key}:".encode("utf-8"))
+            _update_digest(hasher, value[key])
+        hasher.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"[")
+        for item in value:
+            _update_digest(hasher, item)
+        hasher.update(b"]")
+    elif isinstance(value, (int, float, str, bool, type(None))):
+        hasher.update(f"{value!r};".encode("utf-8"))
+    else:
+        # e.g. a ControlNet in a conditioning, identified by its type only
+        hasher.update(f"{type(value).__qualname__};".encode("utf-8"))
+
+
+class LayerSensitivityCalibrator:
+    """Measures the latent MSE of quantizing each layer, with fewer samplings than layers.
+
+    The layers are sorted by an error estimated from the activation statistics of the
+    reference sampling. Neighbouring layers are quantized together and sampled once; a group
+    whose MSE is at most `group_mse_threshold` gives its MSE to all of its layers, which bounds
+    their own, otherwise it is split in halves until single layers. The results are saved to
+    `checkpoint_file` after each sampling, so an interrupted run resumes where it stopped.
+
+    __init__ args:
+        `model_patcher`: The ModelPatcher of the diffusion model.
+        `quantizable_modules`: The layers to calibrate, by name.
+        `sample_fn`: Returns the latent samples generated by a ModelPatcher.
+        `bits`: The number of bits of the quantized weights.
+        `group_size`: The number of layers sampled together, 1 samples each layer.
+        `group_mse_threshold`: The MSE under which a group is not split. Every layer of such
+            a group gets the MSE of the whole group, not its own, so the `mse` compared with the
+            thresholds of `fine_tune_calibrate_info` is an upper bound that depends on the
+            grouping; `group_size=1` gives the MSE of each layer alone.
+        `activation_score_threshold`: Layers with an estimated error under it start in one
+            group, whatever its size.
+        `checkpoint_file`: The JSON file of the results, None disables checkpointing.
+    """
+
+    def __init__(
+        self,
+        model_patcher,
+        quantizable_modules: Dict[str, nn.Module],
+        sample_fn: Callable,
+        bits: int = 8,
+        *,
+        group_size: int = 8,
+        group_mse_threshold: float = 0.01,
+        activation_score_threshold: Optional[float] = None,
+        checkpoint_file: Optional[str] = None,
+    ):
+        self.model_patcher = model_patcher
+        self.quantizable_modules = quantizable_modules
+        self.sample_fn = sample_fn
+        self.bits = bits
+        self.group_size = max(1, group_size)
+        self.group_mse_threshold = group_mse_threshold
+        self.activation_score_threshold = activation_score_threshold
+        self.checkpoint_file = checkpoint_file
+        self.input_power = {}
+        self.num_samplings = 0
+        self.results = {"layers": {}, "groups": {}}
+        self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        if self.checkpoint_file is None or not os.path.exists(self.checkpoint_file):
+            return
+        with open(self.checkpoint_file, "r") as f:
+            self.results = json.load(f)
+        print(
+            f"Resuming calibration from {self.checkpoint_file}, "
+            f"{len(self.results['layers'])}/{len(self.quantizable_modules)} layers done."
+        )
+
+    def _save_checkpoint(self):
+        if self.checkpoint_file is None:
+            return
+        os.makedirs(os.path.dirname(self.checkpoint_file) or ".", exist_ok=True)
+        tmp_file = f"{self.checkpoint_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.results, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    @contextmanager
+    def record_activations(self):
+        """Accumulates the input power of the layers while sampling the reference."""
+        counts = {}
+
+        def hook(name, module, inputs):
+            power = _input_channel_power(module, inputs[0])
+            if name in self.input_power:
+                self.input_power[name] += power
+            else:
+                self.input_power[name] = power
+            counts[name] = counts.get(name, 0) + 1
+
+        handles = [
+            module.register_forward_pre_hook(
+                lambda module, inputs, name=name: hook(name, module, inputs)
+            )
+            for name, module in self.quantizable_modules.items()
+        ]
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+            for name, count in counts.items():
+                self.input_power[name] /= count
+
+    def activation_scores(self) -> Dict[str, float]:
+        scores = {}
+        for name, module in self.quantizable_modules.items():
+            input_power = self.input_power.get(name, None)
+            if input_power is None:
+                # Not called by the sampling, so its error can't be estimated
+                scores[name] = float("inf")
+                continue
+            scores[name] = estimate_quantize_error(
+                module.weight, self.bits, input_power
+            )
+        return scores
+
+    def groups(self, scores: Dict[str, float]) -> List[List[str]]:
+        names = sorted(scores, key=lambda name: (scores[name], name))
+        groups = []
+        if self.activation_score_threshold is not None:
+            insensitive = [
+                name
+                for name in names
+                if scores[name] <= self.activation_score_threshold
+            ]
+            if insensitive:
+                groups.append(insensitive)
+            names = names[len(insensitive) :]
+        for i in range(0, len(names), self.group_size):
+            groups.append(names[i : i + self.group_size])
+        return groups
+
+    def measure(self, layers: List[str], reference) -> float:
+        key = hashlib.sha256(",".join(layers).encode("utf-8")).hexdigest()[:16]
+        if key in self.results["groups"]:
+            return self.results["groups"][key]
+
+        with quantized_model_patcher(
+            model_patcher=self.model_patcher, layers=layers, bits=self.bits
+        ) as qmpatcher:
+            latent_sample = self.sample_fn(qmpatcher)
+        self.num_samplings += 1
+        mse = torch.mean((reference - latent_sample) ** 2).item()
+        self.results["groups"][key] = mse
+        self._save_checkpoint()
+        return mse
+
+    def _calibrate_group(self, group: List[str], reference) -> None:
+        group = [name for name in group if name not in self.results["layers"]]
+        if not group:
+            return
+        mse = self.measure(group, reference)
+        if len(group) > 1 and mse > self.group_mse_threshold:
+            half = len(group) // 2
+            self._calibrate_group(group[:half], reference)
+            self._calibrate_group(group[half:], reference)
+            return
+        print(f"mse: {mse:.4f} of {len(group)} layers, {group[0]}...")
+        for name in group:
+            self.results["layers"][name] = mse
+        self._save_checkpoint()
+
+    def calibrate(self, reference) -> Dict[str, float]:
+        """Returns the latent MSE of each layer, needs `record_activations` to have run."""
+        scores = self.activation_scores()
+        groups = self.groups(scores)
+        length = len(self.quantizable_modules)
+        start_time = time.time()
+        for index, group in enumerate(groups):
+            self._calibrate_group(group, reference)
+            done = len(self.results["layers"])
+            print(
+                f"Calibrated {done}/{length} layers in {self.num_samplings} samplings, "
+                f"group {index + 1}/{len(groups)}."
+            )
+            if done < length:
+                estimated_remaining_time = (
+                    (time.time() - start_time) / (index + 1) * (len(groups) - index - 1)
+                )
+                print(
+                    f"Estimated remaining time: {estimated_remaining_time / 60:.4f} minutes"
+                )
+        return dict(self.results["layers"])
+
+
 class KSampleQuantumBase(KSampler):
     @classmethod
     def INPUT_TYPES(s):
@@ -141,6 +380,37 @@ class KSampleQuantumBase(KSampler):
 
         return ImageGenerationPipeline()
 
+    def with_proxy_steps(self, model_patcher, proxy_steps, args, kwargs):
+        """Returns the sampling args and kwargs with `steps` replaced by `proxy_steps`."""
+        if proxy_steps is None:
+            return args, kwargs
+        bound = inspect.signature(self.sample).bind(model_patcher, *args, **kwargs)
+        bound.arguments["steps"] = proxy_steps
+        return bound.args[1:], bound.kwargs
+
+    def default_checkpoint_file(
+        self, diffusion_model, quantizable_modules, bits, args, kwargs
+    ) -> str:
+        """A checkpoint file keyed by the layers, the bits, the weights and the sampling args.
+
+        The weights are identified by sampled fingerprints, the args by their content,
+        including the tensors of the conditionings and the latent.
+        """
+        hasher = hashlib.sha256(
+            json.dumps([list(quantizable_modules), bits]).encode("utf-8")
+        )
+        for name, fingerprint in sorted(
+            compute_tensor_fingerprints(diffusion_model).items()
+        ):
+            hasher.update(name.encode("utf-8"))
+            hasher.update(fingerprint)
+        _update_digest(hasher, list(args))
+        _update_digest(hasher, kwargs)
+        key = hasher.hexdigest()[:16]
+        return os.path.join(
+            folder_paths.get_output_directory(), "onediff_calibrate", f"{key}.json"
+        )
+
     def generate_calibrate_info(
         self,
         model_patcher,
@@ -149,9 +419,21 @@ class KSampleQuantumBase(KSampler):
         quantized_model_generator: callable = lambda x: x.model.diffusion_model,
         model_cls=[nn.Linear, nn.Conv2d],
         *args,
+        proxy_steps: Optional[int] = None,
+        group_size: int = 8,
+        group_mse_threshold: float = 0.01,
+        activation_score_threshold: Optional[float] = None,
+        checkpoint_file: Optional[str] = None,
         **kwargs,
     ) -> Dict:
-        """return calibrate_info"""
+        """return calibrate_info
+
+        The samplings of the calibration run `proxy_steps` steps instead of `steps` if it is
+        set. See LayerSensitivityCalibrator for the other options, `group_size=1` measures
+        each layer alone, larger groups give the layers of a group under `group_mse_threshold`
+        the MSE of the group. The progress is saved to `checkpoint_file`, by default a file of
+        the output directory keyed by the layers, the weights and the sampling args.
+        """
 
         calibrate_info = {}
 
@@ -161,9 +443,7 @@ class KSampleQuantumBase(KSampler):
             diffusion_model, module_cls=model_cls
         )
 
-        org_latent_sample = self.generate_latent_sample(model_patcher, *args, **kwargs)[
-            "samples"
-        ]
+        args, kwargs = self.with_proxy_steps(model_patcher, proxy_steps, args, kwargs)
         pipe = self.generate_pipeline(model_patcher, *args, **kwargs)
         quantize_costs = metric_quantize_costs(
             pipe, pipe_kwargs={}, quantizable_modules=quantizable_modules
@@ -178,32 +458,33 @@ class KSampleQuantumBase(KSampler):
 
             return calibrate_info
 
-        length = len(quantizable_modules)
-        start_time = time.time()
-        for index, (sub_name, _) in enumerate(quantizable_modules.items()):
-            print(f"Quantizing {index+1}/{length} {sub_name}...")
-
-            with quantized_model_patcher(
-                model_patcher=model_patcher, layers=[sub_name], bits=bits
-            ) as qmpatcher:
-                cur_latent_sample = self.generate_latent_sample(
-                    qmpatcher, *args, **kwargs
-                )["samples"]
-
-                mse = torch.mean((org_latent_sample - cur_latent_sample) ** 2)
-
-                compute_density = quantize_costs.get_compute_density(sub_name)
-                print(f"mse: {mse:.4f}, compute_density: {compute_density:.4f}")
-
-                calibrate_info[sub_name] = {
-                    "mse": mse,
-                    "compute_density": compute_density,
-                }
-
-            estimated_remaining_time = (
-                (time.time() - start_time) / (index + 1) * (length - index - 1) / 60
+        if checkpoint_file is None:
+            checkpoint_file = self.default_checkpoint_file(
+                diffusion_model, quantizable_modules, bits, args, kwargs
             )
-            print(f"Estimated remaining time: {estimated_remaining_time:.4f} minutes")
+        calibrator = LayerSensitivityCalibrator(
+            model_patcher,
+            quantizable_modules,
+            lambda patcher: self.generate_latent_sample(patcher, *args, **kwargs)[
+                "samples"
+            ],
+            bits,
+            group_size=group_size,
+            group_mse_threshold=group_mse_threshold,
+            activation_score_threshold=activation_score_threshold,
+            checkpoint_file=checkpoint_file,
+        )
+        with calibrator.record_activations():
+            org_latent_sample = self.generate_latent_sample(
+                model_patcher, *args, **kwargs
+            )["samples"]
+        layer_mse = calibrator.calibrate(org_latent_sample)
+
+        for sub_name in quantizable_modules:
+            calibrate_info[sub_name] = {
+                "mse": layer_mse[sub_name],
+                "compute_density": quantize_costs.get_compute_density(sub_name),
+            }
 
         return calibrate_info
 
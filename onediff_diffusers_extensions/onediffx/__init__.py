@@ -7,6 +7,12 @@ from .compilers.diffusion_pipeline_compiler import (
     quantize_pipe,
     save_pipe,
 )
+from .compilers.warmup_planner import (
+    load_request_log,
+    plan_warmup,
+    run_warmup_plan,
+    WarmupPlan,
+)
 
 __all__ = [
     "compile_pipe",
@@ -14,4 +20,8 @@ __all__ = [
     "load_pipe",
     "OneflowCompileOptions",
     "quantize_pipe",
+    "load_request_log",
+    "plan_warmup",
+    "run_warmup_plan",
+    "WarmupPlan",
 ]
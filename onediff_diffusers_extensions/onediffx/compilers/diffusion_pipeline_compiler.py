@@ -23,6 +23,22 @@ def _recursive_setattr(obj, attr, value):
     setattr(obj, attrs[-1], value)
 
 
+def _get_part(pipe, part, default=None):
+    obj = _recursive_getattr(pipe, part, default)
+    # Wrappers such as DeepCacheUNet are kept, the parts they wrap are compiled
+    if getattr(obj, "wraps_pipeline_part", False):
+        return obj.wrapped_part
+    return obj
+
+
+def _set_part(pipe, part, value):
+    obj = _recursive_getattr(pipe, part, None)
+    if getattr(obj, "wraps_pipeline_part", False):
+        obj.wrapped_part = value
+    else:
+        _recursive_setattr(pipe, part, value)
+
+
 _PARTS = [
     "text_encoder",
     "text_encoder_2",
@@ -61,7 +77,21 @@ def compile_pipe(
     options=None,
     ignores=(),
     fuse_qkv_projections=False,
+    warmup=None,
+    warmup_workers=None,
+    deep_cache=None,
 ):
+    """Compiles the parts of a diffusion pipeline.
+
+    If `warmup` is given, a dict or a list of dicts of representative pipeline call kwargs,
+    the pipeline is run once eagerly to trace the inputs of each compiled part, then the
+    graphs of the parts are built and warmed up concurrently on at most `warmup_workers`
+    threads, and the time of each part is logged. The torch2oflow conversions of the parts
+    run one at a time, see `warmup_pipe`.
+
+    If `deep_cache` is True or a dict of `enable_deep_cache` kwargs, the UNet of the pipeline,
+    whatever its type, runs with DeepCache, and its full and shallow UNets are compiled.
+    """
     if fuse_qkv_projections:
         pipe = fuse_qkv_projections_in_pipe(pipe)
 
@@ -85,14 +115,19 @@ def compile_pipe(
     ):
         pipe.upcast_vae()
 
+    if deep_cache:
+        from onediffx.deep_cache.deep_cache_unet import enable_deep_cache
+
+        enable_deep_cache(pipe, **(deep_cache if isinstance(deep_cache, dict) else {}))
+
     filtered_parts = _filter_parts(ignores=ignores)
+    compiled_parts = {}
     for part in filtered_parts:
-        obj = _recursive_getattr(pipe, part, None)
+        obj = _get_part(pipe, part, None)
         if obj is not None:
             logger.info(f"Compiling {part}")
-            _recursive_setattr(
-                pipe, part, compile(obj, backend=backend, options=options)
-            )
+            compiled_parts[part] = compile(obj, backend=backend, options=options)
+            _set_part(pipe, part, compiled_parts[part])
 
     if hasattr(pipe, "image_processor") and "image_processor" not in ignores:
         logger.info("Patching image_processor")
@@ -103,6 +138,17 @@ def compile_pipe(
 
         patch_image_prcessor_(pipe.image_processor)
 
+    if warmup is not None:
+        from .pipe_warmup import warmup_pipe
+
+        warmup_pipe(
+            pipe,
+            compiled_parts,
+            warmup,
+            _set_part,
+            max_workers=warmup_workers,
+        )
+
     return pipe
 
 
@@ -144,24 +190,16 @@ def convert_pipe_to_memory_format(
 
 
 def save_pipe(pipe, dir="cached_pipe", *, ignores=(), overwrite=True):
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-    filtered_parts = _filter_parts(ignores=ignores)
-    for part in filtered_parts:
-        obj = _recursive_getattr(pipe, part, None)
-        if (
-            obj is not None
-            and isinstance(obj, DeployableModule)
-            and obj._deployable_module_dpl_graph is not None
-            and obj.get_graph().is_compiled
-        ):
-            if not overwrite and os.path.isfile(os.path.join(dir, part)):
-                logger.info(
-                    f"Compiled graph already exists for {part}, not overwriting it."
-                )
-                continue
-            logger.info(f"Saving {part}")
-            obj.save_graph(os.path.join(dir, part))
+    """Saves the compiled graphs of the pipeline as a bundle with a manifest, see pipe_bundle."""
+    from .pipe_bundle import save_bundle
+
+    save_bundle(
+        pipe,
+        dir,
+        _filter_parts(ignores=ignores),
+        _get_part,
+        overwrite=overwrite,
+    )
 
 
 def load_pipe(
@@ -169,15 +207,37 @@ def load_pipe(
     dir="cached_pipe",
     *,
     ignores=(),
+    lazy=False,
+    verify_checksums=False,
 ):
+    """Loads the compiled graphs of a bundle saved by save_pipe.
+
+    Parts whose files, versions, dtype or weights don't match are skipped and rebuilt on
+    first call. The files are hashed only if their mtime changed since they were saved, or
+    if `verify_checksums` is True. If `lazy` is True, the graph of a part is loaded, and its
+    file hashed, on its first call, so unused parts are never loaded. Directories saved
+    without a manifest are loaded as before.
+    """
+    from .pipe_bundle import load_bundle, MANIFEST_FILE_NAME
+
     if not os.path.exists(dir):
         return
     filtered_parts = _filter_parts(ignores=ignores)
-    for part in filtered_parts:
-        obj = _recursive_getattr(pipe, part, None)
-        if obj is not None and os.path.exists(os.path.join(dir, part)):
-            logger.info(f"Loading {part}")
-            obj.load_graph(os.path.join(dir, part))
+    if os.path.exists(os.path.join(dir, MANIFEST_FILE_NAME)):
+        load_bundle(
+            pipe,
+            dir,
+            filtered_parts,
+            _get_part,
+            lazy=lazy,
+            verify_checksums=verify_checksums,
+        )
+    else:
+        for part in filtered_parts:
+            obj = _get_part(pipe, part, None)
+            if obj is not None and os.path.exists(os.path.join(dir, part)):
+                logger.info(f"Loading {part}")
+                obj.load_graph(os.path.join(dir, part))
 
     if "image_processor" not in ignores:
         logger.info("Patching image_processor")
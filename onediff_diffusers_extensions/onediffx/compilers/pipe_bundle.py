@@ -0,0 +1,307 @@
+"""Versioned, checksummed bundles of the compiled graphs of a pipeline.
+
+A bundle is a directory with one graph file per part and a manifest.json recording, for each part,
+the file, its sha256, size and mtime, the model fingerprint, dtype, input signatures and compile
+options, together with the versions of the libraries that produced it. Parts that don't match the
+running pipeline are skipped, so their graphs are rebuilt on first call.
+
+Loading checks the size and mtime of the files. A file is hashed only if its mtime changed, e.g.
+after the bundle is copied, or if `verify_checksums` is True.
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import shutil
+from importlib.metadata import version
+from itertools import chain
+from typing import Dict, List, Optional
+
+import torch
+from onediff.infer_compiler import DeployableModule
+from onediff.utils import logger
+
+__all__ = ["generate_model_fingerprint", "save_bundle", "load_bundle"]
+
+BUNDLE_FORMAT_VERSION = 1
+MANIFEST_FILE_NAME = "manifest.json"
+# A graph built with any other version of these packages is not reused
+_VERSIONED_PACKAGES = ("onediff", "oneflow", "torch", "diffusers")
+
+
+def _get_package_version(package: str) -> Optional[str]:
+    try:
+        return version(package)
+    except Exception:
+        return None
+
+
+def _get_versions() -> Dict[str, Optional[str]]:
+    return {package: _get_package_version(package) for package in _VERSIONED_PACKAGES}
+
+
+def _iter_files(path: str) -> List[str]:
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, _, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names)
+    return sorted(files)
+
+
+def _path_stat(path: str) -> Dict:
+    """Returns the size and the latest mtime of a file, or of all files of a directory."""
+    size, mtime = 0, 0.0
+    for file_path in _iter_files(path):
+        stat = os.stat(file_path)
+        size += stat.st_size
+        mtime = max(mtime, stat.st_mtime)
+    return {"size": size, "mtime": mtime}
+
+
+def _path_checksum(path: str) -> Dict:
+    """Returns the sha256 and size of a file, or of all files of a directory."""
+    hasher = hashlib.sha256()
+    size = 0
+    for file_path in _iter_files(path):
+        hasher.update(os.path.relpath(file_path, path).encode("utf-8"))
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                hasher.update(chunk)
+                size += len(chunk)
+    return {"sha256": hasher.hexdigest(), "size": size}
+
+
+def generate_model_fingerprint(module: torch.nn.Module) -> str:
+    """Hashes the class, the tensor names, shapes and dtypes, and a strided sample of the weights."""
+    module_cls = type(module)
+    hasher = hashlib.sha256(
+        f"{module_cls.__module__}.{module_cls.__qualname__}".encode("utf-8")
+    )
+    samples = []
+    for name, tensor in chain(module.named_parameters(), module.named_buffers()):
+        hasher.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode("utf-8"))
+        if tensor.numel() > 0:
+            flat = tensor.detach().reshape(-1)
+            samples.append(flat[:: max(1, flat.numel() // 16)][:16].float())
+    if samples:
+        # One device to host copy for all samples
+        hasher.update(torch.cat(samples).cpu().numpy().tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def _get_torch_module(obj):
+    return getattr(obj, "_torch_module", obj)
+
+
+def _get_dtype(module) -> Optional[str]:
+    for tensor in module.parameters():
+        return str(tensor.dtype)
+    return None
+
+
+def _get_compile_options(obj) -> Dict:
+    options = getattr(obj, "_deployable_module_options", None)
+    if options is None or not dataclasses.is_dataclass(options):
+        return {}
+    return json.loads(json.dumps(dataclasses.asdict(options), default=str))
+
+
+def _read_manifest(dir: str) -> Optional[Dict]:
+    manifest_path = os.path.join(dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to read the manifest {manifest_path}. {e=}")
+        return None
+
+
+def _write_manifest(dir: str, manifest: Dict) -> None:
+    manifest_path = os.path.join(dir, MANIFEST_FILE_NAME)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _is_saveable(obj) -> bool:
+    return (
+        obj is not None
+        and isinstance(obj, DeployableModule)
+        and obj._deployable_module_dpl_graph is not None
+        and obj.get_graph().is_compiled
+    )
+
+
+def save_bundle(pipe, dir: str, parts: List[str], getattr_fn, *, overwrite=True):
+    os.makedirs(dir, exist_ok=True)
+    manifest = _read_manifest(dir)
+    if manifest is None or manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        manifest = {"format_version": BUNDLE_FORMAT_VERSION, "parts": {}}
+    versions = _get_versions()
+    if manifest.get("versions") != versions:
+        # Entries saved by other versions can't be kept in this manifest
+        manifest["parts"] = {}
+    manifest["versions"] = versions
+
+    for part in parts:
+        obj = getattr_fn(pipe, part, None)
+        if not _is_saveable(obj):
+            continue
+        file_path = os.path.join(dir, part)
+        if not overwrite and part in manifest["parts"] and os.path.exists(file_path):
+            logger.info(
+                f"Compiled graph already exists for {part}, not overwriting it."
+            )
+            continue
+
+        logger.info(f"Saving {part}")
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        obj.save_graph(tmp_path)
+        if os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+        os.replace(tmp_path, file_path)
+
+        torch_module = _get_torch_module(obj)
+        input_structure_key = getattr(
+            obj, "_deployable_module_input_structure_key", None
+        )
+        manifest["parts"][part] = {
+            "file": part,
+            **_path_checksum(file_path),
+            "mtime": _path_stat(file_path)["mtime"],
+            "model_fingerprint": generate_model_fingerprint(torch_module),
+            "model_class": type(torch_module).__name__,
+            "dtype": _get_dtype(torch_module),
+            "input_signatures": [input_structure_key] if input_structure_key else [],
+            "compile_options": _get_compile_options(obj),
+        }
+    _write_manifest(dir, manifest)
+
+
+def _verify_checksum(file_path, entry) -> Optional[str]:
+    checksum = _path_checksum(file_path)
+    if checksum["size"] != entry["size"] or checksum["sha256"] != entry["sha256"]:
+        return f"checksum of {file_path} mismatches"
+    return None
+
+
+def _validate_part(dir, entry, obj, versions) -> Optional[str]:
+    """Returns the reason why the part is incompatible, or None if it is valid.
+
+    The checksum of the file is not verified, see `_verify_checksum`.
+    """
+    mismatched = {
+        package: (saved, versions.get(package, None))
+        for package, saved in entry["versions"].items()
+        if saved != versions.get(package, None)
+    }
+    if mismatched:
+        return f"versions {mismatched} mismatch"
+    file_path = os.path.join(dir, entry["file"])
+    if not os.path.exists(file_path):
+        return f"{file_path} doesn't exist"
+    torch_module = _get_torch_module(obj)
+    if entry["dtype"] != _get_dtype(torch_module):
+        return f"dtype {entry['dtype']} mismatches"
+    if entry["model_fingerprint"] != generate_model_fingerprint(torch_module):
+        return "model weights mismatch"
+    return None
+
+
+def _needs_checksum(file_path, entry, verify_checksums) -> bool:
+    """Returns whether the file must be hashed, raises ValueError if its size mismatches."""
+    stat = _path_stat(file_path)
+    if stat["size"] != entry["size"]:
+        raise ValueError(f"size of {file_path} mismatches")
+    return verify_checksums or stat["mtime"] != entry.get("mtime", None)
+
+
+def _load_part(part, obj, file_path, entry, device, run_warmup, verify_checksum):
+    """Loads the graph of a part, returns the reason why it is skipped, or None if it is loaded."""
+    if verify_checksum:
+        reason = _verify_checksum(file_path, entry)
+        if reason is not None:
+            logger.warning(f"Skip loading {part}, it will be rebuilt: {reason}")
+            return reason
+    logger.info(f"Loading {part}")
+    try:
+        obj.load_graph(file_path, device, run_warmup)
+    except Exception as e:
+        logger.warning(f"Failed to load {part}, it will be rebuilt. {e=}")
+        obj._deployable_module_dpl_graph = None
+        return str(e)
+    return None
+
+
+def _register_lazy_load(
+    part, obj, file_path, entry, device, run_warmup, verify_checksum
+):
+    def load_graph_hook(module, args):
+        handle.remove()
+        _load_part(part, module, file_path, entry, device, run_warmup, verify_checksum)
+
+    handle = obj.register_forward_pre_hook(load_graph_hook, prepend=True)
+
+
+def load_bundle(
+    pipe,
+    dir: str,
+    parts: List[str],
+    getattr_fn,
+    *,
+    lazy=False,
+    verify_checksums=False,
+    device=None,
+    run_warmup=True,
+) -> Dict[str, str]:
+    """Loads the valid parts of a bundle, returns the reason of each skipped part.
+
+    If `lazy` is True, the graph of a part is loaded, and its file hashed if needed, on its
+    first call, and the parts skipped then are not in the returned reasons.
+    """
+    manifest = _read_manifest(dir)
+    if manifest is None:
+        raise RuntimeError(f"No manifest in {dir}")
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        logger.warning(f"Unsupported bundle format in {dir}, skip loading.")
+        return {part: "unsupported bundle format" for part in manifest.get("parts", {})}
+
+    versions = _get_versions()
+    skipped = {}
+    for part in parts:
+        entry = manifest["parts"].get(part, None)
+        obj = getattr_fn(pipe, part, None)
+        if entry is None or obj is None:
+            continue
+        if not isinstance(obj, DeployableModule):
+            skipped[part] = "not compiled"
+            continue
+        entry = dict(entry, versions=manifest["versions"])
+        file_path = os.path.join(dir, entry["file"])
+        reason = _validate_part(dir, entry, obj, versions)
+        if reason is None:
+            try:
+                verify_checksum = _needs_checksum(file_path, entry, verify_checksums)
+            except ValueError as e:
+                reason = str(e)
+        if reason is not None:
+            logger.warning(f"Skip loading {part}, it will be rebuilt: {reason}")
+            skipped[part] = reason
+            continue
+
+        if lazy:
+            _register_lazy_load(
+                part, obj, file_path, entry, device, run_warmup, verify_checksum
+            )
+        else:
+            reason = _load_part(
+                part, obj, file_path, entry, device, run_warmup, verify_checksum
+            )
+            if reason is not None:
+                skipped[part] = reason
+    return skipped
@@ -0,0 +1,137 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Union
+
+import torch
+from onediff.utils import logger, metrics
+
+
+def _input_signature(value) -> str:
+    if isinstance(value, torch.Tensor):
+        return f"T{tuple(value.shape)}{value.dtype}{value.device}"
+    if isinstance(value, (tuple, list)):
+        return "(" + ",".join(_input_signature(v) for v in value) + ")"
+    if isinstance(value, dict):
+        return (
+            "{" + ",".join(f"{k}:{_input_signature(v)}" for k, v in value.items()) + "}"
+        )
+    # Non-tensor values, such as timesteps, don't change the graph to build
+    return type(value).__name__
+
+
+def _clone_inputs(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().clone()
+    if isinstance(value, (tuple, list)):
+        return type(value)(_clone_inputs(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _clone_inputs(v) for k, v in value.items()}
+    return value
+
+
+def trace_input_signatures(
+    pipe, compiled_parts: Dict, call_kwargs_list: Sequence[Dict], setattr_fn
+) -> Dict[str, List]:
+    """Runs the pipeline eagerly and records the inputs of each unique signature of each part."""
+    traced_inputs = {part: {} for part in compiled_parts}
+    handles = []
+
+    def make_hook(part):
+        def hook(module, args, kwargs):
+            signature = _input_signature((args, kwargs))
+            if signature not in traced_inputs[part]:
+                traced_inputs[part][signature] = _clone_inputs((args, kwargs))
+
+        return hook
+
+    try:
+        for part, compiled in compiled_parts.items():
+            torch_module = compiled._torch_module
+            setattr_fn(pipe, part, torch_module)
+            handles.append(
+                torch_module.register_forward_pre_hook(
+                    make_hook(part), with_kwargs=True
+                )
+            )
+        with torch.no_grad():
+            for call_kwargs in call_kwargs_list:
+                pipe(**call_kwargs)
+    finally:
+        for handle in handles:
+            handle.remove()
+        for part, compiled in compiled_parts.items():
+            setattr_fn(pipe, part, compiled)
+
+    return {part: list(inputs.values()) for part, inputs in traced_inputs.items()}
+
+
+def _warmup_part(part, compiled, inputs_list) -> float:
+    start = time.perf_counter()
+    with torch.no_grad():
+        for args, kwargs in inputs_list:
+            compiled(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    cost = time.perf_counter() - start
+    metrics.observe("onediffx_compile_pipe_warmup_seconds", cost, part=part)
+    return cost
+
+
+def warmup_pipe(
+    pipe,
+    compiled_parts: Dict,
+    warmup: Union[Dict, Sequence[Dict]],
+    setattr_fn,
+    max_workers: int = None,
+) -> Dict[str, float]:
+    """Builds and warms up the graphs of the compiled parts for the inputs seen in a dry run.
+
+    The parts are warmed up concurrently, the graphs of one part are built one after another.
+    The torch2oflow conversions of the oneflow parts are serialized by the oneflow backend,
+    since they update process-wide maps, while their graphs are built and run concurrently,
+    so the warm-up takes roughly as long as the slowest part. Returns the warm-up seconds of
+    each part.
+    """
+    call_kwargs_list = [warmup] if isinstance(warmup, dict) else list(warmup)
+    # Functions can't be traced by hooks
+    compiled_parts = {
+        part: compiled
+        for part, compiled in compiled_parts.items()
+        if isinstance(getattr(compiled, "_torch_module", None), torch.nn.Module)
+    }
+
+    start = time.perf_counter()
+    traced_inputs = trace_input_signatures(
+        pipe, compiled_parts, call_kwargs_list, setattr_fn
+    )
+    trace_cost = time.perf_counter() - start
+    logger.info(f"Traced the inputs of {len(traced_inputs)} parts in {trace_cost:.2f}s")
+
+    traced_inputs = {part: inputs for part, inputs in traced_inputs.items() if inputs}
+    if not traced_inputs:
+        return {}
+    max_workers = max_workers if max_workers is not None else len(traced_inputs)
+    timings = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="onediffx_warmup"
+    ) as executor:
+        futures = {
+            part: executor.submit(_warmup_part, part, compiled_parts[part], inputs)
+            for part, inputs in traced_inputs.items()
+        }
+        for part, future in futures.items():
+            try:
+                timings[part] = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to warm up {part}: {e=}")
+    total_cost = time.perf_counter() - start
+
+    for part, cost in timings.items():
+        logger.info(
+            f"Warmed up {part} with {len(traced_inputs[part])} input signatures in {cost:.2f}s"
+        )
+    logger.info(
+        f"Warmed up {len(timings)} parts in {total_cost:.2f}s, {sum(timings.values()):.2f}s in serial"
+    )
+    return timings
@@ -0,0 +1,166 @@
+"""Plan which input shapes to precompile from the shapes served in production.
+
+Example:
+    >>> histogram = load_request_log("requests.jsonl")
+    >>> # The latent buckets of the ShapeBucketPolicy of the UNet, for 512, 768 and 1024 pixels
+    >>> plan = plan_warmup(histogram, coverage=0.95, max_graphs=6, heights=[64, 96, 128])
+    >>> plan.save("cached_pipe")  # next to the graphs saved by save_pipe
+    >>> run_warmup_plan(pipe, WarmupPlan.load("cached_pipe"), prompt="a photo", num_inference_steps=1)
+"""
+
+import collections
+import dataclasses
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from onediff.infer_compiler import ShapeBucketPolicy
+from onediff.utils import logger
+
+__all__ = [
+    "WarmupPlan",
+    "load_request_log",
+    "plan_warmup",
+    "run_warmup_plan",
+]
+
+WARMUP_PLAN_FILE_NAME = "warmup_plan.json"
+
+# (height, width, batch_size)
+Shape = Tuple[int, int, int]
+
+
+def load_request_log(requests: Iterable) -> Dict[Shape, int]:
+    """Counts the shapes of a request log.
+
+    `requests` is a path of a JSON lines file, or an iterable of dicts, with `height`, `width`
+    and optionally `batch_size` (default 1).
+    """
+    if isinstance(requests, (str, os.PathLike)):
+        with open(requests, "r") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+    histogram = collections.Counter()
+    for request in requests:
+        shape = (
+            int(request["height"]),
+            int(request["width"]),
+            int(request.get("batch_size", 1)),
+        )
+        histogram[shape] += 1
+    return dict(histogram)
+
+
+@dataclasses.dataclass
+class WarmupPlan:
+    """The shapes to precompile in priority order, and the share of traffic they cover."""
+
+    shapes: List[Shape]
+    counts: List[int]
+    coverage: float
+    total_requests: int
+
+    def save(self, dir: str) -> str:
+        os.makedirs(dir, exist_ok=True)
+        file_path = os.path.join(dir, WARMUP_PLAN_FILE_NAME)
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dataclasses.asdict(self), f, indent=2)
+        os.replace(tmp_path, file_path)
+        return file_path
+
+    @classmethod
+    def load(cls, dir: str) -> Optional["WarmupPlan"]:
+        file_path = os.path.join(dir, WARMUP_PLAN_FILE_NAME)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r") as f:
+            data = json.load(f)
+        data["shapes"] = [tuple(shape) for shape in data["shapes"]]
+        return cls(**data)
+
+
+def _to_pixels(pixels: int, latent: int, bucket: int, vae_scale_factor: int) -> int:
+    # A dimension beyond the largest bucket is kept as is
+    return pixels if bucket == latent else bucket * vae_scale_factor
+
+
+def plan_warmup(
+    histogram: Dict[Shape, int],
+    *,
+    coverage: float = 0.95,
+    max_graphs: Optional[int] = None,
+    heights: Optional[Sequence[int]] = None,
+    widths: Optional[Sequence[int]] = None,
+    batch_sizes: Optional[Sequence[int]] = None,
+    vae_scale_factor: int = 8,
+    batch_multiplier: int = 2,
+) -> WarmupPlan:
+    """Picks the fewest shapes covering `coverage` of the traffic, at most `max_graphs` of them.
+
+    If buckets are given, they are those of the ShapeBucketPolicy of the UNet, which sees the
+    latents: heights and widths in pixels divided by `vae_scale_factor`, and batch sizes of
+    `num_images_per_prompt` times `batch_multiplier`, 2 with classifier-free guidance. Each shape
+    is rounded up to its bucket first, and the planned shape is a request shape the UNet pads to
+    that bucket, so it compiles the graph serving every shape rounded to it.
+    """
+    policy = ShapeBucketPolicy(batch_sizes=batch_sizes, heights=heights, widths=widths)
+    bucket_histogram = collections.Counter()
+    for (height, width, batch_size), count in histogram.items():
+        latent_height = height // vae_scale_factor
+        latent_width = width // vae_scale_factor
+        bucket_batch_size, bucket_height, bucket_width = policy.get_bucket_shape(
+            batch_size * batch_multiplier, latent_height, latent_width
+        )
+        shape = (
+            _to_pixels(height, latent_height, bucket_height, vae_scale_factor),
+            _to_pixels(width, latent_width, bucket_width, vae_scale_factor),
+            # The largest batch size within the bucket
+            bucket_batch_size // batch_multiplier,
+        )
+        bucket_histogram[shape] += count
+
+    total_requests = sum(bucket_histogram.values())
+    shapes, counts = [], []
+    covered = 0
+    # Each request is served by exactly one shape, so taking the most frequent shapes
+    # first gives the fewest shapes for the target coverage.
+    for shape, count in sorted(
+        bucket_histogram.items(), key=lambda item: (-item[1], item[0])
+    ):
+        if total_requests > 0 and covered / total_requests >= coverage:
+            break
+        if max_graphs is not None and len(shapes) >= max_graphs:
+            break
+        shapes.append(shape)
+        counts.append(count)
+        covered += count
+
+    plan = WarmupPlan(
+        shapes=shapes,
+        counts=counts,
+        coverage=covered / total_requests if total_requests > 0 else 0.0,
+        total_requests=total_requests,
+    )
+    logger.info(
+        f"Planned {len(shapes)} shapes covering {plan.coverage:.1%} of {total_requests} requests"
+    )
+    return plan
+
+
+def run_warmup_plan(pipe, plan: WarmupPlan, **call_kwargs) -> Dict[Shape, float]:
+    """Runs the pipeline once per planned shape in priority order, returns the seconds of each."""
+    timings = {}
+    for height, width, batch_size in plan.shapes:
+        start = time.perf_counter()
+        pipe(
+            height=height,
+            width=width,
+            num_images_per_prompt=batch_size,
+            **call_kwargs,
+        )
+        timings[(height, width, batch_size)] = time.perf_counter() - start
+        logger.info(
+            f"Warmed up {height}x{width} batch {batch_size} in {timings[(height, width, batch_size)]:.2f}s"
+        )
+    return timings
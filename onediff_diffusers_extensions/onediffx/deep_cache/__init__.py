@@ -12,6 +12,8 @@ if diffusers_version < diffusers_0193_v:
         f"onediffx supports at least version of diffusers-0.19.3, Currently version {str(diffusers_version)}! Please upgrade diffusers!"
     )
 
+from .adaptive_schedule import AdaptiveCacheSchedule
+from .deep_cache_unet import DeepCacheUNet, disable_deep_cache, enable_deep_cache
 from .models.pipeline_utils import disable_deep_cache_pipeline
 from .pipeline_stable_diffusion import StableDiffusionPipeline
 
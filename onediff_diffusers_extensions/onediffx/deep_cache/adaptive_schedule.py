@@ -0,0 +1,144 @@
+"""Chooses the full UNet steps of DeepCache from how fast the outputs drift.
+
+With a fixed `cache_interval`, the cached high-level features are refreshed at the same steps
+for every prompt. AdaptiveCacheSchedule instead refreshes them when the drift since the last
+full step exceeds a threshold:
+
+- "noise_pred": the relative change of the noise prediction of the previous step against the
+  one of the last full step.
+- "features": the relative change of the cached features between the last two full steps,
+  per step, extrapolated to the steps since the last full step.
+
+Example:
+    >>> schedule = AdaptiveCacheSchedule(threshold=0.15, max_interval=5, max_full_steps=12)
+    >>> image = pipe(prompt, num_inference_steps=50, cache_schedule=schedule).images[0]
+    >>> schedule.num_full_steps
+    11
+"""
+
+from typing import Dict, List, Optional
+
+import torch
+
+__all__ = ["AdaptiveCacheSchedule"]
+
+
+def _flatten_tensors(value) -> List[torch.Tensor]:
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [t for v in value for t in _flatten_tensors(v)]
+    return []
+
+
+def relative_change(value, reference) -> float:
+    """Returns ||value - reference|| / ||reference|| over all tensors of the values."""
+    values, references = _flatten_tensors(value), _flatten_tensors(reference)
+    if len(values) != len(references) or len(values) == 0:
+        return float("inf")
+    diff_norm = sum(
+        (v.float() - r.float()).pow(2).sum() for v, r in zip(values, references)
+    )
+    reference_norm = sum(r.float().pow(2).sum() for r in references)
+    return (diff_norm.sqrt() / (reference_norm.sqrt() + 1e-8)).item()
+
+
+class AdaptiveCacheSchedule:
+    """AdaptiveCacheSchedule
+
+    Pass it as `cache_schedule` to the DeepCache pipelines, it overrides `cache_interval`.
+    One schedule runs one request at a time, it is reset at the first step.
+
+    __init__ args:
+        `threshold`: Run a full step when the drift exceeds it.
+        `min_interval`: The minimum number of steps between full steps.
+        `max_interval`: The maximum number of steps between full steps.
+        `max_full_steps`: The budget of full steps per request, the first step included.
+        `metric`: "noise_pred" or "features".
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        min_interval: int = 1,
+        max_interval: int = 5,
+        max_full_steps: Optional[int] = None,
+        metric: str = "noise_pred",
+    ):
+        if metric not in ("noise_pred", "features"):
+            raise ValueError(f"Unsupported drift metric {metric}")
+        if not 1 <= min_interval <= max_interval:
+            raise ValueError(
+                f"Expect 1 <= min_interval <= max_interval, got {min_interval} and {max_interval}"
+            )
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_full_steps = max_full_steps
+        self.metric = metric
+        self.reset()
+
+    def reset(self) -> None:
+        self.full_step_ids = []
+        self.drifts = []
+        self.num_steps = 0
+        self._reference = None
+        self._drift = 0.0
+        # Drift per step of the features, measured between full steps
+        self._drift_rate = 0.0
+
+    @property
+    def num_full_steps(self) -> int:
+        return len(self.full_step_ids)
+
+    def _estimated_drift(self, i: int) -> float:
+        if self.metric == "features":
+            return self._drift_rate * (i - self.full_step_ids[-1])
+        return self._drift
+
+    def is_full_step(self, i: int) -> bool:
+        """Whether step `i` has to run the full UNet and refresh the cached features."""
+        if i == 0 or self.num_full_steps == 0:
+            self.reset()
+            return True
+        if (
+            self.max_full_steps is not None
+            and self.num_full_steps >= self.max_full_steps
+        ):
+            return False
+        steps_since_full = i - self.full_step_ids[-1]
+        if steps_since_full < self.min_interval:
+            return False
+        if steps_since_full >= self.max_interval:
+            return True
+        return self._estimated_drift(i) > self.threshold
+
+    def update(self, i: int, is_full_step: bool, noise_pred, features=None) -> None:
+        """Records the outputs of step `i`."""
+        self.num_steps += 1
+        if not is_full_step:
+            if self.metric == "noise_pred":
+                self._drift = relative_change(noise_pred, self._reference)
+                self.drifts.append(self._drift)
+            return
+
+        if self.metric == "features":
+            if self._reference is not None:
+                drift = relative_change(features, self._reference)
+                self._drift_rate = drift / (i - self.full_step_ids[-1])
+                self.drifts.append(drift)
+            reference = features
+        else:
+            reference = noise_pred
+            self._drift = 0.0
+        # Compiled UNets may reuse their output buffers
+        self._reference = [t.detach().clone() for t in _flatten_tensors(reference)]
+        self.full_step_ids.append(i)
+
+    def stats(self) -> Dict:
+        return {
+            "steps": self.num_steps,
+            "full_steps": self.num_full_steps,
+            "full_step_ids": list(self.full_step_ids),
+            "max_drift": max(self.drifts, default=0.0),
+        }
@@ -0,0 +1,300 @@
+"""DeepCache for any diffusers pipeline, without a forked pipeline.
+
+`enable_deep_cache` converts the UNet of a pipeline in place into the DeepCache UNet of
+`onediffx.deep_cache.models`, adds its `fast_unet`, and replaces `pipe.unet` by a DeepCacheUNet.
+The wrapper has the signature of the diffusers UNet, so img2img, inpaint, ControlNet and other
+pipelines calling `self.unet(...)` get the cached steps. It decides between the full and the
+shallow UNet from the step index of the pipeline's scheduler, and keeps the cached features
+between the steps, outside the compiled modules.
+
+Example:
+    >>> pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(...)
+    >>> pipe = compile_pipe(pipe, deep_cache={"cache_interval": 3})
+    >>> image = pipe(prompt, image=init_image).images[0]
+"""
+
+import weakref
+from itertools import chain
+from typing import Dict, Optional
+
+import torch
+from onediff.infer_compiler import DeployableModule
+from onediff.utils import logger
+
+from .adaptive_schedule import AdaptiveCacheSchedule
+
+__all__ = ["DeepCacheUNet", "enable_deep_cache", "disable_deep_cache"]
+
+
+def _get_torch_module(module):
+    return getattr(module, "_torch_module", module)
+
+
+def _convert_blocks(unet, update_cls) -> None:
+    blocks = list(chain(unet.down_blocks, unet.up_blocks))
+    for block in blocks:
+        if type(block).__name__ not in update_cls:
+            raise ValueError(
+                f"DeepCache doesn't support the block {type(block).__name__} of {type(unet).__name__}"
+            )
+    for block in blocks:
+        new_cls = update_cls[type(block).__name__]
+        if type(block) is not new_cls:
+            # The DeepCache blocks only override forward, so the parameters are kept as is
+            block.__class__ = new_cls
+
+
+def _convert_unet(unet):
+    """Converts a diffusers UNet in place, returns it and its shallow UNet for cached steps."""
+    from .models.fast_unet_2d_condition import FastUNet2DConditionModel
+    from .models.unet_2d_blocks import update_cls as update_2d_cls
+    from .models.unet_2d_condition import (
+        DiffusersUNet2DConditionModel,
+        UNet2DConditionModel,
+    )
+
+    if isinstance(unet, DiffusersUNet2DConditionModel):
+        _convert_blocks(unet, update_2d_cls)
+        unet.__class__ = UNet2DConditionModel
+        return unet, FastUNet2DConditionModel(unet)
+
+    from .models.fast_unet_spatio_temporal_condition import (
+        FastUNetSpatioTemporalConditionModel,
+    )
+    from .models.unet_3d_blocks import update_cls as update_3d_cls
+    from .models.unet_spatio_temporal_condition import (
+        DiffusersUNetSpatioTemporalConditionModel,
+        UNetSpatioTemporalConditionModel,
+    )
+
+    if isinstance(unet, DiffusersUNetSpatioTemporalConditionModel):
+        _convert_blocks(unet, update_3d_cls)
+        unet.__class__ = UNetSpatioTemporalConditionModel
+        return unet, FastUNetSpatioTemporalConditionModel(unet)
+
+    raise ValueError(f"DeepCache doesn't support the UNet {type(unet).__name__}")
+
+
+def _is_spatio_temporal(unet) -> bool:
+    return hasattr(_get_torch_module(unet).config, "num_frames")
+
+
+class DeepCacheUNet(torch.nn.Module):
+    """DeepCacheUNet
+
+    Runs the full UNet every `cache_interval` steps, or at the steps chosen by `cache_schedule`,
+    and the shallow `pipe.fast_unet` on the cached features at the other steps. Attributes
+    other than its own are those of the wrapped UNet, e.g. `config` and `dtype`.
+
+    __init__ args:
+        `pipe`: The pipeline, whose `scheduler` gives the step index and `fast_unet` the
+            shallow UNet. It is weakly referenced.
+        `unet`: The converted UNet, compiled or not.
+        `cache_interval`: The number of steps between full steps.
+        `cache_layer_id`, `cache_block_id`: The cached up block of the 2D UNets.
+        `cache_branch`: The cached up block of the spatio-temporal UNets.
+        `cache_schedule`: An AdaptiveCacheSchedule overriding `cache_interval`.
+    """
+
+    # The compilers of onediffx compile and save the wrapped part instead of the wrapper
+    wraps_pipeline_part = True
+
+    def __init__(
+        self,
+        pipe,
+        unet: torch.nn.Module,
+        cache_interval: int = 3,
+        cache_layer_id: int = 0,
+        cache_block_id: int = 0,
+        cache_branch: int = 0,
+        cache_schedule: Optional[AdaptiveCacheSchedule] = None,
+    ):
+        super().__init__()
+        if cache_interval < 1:
+            raise ValueError(f"Expect cache_interval >= 1, got {cache_interval}")
+        self.wrapped_part = unet
+        self._pipe = weakref.ref(pipe)
+        self.cache_interval = cache_interval
+        self.cache_layer_id = cache_layer_id
+        self.cache_block_id = cache_block_id
+        self.cache_branch = cache_branch
+        self.cache_schedule = cache_schedule
+        self.spatio_temporal = _is_spatio_temporal(unet)
+        # The timesteps of the scheduler in the current request, and the last timestep
+        self._timesteps = None
+        self._last_timestep = None
+        self.reset()
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if name == "wrapped_part":
+                raise
+            return getattr(self.wrapped_part, name)
+
+    def reset(self) -> None:
+        """Drops the cached features, e.g. after an interrupted request."""
+        self._step = -1
+        self._is_full_step = True
+        # Features of each UNet call of the last full step, e.g. the conditional and
+        # unconditional calls of pipelines without batched classifier free guidance
+        self._features = []
+        self._num_calls = 0
+        self.num_full_calls = 0
+        self.num_cached_calls = 0
+
+    def _step_index(self, timestep) -> int:
+        """Returns the step of the call, and drops the cached features at a new request."""
+        scheduler = getattr(self._pipe(), "scheduler", None)
+        # `set_timesteps` replaces the timesteps of the scheduler at the start of a request
+        timesteps = getattr(scheduler, "timesteps", None)
+        if timesteps is not None and timesteps is not self._timesteps:
+            self._timesteps = timesteps
+            self.reset()
+        step_index = getattr(scheduler, "step_index", None)
+        if step_index is not None:
+            return step_index
+        if isinstance(timestep, torch.Tensor):
+            timestep = timestep.flatten()[0].item()
+        last_timestep, self._last_timestep = self._last_timestep, timestep
+        is_first_step = last_timestep is None or timestep > last_timestep
+        if is_first_step:
+            # The timestep only decreases within a request
+            self.reset()
+        if is_first_step or hasattr(scheduler, "step_index"):
+            # The step index is set by the first `scheduler.step` of a request
+            return 0
+        # Schedulers without a step index, count the changes of the decreasing timestep
+        return self._step + (timestep != last_timestep)
+
+    def _start_call(self, step: int) -> int:
+        """Returns the index of the call in the step, and decides whether the step is full."""
+        if step == self._step:
+            self._num_calls += 1
+            return self._num_calls
+        if step < self._step or self._step == -1:
+            self.reset()
+        self._step = step
+        self._num_calls = 0
+        if self.cache_schedule is not None:
+            self._is_full_step = self.cache_schedule.is_full_step(step)
+        else:
+            self._is_full_step = step % self.cache_interval == 0
+        return 0
+
+    def _cache_kwargs(self, features) -> Dict:
+        if self.spatio_temporal:
+            return {"cache_features": features, "cache_branch": self.cache_branch}
+        return {
+            "replicate_prv_feature": features,
+            "cache_layer_id": self.cache_layer_id,
+            "cache_block_id": self.cache_block_id,
+        }
+
+    def _output(self, sample, return_dict):
+        if not return_dict:
+            return (sample,)
+        if self.spatio_temporal:
+            from .models.unet_spatio_temporal_condition import (
+                UNetSpatioTemporalConditionOutput as Output,
+            )
+        else:
+            from .models.unet_2d_condition import UNet2DConditionOutput as Output
+        return Output(sample=sample)
+
+    def forward(self, sample, timestep, *args, return_dict: bool = True, **kwargs):
+        call = self._start_call(self._step_index(timestep))
+        pipe = self._pipe()
+        fast_unet = getattr(pipe, "fast_unet", None) if pipe is not None else None
+        is_full_call = (
+            self._is_full_step or fast_unet is None or call >= len(self._features)
+        )
+        if is_full_call:
+            noise_pred, features = self.wrapped_part(
+                sample,
+                timestep,
+                *args,
+                return_dict=False,
+                **kwargs,
+                **self._cache_kwargs(None),
+            )
+            del self._features[call:]
+            self._features.append(features)
+            self.num_full_calls += 1
+        else:
+            noise_pred, _ = fast_unet(
+                sample,
+                timestep,
+                *args,
+                return_dict=False,
+                **kwargs,
+                **self._cache_kwargs(self._features[call]),
+            )
+            self.num_cached_calls += 1
+        if self.cache_schedule is not None and call == 0:
+            self.cache_schedule.update(
+                self._step, self._is_full_step, noise_pred, self._features[0]
+            )
+        return self._output(noise_pred, return_dict)
+
+
+def _prepare_deep_cache(pipe) -> None:
+    """Converts `pipe.unet` and adds `pipe.fast_unet`, before the pipeline is compiled."""
+    unet = pipe.unet
+    if isinstance(unet, DeepCacheUNet):
+        return
+    if isinstance(unet, DeployableModule):
+        if getattr(pipe, "fast_unet", None) is not None:
+            return
+        raise RuntimeError(
+            "Enable DeepCache before compiling the pipeline, or pass `deep_cache` to compile_pipe"
+        )
+    if getattr(pipe, "fast_unet", None) is not None:
+        # A DeepCache pipeline of onediffx
+        return
+    pipe.unet, pipe.fast_unet = _convert_unet(unet)
+
+
+def enable_deep_cache(
+    pipe,
+    *,
+    cache_interval: int = 3,
+    cache_layer_id: int = 0,
+    cache_block_id: int = 0,
+    cache_branch: int = 0,
+    cache_schedule: Optional[AdaptiveCacheSchedule] = None,
+):
+    """Makes `pipe.unet` a DeepCacheUNet, for any pipeline calling `self.unet`.
+
+    Call it before compiling the pipeline, or use `compile_pipe(pipe, deep_cache={...})`,
+    which compiles the UNet and the shallow UNet separately. Calling it again updates the
+    options. Returns the pipeline.
+    """
+    options = dict(
+        cache_interval=cache_interval,
+        cache_layer_id=cache_layer_id,
+        cache_block_id=cache_block_id,
+        cache_branch=cache_branch,
+        cache_schedule=cache_schedule,
+    )
+    if isinstance(pipe.unet, DeepCacheUNet):
+        for name, value in options.items():
+            setattr(pipe.unet, name, value)
+        pipe.unet.reset()
+        return pipe
+
+    _prepare_deep_cache(pipe)
+    unet = pipe.unet
+    pipe.unet = DeepCacheUNet(pipe, unet, **options)
+    logger.info(
+        f"Enabled DeepCache on {type(_get_torch_module(unet)).__name__} of {type(pipe).__name__}"
+    )
+    return pipe
+
+
+def disable_deep_cache(pipe):
+    """Restores the UNet called by the pipeline, which keeps the DeepCache blocks."""
+    if isinstance(pipe.unet, DeepCacheUNet):
+        pipe.unet = pipe.unet.wrapped_part
+    return pipe
@@ -52,6 +52,7 @@ from diffusers.pipelines.stable_diffusion.safety_checker import (
 from diffusers.schedulers import KarrasDiffusionSchedulers
 from diffusers.utils import deprecate, logging
 
+from .adaptive_schedule import AdaptiveCacheSchedule
 from .models.fast_unet_2d_condition import FastUNet2DConditionModel
 
 from .models.pipeline_utils import enable_deep_cache_pipeline
@@ -245,6 +246,7 @@ if diffusers_version <= diffusers_0214_v:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
         ):
             # 0. Default height and width to unet
             height = height or self.unet.config.sample_size * self.vae_scale_factor
@@ -366,7 +368,10 @@ if diffusers_version <= diffusers_0214_v:
                         latent_model_input, t
                     )
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -393,6 +398,9 @@ if diffusers_version <= diffusers_0214_v:
                             return_dict=False,
                         )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -607,6 +615,7 @@ elif diffusers_version <= diffusers_0231_v:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
             **kwargs,
         ):
             callback = kwargs.pop("callback", None)
@@ -750,7 +759,10 @@ elif diffusers_version <= diffusers_0231_v:
                         latent_model_input, t
                     )
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -803,6 +815,9 @@ elif diffusers_version <= diffusers_0231_v:
                                 return_dict=False,
                             )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if self.do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -1048,6 +1063,7 @@ elif diffusers_version < diffusers_0270_v:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
             **kwargs,
         ):
             callback = kwargs.pop("callback", None)
@@ -1226,7 +1242,10 @@ elif diffusers_version < diffusers_0270_v:
                         latent_model_input, t
                     )
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -1283,6 +1302,9 @@ elif diffusers_version < diffusers_0270_v:
                                 return_dict=False,
                             )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if self.do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -1526,6 +1548,7 @@ else:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
             **kwargs,
         ):
             callback = kwargs.pop("callback", None)
@@ -1690,7 +1713,10 @@ else:
                         latent_model_input, t
                     )
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -1721,6 +1747,9 @@ else:
                             return_dict=False,
                         )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if self.do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -40,6 +40,7 @@ from diffusers.schedulers import KarrasDiffusionSchedulers
 from diffusers.utils import is_invisible_watermark_available, logging
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
 
+from .adaptive_schedule import AdaptiveCacheSchedule
 from .models.fast_unet_2d_condition import FastUNet2DConditionModel
 
 from .models.unet_2d_condition import UNet2DConditionModel
@@ -184,6 +185,7 @@ if diffusers_version <= diffusers_0202_v:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
         ):
             # 0. Default height and width to unet
             height = height or self.default_sample_size * self.vae_scale_factor
@@ -348,7 +350,10 @@ if diffusers_version <= diffusers_0202_v:
                         "time_ids": add_time_ids,
                     }
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -376,6 +381,9 @@ if diffusers_version <= diffusers_0202_v:
                             return_dict=False,
                         )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -534,6 +542,7 @@ elif diffusers_version <= diffusers_0214_v:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
         ):
             # 0. Default height and width to unet
             height = height or self.default_sample_size * self.vae_scale_factor
@@ -708,7 +717,10 @@ elif diffusers_version <= diffusers_0214_v:
                         "time_ids": add_time_ids,
                     }
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -736,6 +748,9 @@ elif diffusers_version <= diffusers_0214_v:
                             return_dict=False,
                         )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -907,6 +922,7 @@ elif diffusers_version <= diffusers_0231_v:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
             **kwargs,
         ):
             callback = kwargs.pop("callback", None)
@@ -1123,7 +1139,10 @@ elif diffusers_version <= diffusers_0231_v:
                         "time_ids": add_time_ids,
                     }
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -1179,6 +1198,9 @@ elif diffusers_version <= diffusers_0231_v:
                                 return_dict=False,
                             )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if self.do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -1397,6 +1419,7 @@ elif diffusers_version < diffusers_0270_v:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
             **kwargs,
         ):
             callback = kwargs.pop("callback", None)
@@ -1649,7 +1672,10 @@ elif diffusers_version < diffusers_0270_v:
                     if ip_adapter_image is not None:
                         added_cond_kwargs["image_embeds"] = image_embeds
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -1705,6 +1731,9 @@ elif diffusers_version < diffusers_0270_v:
                                 return_dict=False,
                             )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if self.do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -1919,6 +1948,7 @@ else:
             uniform: bool = True,
             pow: float = None,
             center: int = None,
+            cache_schedule: Optional[AdaptiveCacheSchedule] = None,
             **kwargs,
         ):
             callback = kwargs.pop("callback", None)
@@ -2156,7 +2186,10 @@ else:
                     ):
                         added_cond_kwargs["image_embeds"] = image_embeds
 
-                    if i in interval_seq or cache_interval == 1:
+                    is_full_step = i in interval_seq or cache_interval == 1
+                    if cache_schedule is not None:
+                        is_full_step = cache_schedule.is_full_step(i)
+                    if is_full_step:
                         prv_features = None
                         # print(t, prv_features is None)
                         # predict the noise residual
@@ -2187,6 +2220,9 @@ else:
                             return_dict=False,
                         )
 
+                    if cache_schedule is not None:
+                        cache_schedule.update(i, is_full_step, noise_pred, prv_features)
+
                     # perform guidance
                     if self.do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -42,6 +42,7 @@ from diffusers.pipelines.stable_video_diffusion import (
     StableVideoDiffusionPipelineOutput,
 )
 
+from .adaptive_schedule import AdaptiveCacheSchedule
 from .models.fast_unet_spatio_temporal_condition import (
     FastUNetSpatioTemporalConditionModel,
 )
@@ -127,6 +128,7 @@ class StableVideoDiffusionPipeline(DiffusersStableVideoDiffusionPipeline):
         cache_interval: Optional[int] = 1,
         cache_branch: Optional[int] = None,
         return_dict: bool = True,
+        cache_schedule: Optional[AdaptiveCacheSchedule] = None,
     ):
         # 0. Default height and width to unet
         height = height or self.unet.config.sample_size * self.vae_scale_factor
@@ -301,7 +303,10 @@ class StableVideoDiffusionPipeline(DiffusersStableVideoDiffusionPipeline):
                     [latent_model_input, image_latents], dim=2
                 )
 
-                if i in interval_seq:
+                is_full_step = i in interval_seq
+                if cache_schedule is not None:
+                    is_full_step = cache_schedule.is_full_step(i)
+                if is_full_step:
                     cache_features = None
                     # predict the noise residual
                     noise_pred, cache_features = self.unet(
@@ -324,6 +329,9 @@ class StableVideoDiffusionPipeline(DiffusersStableVideoDiffusionPipeline):
                         return_dict=False,
                     )
 
+                if cache_schedule is not None:
+                    cache_schedule.update(i, is_full_step, noise_pred, cache_features)
+
                 # perform guidance
                 if diffusers_version > diffusers_0240_v:
                     if self.do_classifier_free_guidance:
@@ -5,7 +5,9 @@ from onediff.infer_compiler.backends.oneflow.param_utils import (
 from .lora import (
     delete_adapters,
     get_active_adapters,
+    get_lora_cache_stats,
     load_and_fuse_lora,
+    prefetch_loras,
     set_and_fuse_adapters,
     unfuse_lora,
 )
@@ -0,0 +1,254 @@
+"""Batched LoRA fusion for fast adapter switching.
+
+Switching the active adapters only touches the layers whose active adapters or scales change,
+and only by the difference between the old and new adapters. The low rank factors of the
+changed adapters are concatenated along the rank dimension, so the difference of a layer is
+a single matmul, and layers of the same shape are computed together in one `bmm`.
+
+With a cache budget, the fused deltas of each (adapter set, scales) are kept, so switching
+back to a cached adapter set needs no matmul at all.
+"""
+
+import collections
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from onediff.utils import logger, parse_integer_from_env
+from onediff.utils.chache_utils import MemoryBudgetedCache
+
+from .utils import is_peft_available, PatchedLoraProjection, update_graph_related_tensor
+
+if is_peft_available():
+    import peft
+
+__all__ = ["LoRAFusionEngine", "get_fusion_engine"]
+
+# Upper bound of the elements of one batched delta. Each chunk is consumed before the
+# next one is computed, so this bounds the temporary memory of the deltas
+_MAX_BATCH_ELEMENTS = 1 << 26
+
+
+def _unwrap_layer(m: torch.nn.Module) -> Optional[torch.nn.Module]:
+    if isinstance(m, PatchedLoraProjection):
+        m = m.regular_linear_layer
+    elif is_peft_available() and isinstance(
+        m, (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d)
+    ):
+        m = m.base_layer
+    if isinstance(m, (torch.nn.Linear, torch.nn.Conv2d)) and hasattr(
+        m, "adapter_names"
+    ):
+        return m
+    return None
+
+
+def _config_key(adapters: Dict[str, float]) -> Tuple:
+    return tuple(sorted(adapters.items()))
+
+
+def _low_rank_difference(layer, old: Dict[str, float], new: Dict[str, float]):
+    """Returns B, A such that B @ A is the delta from the old to the new adapters of the layer.
+
+    Adapters whose weight is unchanged are skipped, the others are concatenated along the rank.
+    """
+    ups, downs = [], []
+    for adapter in sorted(set(old) | set(new)):
+        if old.get(adapter, None) == new.get(adapter, None):
+            continue
+        old_scale = layer.scaling[adapter] if adapter in old else 0.0
+        new_scale = 0.0
+        if adapter in new:
+            new_scale = new[adapter] * layer.lora_alpha[adapter] / layer.r[adapter]
+        ups.append(
+            layer.lora_B[adapter].flatten(start_dim=1).float() * (new_scale - old_scale)
+        )
+        downs.append(layer.lora_A[adapter].flatten(start_dim=1).float())
+    return torch.cat(ups, dim=1), torch.cat(downs, dim=0)
+
+
+def _batched_deltas(updates, consume) -> None:
+    """Computes B @ A of each (layer, B, A), in one bmm per group of layers of the same shapes.
+
+    `consume(i, delta)` is called with the delta of `updates[i]`, one chunk at a time, so the
+    delta of a layer should not be kept on the weight device by `consume`.
+    """
+    groups = collections.defaultdict(list)
+    for i, (layer, up, down) in enumerate(updates):
+        groups[(layer.weight.device, tuple(up.shape), tuple(down.shape))].append(i)
+
+    for (device, up_shape, down_shape), indices in groups.items():
+        chunk_size = max(1, _MAX_BATCH_ELEMENTS // (up_shape[0] * down_shape[1]))
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start : start + chunk_size]
+            # Stack on the offload device, then copy to the weight device once
+            ups = torch.stack([updates[i][1] for i in chunk]).to(device)
+            downs = torch.stack([updates[i][2] for i in chunk]).to(device)
+            for i, delta in zip(chunk, torch.bmm(ups, downs)):
+                consume(i, delta.reshape(updates[i][0].weight.shape))
+            del ups, downs
+
+
+def _add_to_weight(layer, delta: torch.Tensor) -> None:
+    weight = layer.weight.data
+    fused_weight = weight.float() + delta.to(weight.device).float()
+    weight.copy_(fused_weight.to(dtype=weight.dtype))
+    update_graph_related_tensor(layer)
+
+
+class LoRAFusionEngine:
+    """LoRAFusionEngine
+
+    __init__ args:
+        `max_cache_bytes`: The budget of the cached fused deltas, 0 disables the cache.
+        `cache_device`: The device of the cached deltas, the device of the weights if None.
+    """
+
+    def __init__(self, max_cache_bytes: int = 0, cache_device: Optional[str] = "cpu"):
+        self.max_cache_bytes = max_cache_bytes
+        self.cache_device = cache_device
+        # adapter set and weights -> {layer: (adapters and weights of the layer, delta)}
+        self._cache = MemoryBudgetedCache(
+            capacity=None,
+            max_bytes=max_cache_bytes,
+            size_fn=lambda entry: sum(
+                d.numel() * d.element_size() for _, d in entry.values()
+            ),
+        )
+        self._active_key = ()
+
+    @staticmethod
+    def collect_layers(pipeline) -> List[torch.nn.Module]:
+        layers = []
+        for name in ("unet", "text_encoder", "text_encoder_2"):
+            component = getattr(pipeline, name, None)
+            if component is None:
+                continue
+            for m in component.modules():
+                layer = _unwrap_layer(m)
+                if layer is not None:
+                    layers.append(layer)
+        return layers
+
+    def invalidate(self, adapter_names=None) -> None:
+        """Drops the cached deltas of the adapters, e.g. when they are reloaded or deleted."""
+        for key in list(self._cache.keys()):
+            if adapter_names is None or any(a in adapter_names for a, _ in key):
+                self._cache.pop(key)
+
+    def cache_stats(self) -> Dict:
+        return self._cache.stats()
+
+    def _cached_delta(self, entry, layer, layer_key):
+        """Returns the cached delta of the layer, zeros are None, or False if not cached."""
+        if len(layer_key) == 0:
+            return None
+        if entry is None or layer not in entry or entry[layer][0] != layer_key:
+            return False
+        return entry[layer][1]
+
+    def set_adapters(
+        self, pipeline, adapter_names: List[str], adapter_weights: List[float]
+    ) -> int:
+        """Fuses exactly the given adapters into the LoRA layers, returns the number of updated layers."""
+        target = dict(zip(adapter_names, adapter_weights))
+        target_key = _config_key(target)
+        old_entry = self._cache._entries.get(self._active_key, None)
+        new_entry = self._cache.get(target_key, None) if target_key else None
+        build_entry = self.max_cache_bytes > 0 and target_key and new_entry is None
+
+        dense_updates, low_rank_updates = [], []
+        # Layers whose full delta of the target adapters has to be cached
+        full_delta_layers = []
+        for layer in self.collect_layers(pipeline):
+            old = dict(layer.active_adapter_names)
+            new = {a: w for a, w in target.items() if a in layer.adapter_names}
+            old_key, new_key = _config_key(old), _config_key(new)
+            if old_key != new_key:
+                old_delta = self._cached_delta(old_entry, layer, old_key)
+                new_delta = self._cached_delta(new_entry, layer, new_key)
+                if old_delta is not False and new_delta is not False:
+                    dense_updates.append((layer, old_delta, new_delta))
+                else:
+                    low_rank_updates.append(
+                        (layer, *_low_rank_difference(layer, old, new))
+                    )
+            if build_entry and len(new) > 0 and (len(old) > 0 or old_key == new_key):
+                full_delta_layers.append(layer)
+
+            for adapter, weight in new.items():
+                layer.scaling[adapter] = (
+                    weight * layer.lora_alpha[adapter] / layer.r[adapter]
+                )
+            layer.active_adapter_names = new
+
+        for layer, old_delta, new_delta in dense_updates:
+            # Built right before it is applied, so only one dense delta is alive at a time
+            delta = torch.zeros(
+                layer.weight.shape, dtype=torch.float32, device=layer.weight.device
+            )
+            if new_delta is not None:
+                delta += new_delta.to(delta.device).float()
+            if old_delta is not None:
+                delta -= old_delta.to(delta.device).float()
+            _add_to_weight(layer, delta)
+            del delta
+
+        entry = {}
+        full_delta_ids = {id(layer) for layer in full_delta_layers}
+
+        def to_cache(layer, delta):
+            return delta.to(
+                device=self.cache_device or delta.device, dtype=layer.weight.dtype
+            )
+
+        def apply_low_rank(i, delta):
+            layer = low_rank_updates[i][0]
+            _add_to_weight(layer, delta)
+            # From no adapters, the applied delta is the full delta of the target adapters
+            if (
+                build_entry
+                and id(layer) not in full_delta_ids
+                and len(layer.active_adapter_names) > 0
+            ):
+                entry[layer] = to_cache(layer, delta)
+
+        _batched_deltas(low_rank_updates, apply_low_rank)
+
+        if build_entry:
+            full_updates = [
+                (layer, *_low_rank_difference(layer, {}, layer.active_adapter_names))
+                for layer in full_delta_layers
+            ]
+
+            def keep_full_delta(i, delta):
+                layer = full_updates[i][0]
+                entry[layer] = to_cache(layer, delta)
+
+            _batched_deltas(full_updates, keep_full_delta)
+            self._cache.put(
+                target_key,
+                {
+                    layer: (_config_key(layer.active_adapter_names), delta)
+                    for layer, delta in entry.items()
+                },
+            )
+        self._active_key = target_key
+        logger.debug(
+            f"Updated {len(low_rank_updates)} LoRA layers by low rank and {len(dense_updates)} by cached deltas"
+        )
+        return len(dense_updates) + len(low_rank_updates)
+
+
+def get_fusion_engine(pipeline) -> LoRAFusionEngine:
+    """Returns the fusion engine of the pipeline.
+
+    Set ONEDIFFX_LORA_DELTA_CACHE_BYTES to cache fused deltas within the byte budget, on the
+    host by default.
+    """
+    engine = getattr(pipeline, "_onediffx_lora_fusion_engine", None)
+    if engine is None:
+        engine = LoRAFusionEngine(
+            max_cache_bytes=parse_integer_from_env("ONEDIFFX_LORA_DELTA_CACHE_BYTES", 0)
+        )
+        setattr(pipeline, "_onediffx_lora_fusion_engine", engine)
+    return engine
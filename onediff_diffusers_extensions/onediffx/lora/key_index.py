@@ -0,0 +1,167 @@
+"""Parses LoRA state dict keys once, so that remapping keys and matching alphas are lookups.
+
+The loaders of diffusers match keys by substrings, scanning all keys per block or all alphas
+per key, which is quadratic in the number of keys of large LoRAs.
+"""
+
+import collections
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+__all__ = [
+    "LoRAKeyRecord",
+    "SGMKeyRecord",
+    "parse_lora_key",
+    "parse_sgm_key",
+    "map_network_alphas",
+    "remap_sgm_keys",
+]
+
+SGM_PATTERNS = ("input_blocks", "middle_block", "output_blocks")
+_INNER_BLOCK_MAP = ("resnets", "attentions", "upsamplers")
+
+
+class LoRAKeyRecord(NamedTuple):
+    """A key as `<module>.<sub_key>`, e.g. `mid_block.attentions.0.proj_in` and `lora.down.weight`."""
+
+    key: str
+    module: str
+    sub_key: str
+
+
+class SGMKeyRecord(NamedTuple):
+    """A key of the SGM UNet, e.g. `lora_unet_input_blocks_4_1_...`, split by the delimiter."""
+
+    key: str
+    pattern: str
+    block_id: int
+    parts: Tuple[str, ...]
+
+
+def parse_lora_key(key: str) -> LoRAKeyRecord:
+    parts = key.split(".")
+    return LoRAKeyRecord(key, ".".join(parts[:-3]), ".".join(parts[-3:]))
+
+
+def parse_sgm_key(key: str, delimiter="_", block_slice_pos=5) -> SGMKeyRecord:
+    parts = tuple(key.split(delimiter))
+    block_id = int(parts[:block_slice_pos][-1])
+    for pattern in SGM_PATTERNS:
+        if pattern in key:
+            return SGMKeyRecord(key, pattern, block_id, parts)
+    raise ValueError(f"Checkpoint not supported because layer {key} not supported.")
+
+
+def _remap_sgm_key(
+    record: SGMKeyRecord, layers_per_block: int, delimiter: str, block_slice_pos: int
+) -> str:
+    parts = list(record.parts)
+    i = record.block_id
+    if record.pattern == "input_blocks":
+        block_id = (i - 1) // (layers_per_block + 1)
+        layer_in_block_id = (i - 1) % (layers_per_block + 1)
+        inner_block_id = int(parts[block_slice_pos])
+        is_downsampler = "op" in record.key
+        inner_block_key = (
+            "downsamplers" if is_downsampler else _INNER_BLOCK_MAP[inner_block_id]
+        )
+        inner_layers_in_block = "0" if is_downsampler else str(layer_in_block_id)
+        new_parts = (
+            parts[: block_slice_pos - 1]
+            + [str(block_id), inner_block_key, inner_layers_in_block]
+            + parts[block_slice_pos + 1 :]
+        )
+    elif record.pattern == "middle_block":
+        if i == 0:
+            key_part = [_INNER_BLOCK_MAP[0], "0"]
+        elif i == 1:
+            key_part = [_INNER_BLOCK_MAP[1], "0"]
+        elif i == 2:
+            key_part = [_INNER_BLOCK_MAP[0], "1"]
+        else:
+            raise ValueError(f"Invalid middle block id {i}.")
+        new_parts = parts[: block_slice_pos - 1] + key_part + parts[block_slice_pos:]
+    else:
+        block_id = i // (layers_per_block + 1)
+        layer_in_block_id = i % (layers_per_block + 1)
+        inner_block_id = int(parts[block_slice_pos])
+        inner_layers_in_block = str(layer_in_block_id) if inner_block_id < 2 else "0"
+        new_parts = (
+            parts[: block_slice_pos - 1]
+            + [str(block_id), _INNER_BLOCK_MAP[inner_block_id], inner_layers_in_block]
+            + parts[block_slice_pos + 1 :]
+        )
+    return delimiter.join(new_parts)
+
+
+def remap_sgm_keys(
+    keys: Iterable[str], layers_per_block: int, delimiter="_", block_slice_pos=5
+) -> Optional[Dict[str, str]]:
+    """Maps the SGM UNet keys to diffusers keys, or returns None if no key is in SGM format.
+
+    Text encoder keys are kept as they are. Each key is parsed once and grouped by its own
+    block id, instead of by a substring match of the block name, which also matched e.g.
+    block 10 when looking for block 1.
+    """
+    keys = list(keys)
+    if not any(p in key for key in keys for p in SGM_PATTERNS):
+        return None
+
+    key_map = {}
+    records = []
+    for key in keys:
+        if "text" in key:
+            key_map[key] = key
+        else:
+            records.append(parse_sgm_key(key, delimiter, block_slice_pos))
+    # In the order of the blocks, as diffusers does
+    records.sort(key=lambda r: (SGM_PATTERNS.index(r.pattern), r.block_id))
+    for record in records:
+        key_map[record.key] = _remap_sgm_key(
+            record, layers_per_block, delimiter, block_slice_pos
+        )
+    return key_map
+
+
+def map_network_alphas(
+    records: List[LoRAKeyRecord], network_alphas: Dict[str, float]
+) -> Tuple[Dict[str, float], Set[str]]:
+    """Associates each module with the alpha whose `<name>.alpha` key has `<name>` in the key.
+
+    Returns the alpha of each module and the used alpha keys. Names that are dot-aligned
+    prefixes of a key, which is how diffusers names alphas, are looked up in a dict. Only the
+    alphas that remain unused are matched by substring, as before.
+    """
+    # name -> (position in network_alphas, alpha key), the last alpha wins as before
+    alpha_index = {}
+    for position, alpha_key in enumerate(network_alphas):
+        alpha_index[alpha_key.replace(".alpha", "")] = (position, alpha_key)
+
+    mapped_network_alphas = {}
+    used_alpha_keys = set()
+    # module -> position of the mapped alpha
+    mapped_positions = {}
+    for record in records:
+        parts = record.key.split(".")
+        matches = []
+        for end in range(1, len(parts) + 1):
+            match = alpha_index.get(".".join(parts[:end]), None)
+            if match is not None:
+                matches.append(match)
+        for position, alpha_key in matches:
+            used_alpha_keys.add(alpha_key)
+            if position >= mapped_positions.get(record.module, -1):
+                mapped_positions[record.module] = position
+                mapped_network_alphas[record.module] = network_alphas[alpha_key]
+
+    unused_alpha_keys = [k for k in network_alphas if k not in used_alpha_keys]
+    if unused_alpha_keys:
+        keys_by_module = collections.defaultdict(list)
+        for record in records:
+            keys_by_module[record.module].append(record.key)
+        for alpha_key in unused_alpha_keys:
+            name = alpha_key.replace(".alpha", "")
+            for module, keys in keys_by_module.items():
+                if any(name in key for key in keys):
+                    used_alpha_keys.add(alpha_key)
+                    mapped_network_alphas.setdefault(module, network_alphas[alpha_key])
+    return mapped_network_alphas, used_alpha_keys
@@ -1,4 +1,4 @@
-from collections import defaultdict, OrderedDict
+from collections import defaultdict
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Union
 
@@ -16,13 +16,13 @@ else:
     from diffusers.loaders import PatchedLoraProjection
 
 
+from .fusion_engine import get_fusion_engine
+from .state_dict_cache import get_lora_state_dict_cache
 from .text_encoder import load_lora_into_text_encoder
 from .unet import load_lora_into_unet
 from .utils import (
     _delete_adapter,
     _maybe_map_sgm_blocks_to_diffusers,
-    _set_adapter,
-    _unfuse_lora,
     is_peft_available,
 )
 
@@ -56,6 +56,8 @@ def load_and_fuse_lora(
     pipeline._active_adapter_names[adapter_name] = 1.0
 
     self = pipeline
+    # The cached deltas of a reloaded adapter are stale
+    get_fusion_engine(pipeline).invalidate([adapter_name])
 
     if use_cache:
         state_dict, network_alphas = load_state_dict_cached(
@@ -127,23 +129,11 @@ def load_and_fuse_lora(
 
 
 def unfuse_lora(pipeline: LoraLoaderMixin):
-    def _unfuse_lora_apply(m: torch.nn.Module):
-        if isinstance(m, (torch.nn.Linear, PatchedLoraProjection, torch.nn.Conv2d)):
-            _unfuse_lora(m)
-        elif is_peft_available() and isinstance(
-            m,
-            (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d),
-        ):
-            _unfuse_lora(m.base_layer)
-
+    _init_adapters_info(pipeline)
     pipeline._adapter_names.clear()
     pipeline._active_adapter_names.clear()
 
-    pipeline.unet.apply(_unfuse_lora_apply)
-    if hasattr(pipeline, "text_encoder"):
-        pipeline.text_encoder.apply(_unfuse_lora_apply)
-    if hasattr(pipeline, "text_encoder_2"):
-        pipeline.text_encoder_2.apply(_unfuse_lora_apply)
+    get_fusion_engine(pipeline).set_adapters(pipeline, [], [])
 
 
 def set_and_fuse_adapters(
@@ -169,20 +159,8 @@ def set_and_fuse_adapters(
         k: v for k, v in zip(adapter_names, adapter_weights)
     }
 
-    def set_adapters_apply(m):
-        if isinstance(m, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)):
-            _set_adapter(m, adapter_names, adapter_weights)
-        elif is_peft_available() and isinstance(
-            m,
-            (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d),
-        ):
-            _set_adapter(m.base_layer, adapter_names, adapter_weights)
-
-    pipeline.unet.apply(set_adapters_apply)
-    if hasattr(pipeline, "text_encoder"):
-        pipeline.text_encoder.apply(set_adapters_apply)
-    if hasattr(pipeline, "text_encoder_2"):
-        pipeline.text_encoder_2.apply(set_adapters_apply)
+    # Only the layers whose adapters change are updated, by the difference
+    get_fusion_engine(pipeline).set_adapters(pipeline, adapter_names, adapter_weights)
 
 
 def delete_adapters(self, adapter_names: Union[List[str], str] = None):
@@ -194,6 +172,7 @@ def delete_adapters(self, adapter_names: Union[List[str], str] = None):
     for adapter_name in adapter_names:
         self._adapter_names.remove(adapter_name)
         self._active_adapter_names.pop(adapter_name, None)
+    get_fusion_engine(self).invalidate(adapter_names)
 
     def delete_adapters_apply(m):
         if isinstance(m, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)):
@@ -224,23 +203,6 @@ def _init_adapters_info(self: torch.nn.Module):
         setattr(self, "_active_adapter_names", {})
 
 
-class LRUCacheDict(OrderedDict):
-    def __init__(self, capacity):
-        super().__init__()
-        self.capacity = capacity
-
-    def __getitem__(self, key):
-        value = super().__getitem__(key)
-        self.move_to_end(key)
-        return value
-
-    def __setitem__(self, key, value):
-        if len(self) >= self.capacity:
-            oldest_key = next(iter(self))
-            del self[oldest_key]
-        super().__setitem__(key, value)
-
-
 def load_state_dict_cached(
     lora: Union[str, Path, Dict[str, torch.Tensor]],
     **kwargs,
@@ -250,23 +212,13 @@ def load_state_dict_cached(
         state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(lora, **kwargs)
         return state_dict, network_alphas
 
-    global CachedLoRAs
-    weight_name = kwargs.get("weight_name", None)
+    return get_lora_state_dict_cache().get(lora, **kwargs)
 
-    lora_name = str(lora) + (f"/{weight_name}" if weight_name else "")
-    if lora_name in CachedLoRAs:
-        logger.debug(
-            f"[OneDiffX Cached LoRA] get cached lora of name: {str(lora_name)}"
-        )
-        return CachedLoRAs[lora_name]
 
-    state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(
-        lora,
-        **kwargs,
-    )
-    CachedLoRAs[lora_name] = (state_dict, network_alphas)
-    logger.debug(f"[OneDiffX Cached LoRA] create cached lora of name: {str(lora_name)}")
-    return state_dict, network_alphas
+def prefetch_loras(loras: List[Union[str, Path]], **kwargs):
+    """Loads the LoRAs of queued requests into the cache used by `use_cache=True` in the background."""
+    return get_lora_state_dict_cache().prefetch(loras, **kwargs)
 
 
-CachedLoRAs = LRUCacheDict(100)
+def get_lora_cache_stats() -> Dict:
+    return get_lora_state_dict_cache().stats()
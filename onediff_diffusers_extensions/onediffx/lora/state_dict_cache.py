@@ -0,0 +1,374 @@
+"""A byte-budgeted cache of LoRA state dicts.
+
+Local safetensors files are memory-mapped, so cached tensors are backed by the page cache instead
+of private host memory, and a miss only parses the header. Entries are validated against the size
+and mtime of their file on every lookup, and optionally against its sha256 when the mtime changes,
+so a LoRA that is rewritten on disk is reloaded.
+
+The budget is set by ONEDIFFX_LORA_CACHE_BYTES (default 4 GiB) and the validation by
+ONEDIFFX_LORA_CACHE_VERIFY, "mtime" (default) or "hash". The budget counts the tensors in private
+host memory only, e.g. those converted by diffusers, since the page cache backing memory-mapped
+tensors can be reclaimed. Memory-mapped LoRAs are bounded by the number of cached LoRAs.
+"""
+
+import dataclasses
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+from diffusers.loaders import LoraLoaderMixin
+from onediff.utils import logger, metrics, parse_integer_from_env
+from onediff.utils.chache_utils import MemoryBudgetedCache
+
+__all__ = ["LoRAStateDictCache", "get_lora_state_dict_cache"]
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+# The file names diffusers looks for in a LoRA directory without `weight_name`
+_DEFAULT_WEIGHT_NAMES = (
+    "pytorch_lora_weights.safetensors",
+    "pytorch_lora_weights.bin",
+)
+
+
+def _resolve_local_file(lora: Union[str, Path], weight_name: Optional[str]):
+    path = Path(lora)
+    if path.is_file():
+        return path
+    if path.is_dir():
+        names = [weight_name] if weight_name else _DEFAULT_WEIGHT_NAMES
+        for name in names:
+            if (path / name).is_file():
+                return path / name
+    # A repo on the hub, whose files are resolved by diffusers
+    return None
+
+
+def _file_signature(file_path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = file_path.stat()
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _file_sha256(file_path: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 24), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _mmap_safetensors(file_path: Path) -> Dict[str, torch.Tensor]:
+    """Loads a safetensors file as tensors viewing a copy-on-write memory map of the file."""
+    with open(file_path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        # Copy-on-write, so in-place updates of the tensors never reach the file
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_offset = 8 + header_size
+
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        tensor = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=(end - begin) // itemsize,
+            offset=data_offset + begin,
+        )
+        state_dict[name] = tensor.reshape(info["shape"])
+    return state_dict
+
+
+def _load_local_file(file_path: Path) -> Tuple[Optional[Dict], bool]:
+    """Returns the state dict of a local file and whether its tensors are memory-mapped.
+
+    The state dict is None for pickled files holding more than tensors, which are left to
+    diffusers and its own unpickling policy rather than fully unpickled here.
+    """
+    if file_path.suffix == ".safetensors":
+        try:
+            return _mmap_safetensors(file_path), True
+        except (KeyError, ValueError, struct.error) as e:
+            logger.warning(f"Failed to memory-map {file_path}, load it instead. {e=}")
+            import safetensors.torch
+
+            return safetensors.torch.load_file(str(file_path), device="cpu"), False
+    try:
+        try:
+            state_dict = torch.load(
+                file_path, map_location="cpu", mmap=True, weights_only=True
+            )
+            return state_dict, True
+        except RuntimeError:
+            # Legacy checkpoints, which are not zip files, can't be memory-mapped
+            state_dict = torch.load(file_path, map_location="cpu", weights_only=True)
+            return state_dict, False
+    except TypeError:
+        # torch < 2.1 has no `mmap`
+        logger.debug(f"Can't memory-map {file_path}, load it with diffusers")
+    except pickle.UnpicklingError as e:
+        logger.warning(
+            f"{file_path} holds more than tensors, load it with diffusers. {e=}"
+        )
+    return None, False
+
+
+def _storage_ptrs(state_dict: Dict) -> set:
+    return {
+        t.untyped_storage().data_ptr()
+        for t in state_dict.values()
+        if isinstance(t, torch.Tensor)
+    }
+
+
+@dataclasses.dataclass
+class _CacheEntry:
+    state_dict: Dict[str, torch.Tensor]
+    network_alphas: Optional[Dict[str, float]]
+    file_path: Optional[Path]
+    signature: Optional[Tuple[int, int]]
+    sha256: Optional[str]
+    # Bytes of the tensors in private memory and of those memory-mapped from the file
+    nbytes: int
+    mapped_nbytes: int
+
+
+class LoRAStateDictCache:
+    """LoRAStateDictCache
+
+    __init__ args:
+        `max_bytes`: The byte budget of the cached tensors in private memory, None means
+            unlimited. Memory-mapped tensors are not counted.
+        `capacity`: The maximum number of cached LoRAs.
+        `verify`: "mtime" reloads a LoRA whose file size or mtime changed, "hash" keeps it
+            if the sha256 of the file is unchanged.
+        `max_workers`: The number of threads loading prefetched LoRAs.
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        capacity: int = 100,
+        verify: str = "mtime",
+        max_workers: int = 2,
+    ):
+        if verify not in ("mtime", "hash"):
+            raise ValueError(f"Unsupported verification {verify}")
+        self.verify = verify
+        self.max_workers = max_workers
+        self._cache = MemoryBudgetedCache(
+            capacity=capacity, max_bytes=max_bytes, size_fn=lambda e: e.nbytes
+        )
+        self._lock = threading.Lock()
+        # key -> Future of the LoRA being loaded, so a LoRA is loaded once at a time
+        self._loading = {}
+        self._executor = None
+        self._prefetches = 0
+        self._invalidations = 0
+        self._load_seconds = 0.0
+
+    @staticmethod
+    def _key(lora: Union[str, Path], weight_name: Optional[str]) -> str:
+        return str(lora) + (f"/{weight_name}" if weight_name else "")
+
+    def _is_valid(self, entry: _CacheEntry) -> bool:
+        if entry.file_path is None:
+            return True
+        signature = _file_signature(entry.file_path)
+        if signature is None:
+            return False
+        if signature == entry.signature:
+            return True
+        if self.verify == "hash" and entry.sha256 == _file_sha256(entry.file_path):
+            entry.signature = signature
+            return True
+        return False
+
+    def _load(self, lora, kwargs) -> _CacheEntry:
+        start = time.perf_counter()
+        file_path = _resolve_local_file(lora, kwargs.get("weight_name", None))
+        signature = sha256 = None
+        mapped_ptrs = set()
+        if file_path is not None:
+            signature = _file_signature(file_path)
+            if self.verify == "hash":
+                sha256 = _file_sha256(file_path)
+            local_state_dict, is_mapped = _load_local_file(file_path)
+            if local_state_dict is not None:
+                lora = local_state_dict
+                if is_mapped:
+                    mapped_ptrs = _storage_ptrs(local_state_dict)
+        state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(lora, **kwargs)
+        nbytes = mapped_nbytes = 0
+        for t in state_dict.values():
+            if not isinstance(t, torch.Tensor):
+                continue
+            if t.untyped_storage().data_ptr() in mapped_ptrs:
+                mapped_nbytes += t.numel() * t.element_size()
+            else:
+                nbytes += t.numel() * t.element_size()
+        cost = time.perf_counter() - start
+        with self._lock:
+            self._load_seconds += cost
+        metrics.observe("onediffx_lora_cache_load_seconds", cost)
+        return _CacheEntry(
+            state_dict,
+            network_alphas,
+            file_path,
+            signature,
+            sha256,
+            nbytes,
+            mapped_nbytes,
+        )
+
+    def _get_entry(self, lora, kwargs, prefetch=False) -> _CacheEntry:
+        key = self._key(lora, kwargs.get("weight_name", None))
+        with self._lock:
+            entry = self._cache.peek(key)
+            if entry is not None and not self._is_valid(entry):
+                logger.debug(f"[OneDiffX Cached LoRA] {key} changed on disk, reload it")
+                self._cache.pop(key)
+                self._invalidations += 1
+            # Prefetches are not counted as hits or misses
+            if prefetch:
+                entry = self._cache.peek(key)
+            else:
+                entry = self._cache.get(key, None)
+                metrics.inc(
+                    "onediffx_lora_cache_hits_total"
+                    if entry is not None
+                    else "onediffx_lora_cache_misses_total"
+                )
+            if entry is not None:
+                return entry
+            if prefetch:
+                self._prefetches += 1
+            future = self._loading.get(key, None)
+            is_loader = future is None
+            if is_loader:
+                future = self._loading[key] = Future()
+
+        if not is_loader:
+            # Being loaded by a prefetch or another request
+            return future.result()
+        try:
+            entry = self._load(lora, kwargs)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            for evicted in self._cache.put(key, entry):
+                logger.debug(f"[OneDiffX Cached LoRA] evict cached lora {evicted}")
+            self._loading.pop(key, None)
+        future.set_result(entry)
+        logger.debug(f"[OneDiffX Cached LoRA] create cached lora of name: {key}")
+        return entry
+
+    def get(self, lora: Union[str, Path], **kwargs) -> Tuple[Dict, Optional[Dict]]:
+        """Returns the state dict and network alphas of the LoRA, as LoraLoaderMixin.lora_state_dict."""
+        entry = self._get_entry(lora, kwargs)
+        # The loaders pop the keys they consume, so each caller gets its own dicts
+        network_alphas = entry.network_alphas
+        if network_alphas is not None:
+            network_alphas = dict(network_alphas)
+        return dict(entry.state_dict), network_alphas
+
+    def prefetch(self, loras: List[Union[str, Path]], **kwargs) -> Dict[str, Future]:
+        """Loads the LoRAs in the background, e.g. those of queued requests.
+
+        Returns the Future of each LoRA being loaded. Failures are logged, and raised again by
+        the `get` that needs the LoRA.
+        """
+        futures = {}
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="onediffx_lora_prefetch",
+                )
+            executor = self._executor
+        for lora in loras:
+            key = self._key(lora, kwargs.get("weight_name", None))
+            if key in futures:
+                continue
+            futures[key] = executor.submit(self._prefetch_one, lora, kwargs)
+        return futures
+
+    def _prefetch_one(self, lora, kwargs) -> None:
+        try:
+            self._get_entry(lora, kwargs, prefetch=True)
+        except Exception as e:
+            logger.warning(f"[OneDiffX Cached LoRA] failed to prefetch {lora}. {e=}")
+            raise
+
+    def invalidate(self, lora: Union[str, Path, None] = None, weight_name=None) -> None:
+        """Drops a cached LoRA, or all of them if `lora` is None."""
+        with self._lock:
+            keys = (
+                list(self._cache.keys())
+                if lora is None
+                else [self._key(lora, weight_name)]
+            )
+            for key in keys:
+                if self._cache.pop(key, None) is not None:
+                    self._invalidations += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = self._cache.stats()
+            stats.pop("pinned")
+            stats.update(
+                mapped_bytes=sum(
+                    self._cache.peek(key).mapped_nbytes for key in self._cache.keys()
+                ),
+                max_bytes=self._cache.max_bytes,
+                loading=len(self._loading),
+                prefetches=self._prefetches,
+                invalidations=self._invalidations,
+                load_seconds=self._load_seconds,
+            )
+            return stats
+
+
+_state_dict_cache = None
+
+
+def get_lora_state_dict_cache() -> LoRAStateDictCache:
+    global _state_dict_cache
+    if _state_dict_cache is None:
+        _state_dict_cache = LoRAStateDictCache(
+            max_bytes=parse_integer_from_env("ONEDIFFX_LORA_CACHE_BYTES", 4 << 30),
+            verify=os.getenv("ONEDIFFX_LORA_CACHE_VERIFY", "mtime"),
+        )
+    return _state_dict_cache
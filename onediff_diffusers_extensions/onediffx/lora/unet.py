@@ -8,6 +8,7 @@ from onediff.infer_compiler import DeployableModule
 from onediff.utils import logger
 from packaging import version
 
+from .key_index import map_network_alphas, parse_lora_key
 from .utils import fuse_lora, get_adapter_names, is_peft_available
 
 if is_peft_available():
@@ -56,21 +57,17 @@ def load_lora_into_unet(
         # Load the layers corresponding to UNet.
         logger.info(f"Loading {cls.unet_name}.")
 
-        unet_keys = [k for k in keys if k.startswith(cls.unet_name)]
         state_dict = {
             k.replace(f"{cls.unet_name}.", ""): v
             for k, v in state_dict.items()
-            if k in unet_keys
+            if k.startswith(cls.unet_name)
         }
 
         if network_alphas is not None:
-            alpha_keys = [
-                k for k in network_alphas.keys() if k.startswith(cls.unet_name)
-            ]
             network_alphas = {
                 k.replace(f"{cls.unet_name}.", ""): v
                 for k, v in network_alphas.items()
-                if k in alpha_keys
+                if k.startswith(cls.unet_name)
             }
 
     else:
@@ -107,11 +104,10 @@ def _convert_state_dict_legacy_attn_format(self, state_dict, network_alphas):
         if is_text_encoder_present:
             warn_message = "The state_dict contains LoRA params corresponding to the text encoder which are not being used here. To use both UNet and text encoder related LoRA params, use [`pipe.load_lora_weights()`](https://huggingface.co/docs/diffusers/main/en/api/loaders#diffusers.loaders.LoraLoaderMixin.load_lora_weights)."
             logger.warning(warn_message)
-        unet_keys = [k for k in state_dict.keys() if k.startswith(self.unet_name)]
         state_dict = {
             k.replace(f"{self.unet_name}.", ""): v
             for k, v in state_dict.items()
-            if k in unet_keys
+            if k.startswith(self.unet_name)
         }
 
     # change processor format to 'pure' LoRACompatibleLinear format
@@ -167,33 +163,22 @@ def _load_attn_procs(
                 self, state_dict, network_alphas
             )
 
-        if network_alphas is not None:
-            network_alphas_keys = list(network_alphas.keys())
-            used_network_alphas_keys = set()
-
+        # Parse each key once, alphas are then matched by dict lookups
+        records = [parse_lora_key(key) for key in state_dict]
         lora_grouped_dict = defaultdict(dict)
-        mapped_network_alphas = {}
-
-        all_keys = list(state_dict.keys())
-        for key in all_keys:
-            value = state_dict.pop(key)
-            attn_processor_key, sub_key = (
-                ".".join(key.split(".")[:-3]),
-                ".".join(key.split(".")[-3:]),
+        for record in records:
+            lora_grouped_dict[record.module][record.sub_key] = state_dict.pop(
+                record.key
             )
-            lora_grouped_dict[attn_processor_key][sub_key] = value
 
-            # Create another `mapped_network_alphas` dictionary so that we can properly map them.
-            if network_alphas is not None:
-                for k in network_alphas_keys:
-                    if k.replace(".alpha", "") in key:
-                        mapped_network_alphas.update(
-                            {attn_processor_key: network_alphas.get(k)}
-                        )
-                        used_network_alphas_keys.add(k)
+        mapped_network_alphas = {}
+        if network_alphas is not None:
+            mapped_network_alphas, used_network_alphas_keys = map_network_alphas(
+                records, network_alphas
+            )
 
         if not is_network_alphas_none:
-            if len(set(network_alphas_keys) - used_network_alphas_keys) > 0:
+            if len(set(network_alphas.keys()) - used_network_alphas_keys) > 0:
                 raise ValueError(
                     f"[OneDiffX _load_attn_procs] The `network_alphas` has to be empty at this point but has the following keys \n\n {', '.join(network_alphas.keys())}"
                 )
@@ -0,0 +1,3 @@
+from .batch_scheduler import BatchScheduler, planned_batch_sizes
+
+__all__ = ["BatchScheduler", "planned_batch_sizes"]
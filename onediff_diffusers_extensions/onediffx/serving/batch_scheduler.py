@@ -0,0 +1,422 @@
+"""Micro-batching of concurrent requests to one diffusers pipeline.
+
+Requests that can share a pipeline call, i.e. with the same shape, steps, scheduler, LoRA set and
+other call kwargs, are queued together for at most `max_delay` seconds, run as one batched call,
+and the output is split back per request. Each image gets its own generator, so the images of a
+request with a `seed` don't depend on the requests it is batched with.
+
+With `batch_sizes`, e.g. the batch sizes precompiled by `run_warmup_plan` or declared in a
+ShapeBucketPolicy, batches are closed at the largest of them and padded up to the next one, so
+each call hits an already compiled graph.
+
+Example:
+    >>> scheduler = BatchScheduler(pipe, max_batch_size=8, max_delay=0.02, batch_sizes=[1, 2, 4, 8])
+    >>> output = await scheduler.submit(prompt="a cat", height=1024, width=1024, seed=42)
+    >>> output.images[0].save("cat.png")
+    >>> scheduler.stats()["mean_batch_size"]
+    3.5
+"""
+
+import asyncio
+import collections
+import dataclasses
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+import torch
+from onediff.utils import logger, metrics
+
+__all__ = ["BatchScheduler", "planned_batch_sizes"]
+
+# Call kwargs given per image, batched as lists. The other kwargs are shared by a batch.
+PER_IMAGE_KWARGS = (
+    "prompt",
+    "prompt_2",
+    "negative_prompt",
+    "negative_prompt_2",
+    "image",
+    "mask_image",
+)
+
+
+def _is_prompt_embeds(name: str, value) -> bool:
+    """Tensor embeddings of the prompts, such as `prompt_embeds`, repeated per image by diffusers."""
+    return name.endswith("_embeds") and isinstance(value, torch.Tensor)
+
+
+def planned_batch_sizes(plan) -> Dict[Tuple[int, int], List[int]]:
+    """Returns the batch sizes of each (height, width) of a WarmupPlan, for `batch_sizes`."""
+    sizes = collections.defaultdict(set)
+    for height, width, batch_size in plan.shapes:
+        sizes[(height, width)].add(batch_size)
+    return {shape: sorted(batch_sizes) for shape, batch_sizes in sizes.items()}
+
+
+def _freeze(value):
+    """Returns a hashable key of a call kwarg, tensors and other objects by identity."""
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (tuple, list)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return ("id", id(value))
+
+
+def _split_output(output, offsets: List[Tuple[int, int]], total: int):
+    """Splits the per image fields of a pipeline output, e.g. `images`, by request."""
+    if dataclasses.is_dataclass(output):
+        # A BaseOutput only holds its fields that are not None as items
+        fields = {f.name: getattr(output, f.name) for f in dataclasses.fields(output)}
+    elif isinstance(output, Mapping):
+        fields = dict(output)
+    else:
+        fields = {"images": output}
+    splits = []
+    for begin, end in offsets:
+        request_fields = {}
+        for name, value in fields.items():
+            try:
+                is_per_image = value is not None and len(value) == total
+            except TypeError:
+                is_per_image = False
+            request_fields[name] = value[begin:end] if is_per_image else value
+        if dataclasses.is_dataclass(output):
+            splits.append(dataclasses.replace(output, **request_fields))
+        elif isinstance(output, Mapping):
+            splits.append(type(output)(**request_fields))
+        else:
+            splits.append(request_fields["images"])
+    return splits
+
+
+@dataclasses.dataclass
+class _Request:
+    kwargs: Dict[str, Any]
+    num_images: int
+    generators: List[torch.Generator]
+    adapters: Optional[Dict[str, float]]
+    future: asyncio.Future
+    enqueue_time: float
+
+
+class BatchScheduler:
+    """BatchScheduler
+
+    __init__ args:
+        `pipe`: The pipeline, compiled or not.
+        `max_batch_size`: The maximum number of images of a batched call.
+        `max_delay`: The maximum seconds a request waits for other requests to batch with.
+        `batch_sizes`: The precompiled batch sizes, or a dict of them per (height, width).
+        `pad_batches`: Whether to pad batches to the next of `batch_sizes`, the padded
+            images are discarded.
+        `generator_device`: The device of the generators of the seeded requests.
+    """
+
+    def __init__(
+        self,
+        pipe,
+        *,
+        max_batch_size: int = 8,
+        max_delay: float = 0.01,
+        batch_sizes: Union[Sequence[int], Dict[Tuple[int, int], Sequence[int]]] = None,
+        pad_batches: bool = True,
+        generator_device: str = "cpu",
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"Expect max_batch_size >= 1, got {max_batch_size}")
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batch_sizes = batch_sizes
+        self.pad_batches = pad_batches
+        self.generator_device = generator_device
+        # group key -> requests in arrival order
+        self._pending: Dict[Tuple, List[_Request]] = collections.OrderedDict()
+        self._wakeup = None
+        self._dispatcher = None
+        self._closed = False
+        # The pipeline runs one batch at a time, while the next requests are queued
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="onediffx_batch_scheduler"
+        )
+        self._active_adapters = None
+        self._num_batches = 0
+        self._num_requests = 0
+        self._num_images = 0
+        self._num_padded_images = 0
+        self._queue_seconds = 0.0
+        self._max_queue_seconds = 0.0
+
+    def _get_batch_sizes(self, kwargs) -> Sequence[int]:
+        if isinstance(self.batch_sizes, Mapping):
+            shape = (kwargs.get("height", None), kwargs.get("width", None))
+            return self.batch_sizes.get(shape, ())
+        return self.batch_sizes or ()
+
+    def _get_max_images(self, kwargs) -> int:
+        """The batch is closed at the largest precompiled batch size."""
+        sizes = [s for s in self._get_batch_sizes(kwargs) if s <= self.max_batch_size]
+        return max(sizes, default=self.max_batch_size)
+
+    def _group_key(self, kwargs, adapters) -> Tuple:
+        shared = {k: v for k, v in kwargs.items() if k not in PER_IMAGE_KWARGS}
+        return (
+            type(getattr(self.pipe, "scheduler", None)).__name__,
+            _freeze(adapters),
+            tuple(sorted(k for k in kwargs if k in PER_IMAGE_KWARGS)),
+            _freeze(shared),
+        )
+
+    def _make_generators(self, num_images, seed, generator) -> List[torch.Generator]:
+        if generator is not None:
+            if isinstance(generator, (list, tuple)):
+                if len(generator) != num_images:
+                    raise ValueError(
+                        f"Expect {num_images} generators, got {len(generator)}"
+                    )
+                return list(generator)
+            # Draws the latents of the images one after another, as a single call does
+            return [generator] * num_images
+        if seed is None:
+            seed = torch.Generator(self.generator_device).seed()
+        return [
+            torch.Generator(self.generator_device).manual_seed(seed + i)
+            for i in range(num_images)
+        ]
+
+    async def submit(
+        self,
+        *,
+        num_images_per_prompt: int = 1,
+        seed: Optional[int] = None,
+        generator=None,
+        adapters: Optional[Dict[str, float]] = None,
+        **kwargs,
+    ):
+        """Runs a request in a batch, returns its part of the pipeline output.
+
+        `kwargs` are the kwargs of the pipeline call. Image `i` of a request with a `seed` is
+        generated by a generator seeded with `seed + i`. Tensor embeddings of N prompts, such as
+        `prompt_embeds`, give N * `num_images_per_prompt` images, as a single call does.
+        `adapters`, the LoRA adapters and their weights, are fused by `set_and_fuse_adapters`
+        before the batch runs. A batch without adapters, None or empty, unfuses those of the
+        previous batches, and runs with the adapters fused in the pipeline before the scheduler
+        otherwise.
+        """
+        if self._closed:
+            raise RuntimeError("The scheduler is closed")
+        if not kwargs.get("return_dict", True):
+            raise ValueError(
+                "The batched output is split by field, return_dict must be True"
+            )
+        for name in PER_IMAGE_KWARGS:
+            if isinstance(kwargs.get(name, None), list):
+                raise ValueError(f"Submit one request per {name}, got a list")
+        num_prompts = {
+            len(value)
+            for name, value in kwargs.items()
+            if _is_prompt_embeds(name, value)
+        }
+        if len(num_prompts) > 1:
+            raise ValueError(
+                f"Expect prompt embeddings of the same batch size, got {sorted(num_prompts)}"
+            )
+        num_images = num_images_per_prompt * (num_prompts.pop() if num_prompts else 1)
+        adapters = dict(adapters) if adapters else None
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = loop.create_task(self._dispatch_loop())
+
+        request = _Request(
+            kwargs=kwargs,
+            num_images=num_images,
+            generators=self._make_generators(num_images, seed, generator),
+            adapters=adapters,
+            future=loop.create_future(),
+            enqueue_time=time.perf_counter(),
+        )
+        key = self._group_key(kwargs, adapters)
+        self._pending.setdefault(key, []).append(request)
+        self._wakeup.set()
+        return await request.future
+
+    def _is_full(self, requests: List[_Request]) -> bool:
+        num_images = sum(r.num_images for r in requests)
+        return num_images >= self._get_max_images(requests[0].kwargs)
+
+    def _next_batch(self, now: float) -> Optional[List[_Request]]:
+        """Pops the requests of the next batch, or returns None if no group is ready."""
+        ready_key = None
+        for key, requests in self._pending.items():
+            if (
+                self._closed
+                or self._is_full(requests)
+                or now - requests[0].enqueue_time >= self.max_delay
+            ):
+                # The group waiting the longest first, the groups are in arrival order
+                if ready_key is None or (
+                    requests[0].enqueue_time < self._pending[ready_key][0].enqueue_time
+                ):
+                    ready_key = key
+        if ready_key is None:
+            return None
+
+        requests = self._pending[ready_key]
+        max_images = self._get_max_images(requests[0].kwargs)
+        batch, num_images = [], 0
+        while requests and (
+            len(batch) == 0 or num_images + requests[0].num_images <= max_images
+        ):
+            num_images += requests[0].num_images
+            batch.append(requests.pop(0))
+        if not requests:
+            del self._pending[ready_key]
+        return batch
+
+    def _next_deadline(self) -> Optional[float]:
+        if not self._pending:
+            return None
+        return (
+            min(requests[0].enqueue_time for requests in self._pending.values())
+            + self.max_delay
+        )
+
+    async def _dispatch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._closed or self._pending:
+            batch = self._next_batch(time.perf_counter())
+            if batch is None:
+                deadline = self._next_deadline()
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0.0, deadline - time.perf_counter())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            start = time.perf_counter()
+            for request in batch:
+                queue_seconds = start - request.enqueue_time
+                self._queue_seconds += queue_seconds
+                self._max_queue_seconds = max(self._max_queue_seconds, queue_seconds)
+                metrics.observe("onediffx_batch_queue_seconds", queue_seconds)
+            try:
+                outputs = await loop.run_in_executor(
+                    self._executor, self._run_batch, batch
+                )
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for request, output in zip(batch, outputs):
+                if not request.future.done():
+                    request.future.set_result(output)
+
+    def _pad_size(self, kwargs, num_images: int) -> int:
+        if not self.pad_batches:
+            return num_images
+        sizes = sorted(s for s in self._get_batch_sizes(kwargs) if s >= num_images)
+        return sizes[0] if sizes else num_images
+
+    def _run_batch(self, batch: List[_Request]) -> List[Any]:
+        adapters = batch[0].adapters
+        if adapters != self._active_adapters:
+            from onediffx.lora import set_and_fuse_adapters, unfuse_lora
+
+            if adapters is None:
+                unfuse_lora(self.pipe)
+            else:
+                set_and_fuse_adapters(
+                    self.pipe, list(adapters), list(adapters.values())
+                )
+            self._active_adapters = adapters
+
+        shared_kwargs = {
+            k: v for k, v in batch[0].kwargs.items() if k not in PER_IMAGE_KWARGS
+        }
+        # The requests of a batch share the embeddings, repeated to one row per image
+        embeds = {
+            k: shared_kwargs.pop(k)
+            for k, v in list(shared_kwargs.items())
+            if _is_prompt_embeds(k, v)
+        }
+        per_image_kwargs = collections.defaultdict(list)
+        per_image_embeds = collections.defaultdict(list)
+        generators = []
+        offsets = []
+        for request in batch:
+            begin = len(generators)
+            for name in PER_IMAGE_KWARGS:
+                if name in request.kwargs:
+                    per_image_kwargs[name] += [
+                        request.kwargs[name]
+                    ] * request.num_images
+            for name, value in embeds.items():
+                per_image_embeds[name].append(
+                    value.repeat_interleave(request.num_images // len(value), dim=0)
+                )
+            generators += request.generators
+            offsets.append((begin, len(generators)))
+
+        num_images = len(generators)
+        batch_size = self._pad_size(shared_kwargs, num_images)
+        num_padded = batch_size - num_images
+        if num_padded > 0:
+            # Copies of the last image, discarded
+            for values in per_image_kwargs.values():
+                values += values[-1:] * num_padded
+            for values in per_image_embeds.values():
+                values.append(values[-1][-1:].expand(num_padded, *values[-1].shape[1:]))
+            generators += [
+                torch.Generator(self.generator_device).manual_seed(i)
+                for i in range(num_padded)
+            ]
+
+        output = self.pipe(
+            **shared_kwargs,
+            **per_image_kwargs,
+            **{name: torch.cat(values) for name, values in per_image_embeds.items()},
+            num_images_per_prompt=1,
+            generator=generators,
+        )
+        outputs = _split_output(output, offsets, batch_size)
+
+        self._num_batches += 1
+        self._num_requests += len(batch)
+        self._num_images += num_images
+        self._num_padded_images += num_padded
+        metrics.observe("onediffx_batch_size", num_images)
+        metrics.inc("onediffx_batch_requests_total", len(batch))
+        if num_padded > 0:
+            metrics.inc("onediffx_batch_padded_images_total", num_padded)
+        logger.debug(
+            f"Ran a batch of {len(batch)} requests, {num_images} images padded to {batch_size}"
+        )
+        return outputs
+
+    async def close(self) -> None:
+        """Runs the queued requests and stops the scheduler."""
+        self._closed = True
+        if self._dispatcher is not None:
+            self._wakeup.set()
+            await self._dispatcher
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self._num_batches,
+            "requests": self._num_requests,
+            "images": self._num_images,
+            "padded_images": self._num_padded_images,
+            "pending_requests": sum(len(r) for r in self._pending.values()),
+            "mean_batch_size": self._num_images / max(1, self._num_batches),
+            "mean_queue_seconds": self._queue_seconds / max(1, self._num_requests),
+            "max_queue_seconds": self._max_queue_seconds,
+        }
@@ -1,13 +1,38 @@
+import io
+import os
+import threading
 import warnings
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
 
 import numpy as np
 import PIL.Image
 import torch
 from diffusers.image_processor import VaeImageProcessor
 from diffusers.utils import deprecate
+from onediff.utils import parse_integer_from_env
 from PIL import Image
 
+# Images converted or encoded per call below which the thread pool isn't worth it
+_MIN_PARALLEL_IMAGES = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """The threads converting and encoding images, ONEDIFFX_IMAGE_WORKERS of them."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            max_workers = parse_integer_from_env(
+                "ONEDIFFX_IMAGE_WORKERS", min(8, os.cpu_count() or 1)
+            )
+            _executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="onediffx_image"
+            )
+        return _executor
+
 
 def patch_image_prcessor(processor):
     if type(processor) is VaeImageProcessor:
@@ -46,19 +71,15 @@ def postprocess(
     if do_denormalize is None:
         do_denormalize = [self.config.do_normalize] * image.shape[0]
 
-    image = torch.stack(
-        [
-            self.denormalize(image[i]) if do_denormalize[i] else image[i]
-            for i in range(image.shape[0])
-        ]
-    )
+    if output_type == "pil":
+        # Denormalized and quantized on the device, only uint8 is copied to the host
+        return _uint8_to_pil(_pt_to_uint8(image, do_denormalize))
+
+    image = _denormalize(image, do_denormalize)
 
     if output_type == "pt":
         return image
 
-    if output_type == "pil":
-        return self.pt_to_pil(image)
-
     image = self.pt_to_numpy(image)
 
     if output_type == "np":
@@ -68,6 +89,35 @@ def postprocess(
     #     return self.numpy_to_pil(image)
 
 
+def _denormalize(images: torch.Tensor, do_denormalize: List[bool]) -> torch.Tensor:
+    """Denormalizes the images whose `do_denormalize` is True, in one op for the batch."""
+    if not any(do_denormalize):
+        return images
+    denormalized = (images / 2 + 0.5).clamp(0, 1)
+    if all(do_denormalize):
+        return denormalized
+    mask = torch.tensor(do_denormalize, device=images.device).view(-1, 1, 1, 1)
+    return torch.where(mask, denormalized, images)
+
+
+def _pt_to_uint8(images: torch.Tensor, do_denormalize: List[bool]) -> np.ndarray:
+    """Returns the NHWC uint8 images, a quarter of the bytes of float32 to copy."""
+    images = _denormalize(images.float(), do_denormalize)
+    return _pt_to_pil_pre(images).numpy()
+
+
+def _uint8_to_pil(images: np.ndarray) -> List[PIL.Image.Image]:
+    def convert(image):
+        if image.shape[-1] == 1:
+            # special case for grayscale (single channel) images
+            return Image.fromarray(image.squeeze(), mode="L")
+        return Image.fromarray(image)
+
+    if len(images) < _MIN_PARALLEL_IMAGES:
+        return [convert(image) for image in images]
+    return list(_get_executor().map(convert, images))
+
+
 @torch.jit.script
 def _pt_to_numpy_pre(images):
     return images.permute(0, 2, 3, 1).contiguous().float().cpu()
@@ -104,10 +154,42 @@ def pt_to_pil(images: np.ndarray) -> PIL.Image.Image:
         images = images[None, ...]
     # images = (images * 255).round().astype("uint8")
     images = _pt_to_pil_pre(images).numpy()
-    if images.shape[-1] == 1:
-        # special case for grayscale (single channel) images
-        pil_images = [Image.fromarray(image.squeeze(), mode="L") for image in images]
-    else:
-        pil_images = [Image.fromarray(image) for image in images]
+    return _uint8_to_pil(images)
 
-    return pil_images
+
+def _encode_image(image: PIL.Image.Image, format: str, save_kwargs) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **save_kwargs)
+    return buffer.getvalue()
+
+
+def iter_encoded_images(
+    images: List[PIL.Image.Image], format: str = "PNG", **save_kwargs
+) -> Iterator[bytes]:
+    """Encodes the images on the thread pool, yields each in order as soon as it's encoded.
+
+    `save_kwargs` are passed to `PIL.Image.Image.save`, e.g. `quality=90` for WEBP or JPEG.
+    The encoders of PIL release the GIL, so the images are encoded in parallel.
+    """
+    if len(images) < _MIN_PARALLEL_IMAGES:
+        for image in images:
+            yield _encode_image(image, format, save_kwargs)
+        return
+    executor = _get_executor()
+    futures = [
+        executor.submit(_encode_image, image, format, save_kwargs) for image in images
+    ]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # The consumer stopped early
+        for future in futures:
+            future.cancel()
+
+
+def encode_images(
+    images: List[PIL.Image.Image], format: str = "PNG", **save_kwargs
+) -> List[bytes]:
+    """Encodes the images on the thread pool, see iter_encoded_images."""
+    return list(iter_encoded_images(images, format, **save_kwargs))
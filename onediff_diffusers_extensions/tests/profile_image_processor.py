@@ -0,0 +1,81 @@
+"""Profiles post-processing decoded images to encoded files on the CPU.
+
+Compares the stock VaeImageProcessor, which denormalizes per image and converts to PIL on the
+calling thread, followed by encoding the images one after another, with the patched processor,
+which denormalizes and quantizes the batch at once and converts and encodes on a thread pool.
+
+    python3 tests/profile_image_processor.py --batch-size 8 --size 1024 --format PNG
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+import torch
+from diffusers.image_processor import VaeImageProcessor
+from onediffx.utils.patch_image_processor import (
+    encode_images,
+    iter_encoded_images,
+    patch_image_prcessor,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch-size", type=int, default=8)
+parser.add_argument("--size", type=int, default=1024)
+parser.add_argument("--format", type=str, default="PNG")
+parser.add_argument("--repeat", type=int, default=3)
+args = parser.parse_args()
+
+
+def stock_encode(images):
+    files = []
+    for image in images:
+        buffer = io.BytesIO()
+        image.save(buffer, format=args.format)
+        files.append(buffer.getvalue())
+    return files
+
+
+def profile(name, fn):
+    fn()
+    costs = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fn()
+        costs.append(time.perf_counter() - start)
+    print(f"{name:<32} mean {sum(costs) / len(costs) * 1000:8.2f} ms")
+
+
+torch.manual_seed(0)
+decoded = torch.randn(args.batch_size, 3, args.size, args.size).clamp(-1, 1)
+stock_processor = VaeImageProcessor()
+patched_processor = VaeImageProcessor()
+patch_image_prcessor(patched_processor)
+print(f"batch {args.batch_size}, {args.size}x{args.size}, {args.format}")
+
+profile("stock postprocess", lambda: stock_processor.postprocess(decoded))
+profile("patched postprocess", lambda: patched_processor.postprocess(decoded))
+
+stock_images = stock_processor.postprocess(decoded)
+patched_images = patched_processor.postprocess(decoded)
+profile("stock encode", lambda: stock_encode(stock_images))
+profile("parallel encode", lambda: encode_images(patched_images, args.format))
+profile(
+    "stock postprocess + encode",
+    lambda: stock_encode(stock_processor.postprocess(decoded)),
+)
+profile(
+    "patched postprocess + encode",
+    lambda: encode_images(patched_processor.postprocess(decoded), args.format),
+)
+
+start = time.perf_counter()
+next(iter_encoded_images(patched_images, args.format))
+print(f"first streamed image after {(time.perf_counter() - start) * 1000:.2f} ms")
+
+max_error = max(
+    np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)).max()
+    for a, b in zip(stock_images, patched_images)
+)
+print(f"Max abs difference of the pixels: {max_error}")
@@ -0,0 +1,109 @@
+"""Profiles switching LoRA adapters on a synthetic UNet-shaped model on the CPU.
+
+Compares the per-layer `_set_adapter`, which unfuses and refuses every adapter of every layer,
+with the batched LoRAFusionEngine, without and with the cache of fused deltas.
+
+    python3 tests/profile_lora_fusion.py --scale 0.5 --rank 32
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+from onediffx.lora.fusion_engine import LoRAFusionEngine
+from onediffx.lora.utils import _set_adapter, fuse_lora
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--scale", type=float, default=0.25)
+parser.add_argument("--rank", type=int, default=32)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--cache-bytes", type=int, default=1 << 32)
+parser.add_argument("--tolerance", type=float, default=1e-4)
+args = parser.parse_args()
+
+# Channels and number of transformer blocks of the SDXL UNet levels
+LEVELS = [(320, 0), (640, 2), (1280, 10)]
+ADAPTERS = ["style", "detail", "character"]
+
+
+def make_unet(scale: float) -> torch.nn.Module:
+    layers = torch.nn.ModuleList()
+    for channels, num_blocks in LEVELS:
+        c = max(8, int(channels * scale))
+        for _ in range(2):
+            layers.append(torch.nn.Conv2d(c, c, 3, padding=1))
+        for _ in range(num_blocks):
+            # q, k, v, out of self and cross attention, and the feed forward
+            layers.extend(torch.nn.Linear(c, c, bias=False) for _ in range(8))
+            layers.append(torch.nn.Linear(c, 8 * c))
+            layers.append(torch.nn.Linear(4 * c, c))
+    return layers
+
+
+def make_pipeline(unet: torch.nn.Module):
+    torch.manual_seed(0)
+    for layer in unet:
+        for adapter in ADAPTERS:
+            if isinstance(layer, torch.nn.Conv2d):
+                up = torch.randn(layer.out_channels, args.rank, 1, 1) * 1e-2
+                down = torch.randn(args.rank, *layer.weight.shape[1:]) * 1e-2
+            else:
+                up = torch.randn(layer.out_features, args.rank) * 1e-2
+                down = torch.randn(args.rank, layer.in_features) * 1e-2
+            fuse_lora(
+                layer,
+                {"lora.up.weight": up, "lora.down.weight": down},
+                rank=args.rank,
+                adapter_name=adapter,
+            )
+    return SimpleNamespace(unet=unet)
+
+
+def set_adapters_per_layer(pipeline, adapter_names, adapter_weights):
+    for layer in pipeline.unet:
+        _set_adapter(layer, adapter_names, adapter_weights)
+
+
+def profile(name, set_adapters, pipeline, configs):
+    costs = []
+    for _ in range(args.repeat):
+        for adapter_names, adapter_weights in configs:
+            start = time.perf_counter()
+            set_adapters(pipeline, adapter_names, adapter_weights)
+            costs.append(time.perf_counter() - start)
+    print(
+        f"{name:<28} mean {sum(costs) / len(costs) * 1000:8.2f} ms, max {max(costs) * 1000:8.2f} ms"
+    )
+
+
+configs = [
+    (["style", "detail"], [1.0, 0.5]),
+    (["style", "detail"], [1.0, 0.8]),
+    (["character"], [1.0]),
+    (["style", "detail", "character"], [1.0, 0.5, 0.7]),
+]
+
+pipelines = [make_pipeline(make_unet(args.scale)) for _ in range(3)]
+unet = pipelines[0].unet
+num_params = sum(p.numel() for p in unet.parameters())
+print(f"{len(unet)} LoRA layers, {num_params / 1e6:.1f}M parameters, rank {args.rank}")
+
+profile("per-layer _set_adapter", set_adapters_per_layer, pipelines[0], configs)
+profile("batched", LoRAFusionEngine().set_adapters, pipelines[1], configs)
+profile(
+    "batched with delta cache",
+    LoRAFusionEngine(max_cache_bytes=args.cache_bytes).set_adapters,
+    pipelines[2],
+    configs,
+)
+
+max_error = max(
+    (a.weight - b.weight).abs().max().item()
+    for pipeline in pipelines[1:]
+    for a, b in zip(pipelines[0].unet, pipeline.unet)
+)
+print(f"Max abs difference of the fused weights: {max_error:.2e}")
+assert (
+    max_error < args.tolerance
+), f"The batched fused weights differ from _set_adapter by {max_error:.2e}"
@@ -0,0 +1,98 @@
+"""Profiles remapping LoRA keys and matching their alphas on generated SDXL-scale key sets.
+
+Asserts that the time per key stays flat as the number of keys grows, i.e. linear scaling.
+
+    python3 tests/profile_lora_key_index.py --max-scale 16
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+from onediffx.lora.key_index import map_network_alphas, parse_lora_key, remap_sgm_keys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--max-scale", type=int, default=16)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--tolerance", type=float, default=3.0)
+args = parser.parse_args()
+
+UNET_CONFIG = SimpleNamespace(layers_per_block=2)
+ATTENTION_LAYERS = [
+    f"attn{i}_{proj}" for i in (1, 2) for proj in ("to_q", "to_k", "to_v", "to_out_0")
+] + ["ff_net_0_proj", "ff_net_2"]
+
+
+def generate_sgm_keys(scale: int):
+    """The keys of a kohya LoRA of the SDXL UNet, with `scale` times the transformer blocks."""
+    layers = []
+    for block, num_transformers in [(4, 2), (5, 2), (7, 10), (8, 10)]:
+        layers.append((f"input_blocks_{block}_1", num_transformers))
+    layers.append(("middle_block_1", 10))
+    for block in range(6):
+        layers.append((f"output_blocks_{block}_1", 10 if block < 3 else 2))
+
+    keys = []
+    for prefix, num_transformers in layers:
+        for t in range(num_transformers * scale):
+            for layer in ATTENTION_LAYERS:
+                name = f"lora_unet_{prefix}_transformer_blocks_{t}_{layer}"
+                keys += [f"{name}.lora_down.weight", f"{name}.lora_up.weight"]
+    return keys
+
+
+def generate_diffusers_keys(scale: int):
+    """The keys and alphas of a diffusers LoRA of the SDXL UNet."""
+    keys, network_alphas = [], {}
+    for block, num_transformers in [("down_blocks.1", 2), ("down_blocks.2", 10)] + [
+        ("mid_block", 10),
+        ("up_blocks.0", 10),
+        ("up_blocks.1", 2),
+    ]:
+        for a in range(2):
+            for t in range(num_transformers * scale):
+                for i in (1, 2):
+                    for proj in ("to_q", "to_k", "to_v", "to_out.0"):
+                        name = f"{block}.attentions.{a}.transformer_blocks.{t}.attn{i}.{proj}"
+                        keys += [f"{name}.lora.down.weight", f"{name}.lora.up.weight"]
+                        network_alphas[f"{name}.alpha"] = 8.0
+    return keys, network_alphas
+
+
+def best_time(fn):
+    costs = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fn()
+        costs.append(time.perf_counter() - start)
+    return min(costs)
+
+
+def profile(name, generate, fn):
+    per_key_costs = {}
+    scale = 1
+    while scale <= args.max_scale:
+        data = generate(scale)
+        num_keys = len(data[0]) if isinstance(data, tuple) else len(data)
+        cost = best_time(lambda: fn(data))
+        per_key_costs[scale] = cost / num_keys
+        print(
+            f"{name:<20} {num_keys:>8} keys {cost * 1000:10.2f} ms {per_key_costs[scale] * 1e6:8.3f} us/key"
+        )
+        scale *= 2
+    growth = per_key_costs[max(per_key_costs)] / per_key_costs[1]
+    assert (
+        growth < args.tolerance
+    ), f"{name} is not linear, the time per key grows {growth:.1f}x"
+
+
+profile(
+    "remap_sgm_keys",
+    generate_sgm_keys,
+    lambda keys: remap_sgm_keys(keys, UNET_CONFIG.layers_per_block),
+)
+profile(
+    "map_network_alphas",
+    generate_diffusers_keys,
+    lambda data: map_network_alphas([parse_lora_key(k) for k in data[0]], data[1]),
+)
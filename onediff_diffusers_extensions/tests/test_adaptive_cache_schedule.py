@@ -0,0 +1,64 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+# onediffx.deep_cache imports the oneflow backend
+pytest.importorskip("oneflow")
+
+from onediffx.deep_cache.adaptive_schedule import AdaptiveCacheSchedule  # usort: skip
+
+
+def _run(schedule, values):
+    """Runs one request whose noise predictions and features of step i are all values[i]."""
+    for i, value in enumerate(values):
+        is_full_step = schedule.is_full_step(i)
+        output = torch.full((4,), float(value))
+        schedule.update(i, is_full_step, output, [output])
+    return schedule.full_step_ids
+
+
+def test_adaptive_cache_schedule_max_interval():
+    schedule = AdaptiveCacheSchedule(threshold=0.1, max_interval=3)
+    assert _run(schedule, [1.0] * 10) == [0, 3, 6, 9]
+    assert schedule.stats()["max_drift"] == 0.0
+
+
+def test_adaptive_cache_schedule_min_interval():
+    # Every step drifts over the threshold
+    schedule = AdaptiveCacheSchedule(threshold=0.1, min_interval=2, max_interval=5)
+    assert _run(schedule, range(1, 11)) == [0, 2, 4, 6, 8]
+
+
+def test_adaptive_cache_schedule_max_full_steps():
+    schedule = AdaptiveCacheSchedule(threshold=0.1, max_interval=2, max_full_steps=3)
+    assert _run(schedule, [1.0] * 10) == [0, 2, 4]
+    assert schedule.stats()["steps"] == 10
+
+
+def test_adaptive_cache_schedule_noise_pred_threshold():
+    schedule = AdaptiveCacheSchedule(threshold=0.15, max_interval=10)
+    values = [1.0, 1.05, 1.1, 1.2] + [1.2] * 6
+    # The drift of step 3 is the first one over the threshold
+    assert _run(schedule, values) == [0, 4]
+    assert schedule.drifts[:3] == pytest.approx([0.05, 0.1, 0.2], abs=1e-6)
+
+
+def test_adaptive_cache_schedule_features_threshold():
+    schedule = AdaptiveCacheSchedule(threshold=0.15, max_interval=4, metric="features")
+    values = [1.0 + 0.1 * i for i in range(10)]
+    # No drift rate before the second full step, then it is extrapolated from the last two
+    assert _run(schedule, values) == [0, 4, 6, 9]
+    assert schedule.drifts == pytest.approx([0.4, 0.2 / 1.4, 0.3 / 1.6], abs=1e-6)
+
+
+def test_adaptive_cache_schedule_resets_at_the_first_step():
+    schedule = AdaptiveCacheSchedule(threshold=0.1, max_interval=3)
+    _run(schedule, [1.0] * 10)
+    first_stats = schedule.stats()
+    assert _run(schedule, [1.0] * 10) == [0, 3, 6, 9]
+    assert schedule.stats() == first_stats
+
+    # An interrupted request does not leak into the next one
+    _run(schedule, [1.0] * 2)
+    assert schedule.stats()["steps"] == 2
+    assert schedule.full_step_ids == [0]
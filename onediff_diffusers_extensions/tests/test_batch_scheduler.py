@@ -0,0 +1,162 @@
+import asyncio
+import dataclasses
+import sys
+import types
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+from onediffx.serving import BatchScheduler
+
+
+@dataclasses.dataclass
+class FakeOutput(OrderedDict):
+    """As diffusers.utils.BaseOutput, only the fields that are not None are items."""
+
+    images: List[str]
+    nsfw_content_detected: Optional[List[bool]] = None
+
+    def __post_init__(self):
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            if value is not None:
+                self[field.name] = value
+
+
+class FakePipeline:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompt, generator, height=512, **kwargs):
+        assert len(prompt) == len(generator)
+        self.calls.append((height, len(prompt)))
+        images = [f"{p}-{g.initial_seed()}" for p, g in zip(prompt, generator)]
+        nsfw_content_detected = None
+        if kwargs.get("safety_checker", False):
+            nsfw_content_detected = [p.startswith("nsfw") for p in prompt]
+        return FakeOutput(images=images, nsfw_content_detected=nsfw_content_detected)
+
+
+async def _submit_all(scheduler, requests):
+    outputs = await asyncio.gather(*[scheduler.submit(**r) for r in requests])
+    await scheduler.close()
+    return outputs
+
+
+def test_batch_scheduler_groups_compatible_requests():
+    pipe = FakePipeline()
+    scheduler = BatchScheduler(pipe, max_batch_size=8, max_delay=0.05)
+    requests = [
+        dict(prompt=f"p{i}", height=512 if i % 2 else 768, seed=i * 10)
+        for i in range(6)
+    ]
+    requests[1]["num_images_per_prompt"] = 2
+    outputs = asyncio.run(_submit_all(scheduler, requests))
+
+    assert sorted(pipe.calls) == [(512, 4), (768, 3)]
+    assert outputs[0]["images"] == ["p0-0"]
+    assert outputs[1]["images"] == ["p1-10", "p1-11"]
+    assert outputs[5]["images"] == ["p5-50"]
+    stats = scheduler.stats()
+    assert (stats["batches"], stats["requests"], stats["images"]) == (2, 6, 7)
+
+
+def test_batch_scheduler_pads_to_precompiled_batch_sizes():
+    pipe = FakePipeline()
+    scheduler = BatchScheduler(pipe, max_delay=0.05, batch_sizes=[1, 2, 4])
+    requests = [dict(prompt=f"p{i}", seed=i) for i in range(7)]
+    outputs = asyncio.run(_submit_all(scheduler, requests))
+
+    # Batches are closed at 4 images, the remaining 3 are padded to 4
+    assert pipe.calls == [(512, 4), (512, 4)]
+    assert [o["images"] for o in outputs] == [[f"p{i}-{i}"] for i in range(7)]
+    assert scheduler.stats()["padded_images"] == 1
+
+
+def test_batch_scheduler_splits_outputs_with_none_fields():
+    pipe = FakePipeline()
+    scheduler = BatchScheduler(pipe, max_delay=0.05)
+    requests = [dict(prompt=f"p{i}", seed=i) for i in range(2)]
+    requests += [dict(prompt=p, seed=0, safety_checker=True) for p in ("nsfw", "p")]
+    outputs = asyncio.run(_submit_all(scheduler, requests))
+
+    assert [o.images for o in outputs] == [["p0-0"], ["p1-1"], ["nsfw-0"], ["p-0"]]
+    assert outputs[0].nsfw_content_detected is None
+    assert "nsfw_content_detected" not in outputs[0]
+    assert [o.nsfw_content_detected for o in outputs[2:]] == [[True], [False]]
+
+
+class FakeEmbedsPipeline(FakePipeline):
+    def __call__(self, prompt_embeds, generator, num_images_per_prompt=1, **kwargs):
+        # As diffusers, one generator per image of the effective batch
+        assert len(generator) == len(prompt_embeds) * num_images_per_prompt
+        self.calls.append(len(generator))
+        images = prompt_embeds.repeat_interleave(num_images_per_prompt, dim=0)
+        return FakeOutput(
+            images=[f"{int(e)}-{g.initial_seed()}" for e, g in zip(images, generator)]
+        )
+
+
+def test_batch_scheduler_repeats_prompt_embeds_per_image():
+    pipe = FakeEmbedsPipeline()
+    scheduler = BatchScheduler(pipe, max_delay=0.05, batch_sizes=[8])
+    prompt_embeds = torch.tensor([1, 2])
+    requests = [
+        dict(prompt_embeds=prompt_embeds, num_images_per_prompt=2, seed=0),
+        dict(prompt_embeds=prompt_embeds, seed=10),
+    ]
+    outputs = asyncio.run(_submit_all(scheduler, requests))
+
+    # 2 prompts of 2 and 1 images, padded to 8
+    assert pipe.calls == [8]
+    assert outputs[0]["images"] == ["1-0", "1-1", "2-2", "2-3"]
+    assert outputs[1]["images"] == ["1-10", "2-11"]
+    assert scheduler.stats()["images"] == 6
+
+
+class FakeLoRAPipeline(FakePipeline):
+    def __init__(self):
+        super().__init__()
+        self.fused = {}
+        self.adapter_calls = []
+
+    def __call__(self, prompt, generator, height=512, **kwargs):
+        self.calls.append(dict(self.fused))
+        return FakeOutput(images=list(prompt))
+
+
+def _fake_lora_module():
+    def set_and_fuse_adapters(pipe, adapter_names, adapter_weights):
+        pipe.adapter_calls.append(("fuse", adapter_names, adapter_weights))
+        pipe.fused = dict(zip(adapter_names, adapter_weights))
+
+    def unfuse_lora(pipe):
+        pipe.adapter_calls.append(("unfuse",))
+        pipe.fused = {}
+
+    module = types.ModuleType("onediffx.lora")
+    module.set_and_fuse_adapters = set_and_fuse_adapters
+    module.unfuse_lora = unfuse_lora
+    return module
+
+
+def test_batch_scheduler_unfuses_adapters_for_batches_without_them(monkeypatch):
+    monkeypatch.setitem(sys.modules, "onediffx.lora", _fake_lora_module())
+    pipe = FakeLoRAPipeline()
+    scheduler = BatchScheduler(pipe, max_delay=0.0)
+
+    async def submit_in_order(adapters_list):
+        for adapters in adapters_list:
+            await scheduler.submit(prompt="p", seed=0, adapters=adapters)
+        await scheduler.close()
+
+    adapters_list = [None, {"a": 1.0}, None, {}, {"b": 0.5}, {"b": 0.5}, {}]
+    asyncio.run(submit_in_order(adapters_list))
+
+    assert pipe.adapter_calls == [
+        ("fuse", ["a"], [1.0]),
+        ("unfuse",),
+        ("fuse", ["b"], [0.5]),
+        ("unfuse",),
+    ]
+    assert pipe.calls == [{}, {"a": 1.0}, {}, {}, {"b": 0.5}, {"b": 0.5}, {}]
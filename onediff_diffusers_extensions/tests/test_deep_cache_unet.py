@@ -0,0 +1,120 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+# onediffx.deep_cache imports the oneflow backend
+pytest.importorskip("oneflow")
+
+from onediffx.deep_cache import DeepCacheUNet  # usort: skip
+
+
+class StubConfig:
+    sample_size = 64
+
+
+class StubUNet(torch.nn.Module):
+    """Returns the prompt as the features, and records the prompt and the cached features."""
+
+    def __init__(self):
+        super().__init__()
+        self.config = StubConfig()
+        self.calls = []
+
+    def forward(
+        self,
+        sample,
+        timestep,
+        encoder_hidden_states,
+        return_dict=True,
+        replicate_prv_feature=None,
+        **kwargs,
+    ):
+        self.calls.append((int(timestep), encoder_hidden_states, replicate_prv_feature))
+        return sample, encoder_hidden_states
+
+
+class StubScheduler:
+    def __init__(self):
+        self.timesteps = None
+        self.step_index = None
+
+    def set_timesteps(self, num_inference_steps):
+        self.timesteps = torch.arange(num_inference_steps, 0, -1) * 100
+        self.step_index = None
+
+    def step(self):
+        self.step_index = 1 if self.step_index is None else self.step_index + 1
+
+
+class StubSchedulerWithoutStepIndex:
+    def set_timesteps(self, num_inference_steps):
+        self.timesteps = torch.arange(num_inference_steps, 0, -1) * 100
+
+    def step(self):
+        pass
+
+
+class StubPipeline:
+    def __init__(self, scheduler, cache_interval=3):
+        self.scheduler = scheduler
+        self.fast_unet = StubUNet()
+        self.full_unet = StubUNet()
+        self.unet = DeepCacheUNet(self, self.full_unet, cache_interval=cache_interval)
+
+    def __call__(self, prompts, num_inference_steps, num_finished_steps=None):
+        """Calls the UNet once per prompt at each step, as classifier free guidance without batching."""
+        self.scheduler.set_timesteps(num_inference_steps)
+        for i, t in enumerate(self.scheduler.timesteps):
+            for prompt in prompts:
+                self.unet(torch.zeros(1), t, prompt, return_dict=False)
+            if i == num_finished_steps:
+                # Interrupted before the scheduler step
+                return
+            self.scheduler.step()
+
+
+@pytest.mark.parametrize(
+    "scheduler_cls", [StubScheduler, StubSchedulerWithoutStepIndex]
+)
+def test_deep_cache_unet_cache_interval(scheduler_cls):
+    pipe = StubPipeline(scheduler_cls(), cache_interval=3)
+    pipe(["a"], 7)
+
+    # The first step is full, then every third step
+    assert [call[0] for call in pipe.full_unet.calls] == [700, 400, 100]
+    assert pipe.fast_unet.calls == [
+        (600, "a", "a"),
+        (500, "a", "a"),
+        (300, "a", "a"),
+        (200, "a", "a"),
+    ]
+    assert (pipe.unet.num_full_calls, pipe.unet.num_cached_calls) == (3, 4)
+
+
+def test_deep_cache_unet_calls_of_classifier_free_guidance():
+    pipe = StubPipeline(StubScheduler(), cache_interval=2)
+    pipe(["uncond", "cond"], 3)
+
+    assert pipe.full_unet.calls == [
+        (300, "uncond", None),
+        (300, "cond", None),
+        (100, "uncond", None),
+        (100, "cond", None),
+    ]
+    # Each call of a cached step gets the features of the same call of the full step
+    assert pipe.fast_unet.calls == [(200, "uncond", "uncond"), (200, "cond", "cond")]
+
+
+@pytest.mark.parametrize(
+    "scheduler_cls", [StubScheduler, StubSchedulerWithoutStepIndex]
+)
+@pytest.mark.parametrize("num_finished_steps", [None, 0])
+def test_deep_cache_unet_resets_between_requests(scheduler_cls, num_finished_steps):
+    pipe = StubPipeline(scheduler_cls(), cache_interval=3)
+    # A request of one step, or one interrupted at its first step
+    pipe(["a"], 1 if num_finished_steps is None else 5, num_finished_steps)
+    pipe(["b"], 3)
+
+    assert [call[1] for call in pipe.full_unet.calls] == ["a", "b"]
+    assert pipe.fast_unet.calls == [(200, "b", "b"), (100, "b", "b")]
+    assert (pipe.unet.num_full_calls, pipe.unet.num_cached_calls) == (1, 2)
@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+# onediffx.lora imports the oneflow backend
+pytest.importorskip("oneflow")
+
+from onediffx.lora.fusion_engine import LoRAFusionEngine  # usort: skip
+from onediffx.lora.utils import _delete_adapter, _set_adapter, _unfuse_lora, fuse_lora
+
+RANK = 2
+ADAPTERS = ["style", "detail", "character"]
+
+
+def _make_unet():
+    torch.manual_seed(0)
+    # Two layers of the same shapes are fused in one batch
+    return torch.nn.ModuleList(
+        [
+            torch.nn.Linear(8, 6),
+            torch.nn.Linear(8, 6),
+            torch.nn.Linear(6, 4, bias=False),
+            torch.nn.Conv2d(4, 6, 3, padding=1),
+        ]
+    )
+
+
+def _lora_state_dict(layer, seed):
+    generator = torch.Generator().manual_seed(seed)
+    if isinstance(layer, torch.nn.Conv2d):
+        up = torch.randn(layer.out_channels, RANK, 1, 1, generator=generator)
+        down = torch.randn(RANK, *layer.weight.shape[1:], generator=generator)
+    else:
+        up = torch.randn(layer.out_features, RANK, generator=generator)
+        down = torch.randn(RANK, layer.in_features, generator=generator)
+    return {"lora.up.weight": up * 0.1, "lora.down.weight": down * 0.1}
+
+
+def _load_adapter(layer, index, adapter, seed=0):
+    fuse_lora(
+        layer,
+        _lora_state_dict(layer, seed * 100 + index * 10 + ADAPTERS.index(adapter)),
+        rank=RANK,
+        alpha=RANK * 2,
+        adapter_name=adapter,
+    )
+
+
+def _make_pipeline():
+    unet = _make_unet()
+    for i, layer in enumerate(unet):
+        # The conv layer has no "character" adapter
+        adapters = ADAPTERS[:2] if isinstance(layer, torch.nn.Conv2d) else ADAPTERS
+        for adapter in adapters:
+            _load_adapter(layer, i, adapter)
+    return SimpleNamespace(unet=unet)
+
+
+def _set_adapters_per_layer(pipeline, adapter_names, adapter_weights):
+    for layer in pipeline.unet:
+        _set_adapter(layer, adapter_names, adapter_weights)
+
+
+def _assert_same_layers(expected_pipeline, pipeline):
+    for expected, layer in zip(expected_pipeline.unet, pipeline.unet):
+        assert torch.allclose(layer.weight, expected.weight, atol=1e-5)
+        assert layer.active_adapter_names == expected.active_adapter_names
+        for adapter in layer.active_adapter_names:
+            assert layer.scaling[adapter] == pytest.approx(expected.scaling[adapter])
+
+
+CONFIGS = [
+    (["style", "detail"], [1.0, 0.5]),
+    # Switching scales
+    (["style", "detail"], [1.0, 0.8]),
+    # Adding and removing adapters
+    (["style", "detail", "character"], [1.0, 0.8, 0.7]),
+    (["character"], [0.7]),
+    # Back to a cached adapter set
+    (["style", "detail"], [1.0, 0.5]),
+    ([], []),
+]
+
+
+@pytest.mark.parametrize("max_cache_bytes", [0, 1 << 20])
+def test_fusion_engine_matches_set_adapter(max_cache_bytes):
+    expected, pipeline = _make_pipeline(), _make_pipeline()
+    engine = LoRAFusionEngine(max_cache_bytes=max_cache_bytes)
+
+    for adapter_names, adapter_weights in CONFIGS:
+        _set_adapters_per_layer(expected, adapter_names, adapter_weights)
+        engine.set_adapters(pipeline, adapter_names, adapter_weights)
+        _assert_same_layers(expected, pipeline)
+
+    stats = engine.cache_stats()
+    if max_cache_bytes > 0:
+        assert stats["hits"] == 1
+        assert stats["entries"] == 4
+    else:
+        assert stats["entries"] == 0
+
+
+@pytest.mark.parametrize("max_cache_bytes", [0, 1 << 20])
+def test_fusion_engine_unfuses_to_the_base_weights(max_cache_bytes):
+    base = _make_unet()
+    pipeline = _make_pipeline()
+    engine = LoRAFusionEngine(max_cache_bytes=max_cache_bytes)
+
+    for adapter_names, adapter_weights in CONFIGS[:-1]:
+        engine.set_adapters(pipeline, adapter_names, adapter_weights)
+    # The LoRA infos are kept up to date, so a layer can be unfused on its own
+    for layer in pipeline.unet:
+        _unfuse_lora(layer)
+    for expected, layer in zip(base, pipeline.unet):
+        assert torch.allclose(layer.weight, expected.weight, atol=1e-5)
+
+    engine.set_adapters(pipeline, ["style", "detail"], [1.0, 0.5])
+    engine.set_adapters(pipeline, [], [])
+    for expected, layer in zip(base, pipeline.unet):
+        assert layer.active_adapter_names == {}
+        assert torch.allclose(layer.weight, expected.weight, atol=1e-5)
+
+
+def test_fusion_engine_invalidates_a_reloaded_adapter():
+    expected, pipeline = _make_pipeline(), _make_pipeline()
+    engine = LoRAFusionEngine(max_cache_bytes=1 << 20)
+    engine.set_adapters(pipeline, ["style", "detail"], [1.0, 0.5])
+    engine.set_adapters(pipeline, ["character"], [1.0])
+    _set_adapters_per_layer(expected, ["character"], [1.0])
+    assert engine.cache_stats()["entries"] == 2
+
+    # Reload "style" with other factors, as `delete_adapters` and `load_and_fuse_lora` do
+    engine.invalidate(["style"])
+    for reloaded in (expected, pipeline):
+        for i, layer in enumerate(reloaded.unet):
+            _delete_adapter(layer, ["style"])
+            _load_adapter(layer, i, "style", seed=1)
+    assert engine.cache_stats()["entries"] == 1
+
+    for adapter_names, adapter_weights in CONFIGS:
+        _set_adapters_per_layer(expected, adapter_names, adapter_weights)
+        engine.set_adapters(pipeline, adapter_names, adapter_weights)
+        _assert_same_layers(expected, pipeline)
@@ -0,0 +1,123 @@
+import os
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+safetensors_torch = pytest.importorskip("safetensors.torch")
+# onediffx.lora imports the oneflow backend
+pytest.importorskip("oneflow")
+
+from onediffx.lora import state_dict_cache  # usort: skip
+from onediffx.lora.state_dict_cache import LoRAStateDictCache
+
+KEY = "unet.down_blocks.0.attentions.0.proj_in.lora.down.weight"
+
+
+def _save_lora(tmp_path, name, value=1.0):
+    file_path = tmp_path / name
+    state_dict = {KEY: torch.full((4, 8), value)}
+    if file_path.suffix == ".safetensors":
+        safetensors_torch.save_file(state_dict, str(file_path))
+    else:
+        torch.save(state_dict, str(file_path))
+    return file_path
+
+
+def test_lora_cache_counts_hits_and_misses_once(tmp_path):
+    file_path = _save_lora(tmp_path, "lora.safetensors")
+    cache = LoRAStateDictCache()
+
+    cache.prefetch([str(file_path)])[str(file_path)].result()
+    cache.get(str(file_path))
+    cache.get(str(file_path))
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["prefetches"]) == (2, 0, 1)
+    # Memory-mapped tensors are not counted against the budget
+    assert stats["total_bytes"] == 0
+    assert stats["mapped_bytes"] == 4 * 8 * 4
+
+
+def test_lora_cache_leaves_pickled_objects_to_diffusers(monkeypatch, tmp_path):
+    file_path = _save_lora(tmp_path, "lora.bin")
+    calls = []
+
+    def fake_lora_state_dict(lora, **kwargs):
+        calls.append(lora)
+        return {KEY: torch.ones(4, 8)}, None
+
+    def reject(*args, **kwargs):
+        raise state_dict_cache.pickle.UnpicklingError("Unsupported global")
+
+    monkeypatch.setattr(state_dict_cache.torch, "load", reject)
+    monkeypatch.setattr(
+        state_dict_cache.LoraLoaderMixin, "lora_state_dict", fake_lora_state_dict
+    )
+    cache = LoRAStateDictCache()
+    cache.get(str(file_path))
+
+    # diffusers gets the path, and applies its own unpickling policy
+    assert calls == [str(file_path)]
+    assert cache.stats()["total_bytes"] == 4 * 8 * 4
+
+
+def _touch(file_path, seconds=10):
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10**9))
+
+
+def test_lora_cache_reloads_rewritten_files(tmp_path):
+    file_path = _save_lora(tmp_path, "lora.safetensors")
+    cache = LoRAStateDictCache()
+    state_dict, _ = cache.get(str(file_path))
+    assert torch.all(state_dict[KEY] == 1.0)
+
+    _save_lora(tmp_path, "lora.safetensors", value=2.0)
+    _touch(file_path)
+    state_dict, _ = cache.get(str(file_path))
+    assert torch.all(state_dict[KEY] == 2.0)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (0, 2, 1)
+
+
+def test_lora_cache_keeps_touched_files_with_the_same_hash(tmp_path):
+    file_path = _save_lora(tmp_path, "lora.safetensors")
+    cache = LoRAStateDictCache(verify="hash")
+    cache.get(str(file_path))
+
+    _touch(file_path)
+    cache.get(str(file_path))
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (1, 1, 0)
+
+
+def test_lora_cache_get_waits_for_a_running_prefetch(monkeypatch, tmp_path):
+    file_path = _save_lora(tmp_path, "lora.safetensors")
+    cache = LoRAStateDictCache()
+    started, release = threading.Event(), threading.Event()
+    loads = []
+    load = LoRAStateDictCache._load
+
+    def slow_load(self, lora, kwargs):
+        loads.append(lora)
+        started.set()
+        assert release.wait(10)
+        return load(self, lora, kwargs)
+
+    monkeypatch.setattr(LoRAStateDictCache, "_load", slow_load)
+    future = cache.prefetch([str(file_path)])[str(file_path)]
+    assert started.wait(10)
+
+    results = []
+    getter = threading.Thread(target=lambda: results.append(cache.get(str(file_path))))
+    getter.start()
+    getter.join(0.1)
+    # Waiting for the prefetch, not loading the LoRA again
+    assert getter.is_alive()
+    release.set()
+    getter.join(10)
+    future.result()
+
+    assert loads == [str(file_path)]
+    assert torch.all(results[0][0][KEY] == 1.0)
+    assert cache.stats()["prefetches"] == 1
@@ -0,0 +1,112 @@
+import json
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from onediff.infer_compiler import DeployableModule  # usort: skip
+from onediffx.compilers.pipe_bundle import load_bundle, MANIFEST_FILE_NAME, save_bundle
+
+PARTS = ["unet", "vae"]
+
+
+class FakeGraph:
+    is_compiled = True
+
+
+class FakeDeployableModule(DeployableModule):
+    def __init__(self, torch_module):
+        super().__init__()
+        self._torch_module = torch_module
+        self._deployable_module_dpl_graph = FakeGraph()
+        self.loaded = []
+
+    def get_graph(self):
+        return self._deployable_module_dpl_graph
+
+    def save_graph(self, file_path):
+        with open(file_path, "wb") as f:
+            f.write(b"graph" * 16)
+
+    def load_graph(self, file_path, device=None, run_warmup=True):
+        self.loaded.append(file_path)
+
+    def forward(self, x):
+        return self._torch_module(x)
+
+
+class FakePipeline:
+    def __init__(self):
+        torch.manual_seed(0)
+        self.unet = FakeDeployableModule(torch.nn.Linear(4, 4))
+        self.vae = FakeDeployableModule(torch.nn.Linear(4, 2))
+
+
+def _save_and_reload(tmp_path, **kwargs):
+    save_bundle(FakePipeline(), str(tmp_path), PARTS, getattr)
+    pipe = FakePipeline()
+    skipped = load_bundle(pipe, str(tmp_path), PARTS, getattr, **kwargs)
+    return pipe, skipped
+
+
+def test_pipe_bundle_round_trip(tmp_path):
+    pipe, skipped = _save_and_reload(tmp_path)
+
+    assert skipped == {}
+    assert pipe.unet.loaded == [str(tmp_path / "unet")]
+    assert pipe.vae.loaded == [str(tmp_path / "vae")]
+    with open(tmp_path / MANIFEST_FILE_NAME) as f:
+        manifest = json.load(f)
+    assert set(manifest["parts"]) == set(PARTS)
+    assert manifest["parts"]["unet"]["size"] == 80
+
+
+def test_pipe_bundle_lazy_load(tmp_path):
+    pipe, skipped = _save_and_reload(tmp_path, lazy=True)
+
+    assert skipped == {}
+    assert pipe.unet.loaded == []
+    pipe.unet(torch.zeros(1, 4))
+    pipe.unet(torch.zeros(1, 4))
+    assert pipe.unet.loaded == [str(tmp_path / "unet")]
+    assert pipe.vae.loaded == []
+
+
+def test_pipe_bundle_skips_mismatched_parts(tmp_path):
+    save_bundle(FakePipeline(), str(tmp_path), PARTS, getattr)
+    # Same size, new content and mtime, e.g. a corrupted copy
+    file_path = tmp_path / "vae"
+    stat = os.stat(file_path)
+    with open(file_path, "r+b") as f:
+        f.write(b"x")
+    os.utime(file_path, (stat.st_atime, stat.st_mtime + 10))
+    pipe = FakePipeline()
+    with torch.no_grad():
+        pipe.unet._torch_module.weight.add_(1)
+
+    skipped = load_bundle(pipe, str(tmp_path), PARTS, getattr)
+    assert skipped["unet"] == "model weights mismatch"
+    assert "checksum" in skipped["vae"]
+    assert pipe.unet.loaded == [] and pipe.vae.loaded == []
+
+    with open(tmp_path / "vae", "ab") as f:
+        f.write(b"x")
+    skipped = load_bundle(FakePipeline(), str(tmp_path), PARTS, getattr)
+    assert "size" in skipped["vae"]
+
+
+def test_pipe_bundle_hashes_only_on_demand(tmp_path):
+    save_bundle(FakePipeline(), str(tmp_path), PARTS, getattr)
+    file_path = tmp_path / "vae"
+    stat = os.stat(file_path)
+    with open(file_path, "r+b") as f:
+        f.write(b"x")
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    # An unchanged size and mtime is trusted without hashing
+    assert load_bundle(FakePipeline(), str(tmp_path), PARTS, getattr) == {}
+    skipped = load_bundle(
+        FakePipeline(), str(tmp_path), PARTS, getattr, verify_checksums=True
+    )
+    assert "checksum" in skipped["vae"]
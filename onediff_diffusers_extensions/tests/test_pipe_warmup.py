@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from onediff.infer_compiler.backends.env_var import (  # usort: skip
+    CPUCompileOptions,
+    OneflowCompileOptions,
+)
+from onediffx.compilers.pipe_warmup import warmup_pipe
+
+
+class Part(torch.nn.Module):
+    def forward(self, x, scale=1.0):
+        return x * scale
+
+
+class FakeCompiled:
+    """Records the inputs it is warmed up with and how many oneflow parts run at once."""
+
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+    # The first calls of the oneflow parts wait for each other, unless they are serialized
+    barrier = None
+
+    def __init__(self, options):
+        self._torch_module = Part()
+        self._deployable_module_options = options
+        self.calls = []
+
+    def __call__(self, x, scale=1.0):
+        is_oneflow = isinstance(self._deployable_module_options, OneflowCompileOptions)
+        if is_oneflow:
+            with FakeCompiled.lock:
+                FakeCompiled.running += 1
+                FakeCompiled.max_running = max(
+                    FakeCompiled.max_running, FakeCompiled.running
+                )
+            if not self.calls:
+                FakeCompiled.barrier.wait()
+        time.sleep(0.02)
+        self.calls.append(tuple(x.shape))
+        if is_oneflow:
+            with FakeCompiled.lock:
+                FakeCompiled.running -= 1
+        return x
+
+
+class FakePipeline:
+    def __init__(self, parts):
+        for name, part in parts.items():
+            setattr(self, name, part)
+
+    def __call__(self, height, width):
+        x = torch.zeros(1, 4, height // 8, width // 8)
+        self.unet(x, scale=0.5)
+        self.unet(x, scale=1.0)
+        self.controlnet(x)
+        self.vae(x)
+
+
+def test_warmup_pipe_traces_each_signature_once_and_overlaps_parts():
+    FakeCompiled.barrier = threading.Barrier(2, timeout=10)
+    parts = {
+        "unet": FakeCompiled(OneflowCompileOptions()),
+        "controlnet": FakeCompiled(OneflowCompileOptions()),
+        "vae": FakeCompiled(CPUCompileOptions()),
+    }
+    pipe = FakePipeline(parts)
+    warmup = [dict(height=512, width=512), dict(height=512, width=768)]
+
+    timings = warmup_pipe(pipe, parts, warmup, setattr, max_workers=3)
+
+    assert set(timings) == {"unet", "controlnet", "vae"}
+    # The scale doesn't change the signature, the resolution does
+    assert parts["unet"].calls == [(1, 4, 64, 64), (1, 4, 64, 96)]
+    assert parts["vae"].calls == [(1, 4, 64, 64), (1, 4, 64, 96)]
+    # The oneflow parts are warmed up concurrently
+    assert FakeCompiled.max_running == 2
+    # The compiled parts are put back after tracing
+    assert pipe.unet is parts["unet"]
@@ -0,0 +1,95 @@
+import json
+
+from onediffx.compilers.warmup_planner import (
+    load_request_log,
+    plan_warmup,
+    run_warmup_plan,
+    WarmupPlan,
+)
+
+
+def test_load_request_log(tmp_path):
+    log_path = tmp_path / "requests.jsonl"
+    requests = [
+        {"height": 512, "width": 512},
+        {"height": 512, "width": 512, "batch_size": 1},
+        {"height": 768, "width": 512, "batch_size": 2},
+    ]
+    log_path.write_text("\n".join(json.dumps(r) for r in requests) + "\n\n")
+
+    assert load_request_log(str(log_path)) == {(512, 512, 1): 2, (768, 512, 2): 1}
+
+
+def test_plan_warmup_picks_the_most_frequent_shapes():
+    histogram = {
+        (512, 512, 1): 50,
+        (768, 768, 1): 30,
+        (1024, 1024, 1): 15,
+        (640, 640, 1): 5,
+    }
+
+    plan = plan_warmup(histogram, coverage=0.9)
+    assert plan.shapes == [(512, 512, 1), (768, 768, 1), (1024, 1024, 1)]
+    assert plan.counts == [50, 30, 15]
+    assert plan.coverage == 0.95
+    assert plan.total_requests == 100
+
+    plan = plan_warmup(histogram, coverage=1.0, max_graphs=2)
+    assert plan.shapes == [(512, 512, 1), (768, 768, 1)]
+    assert plan.coverage == 0.8
+
+
+def test_plan_warmup_rounds_shapes_up_to_buckets():
+    histogram = {
+        (500, 512, 1): 10,
+        (512, 512, 1): 5,
+        (700, 512, 3): 20,
+        (2048, 512, 1): 1,
+    }
+
+    # The latent buckets of the UNet, with classifier-free guidance
+    plan = plan_warmup(
+        histogram, coverage=1.0, heights=[64, 96], widths=[64], batch_sizes=[2, 8]
+    )
+    # A shape beyond the largest bucket is kept as is
+    assert plan.shapes == [(768, 512, 4), (512, 512, 1), (2048, 512, 1)]
+    assert plan.counts == [20, 15, 1]
+
+    # Without guidance, in pixels
+    plan = plan_warmup(
+        histogram,
+        coverage=1.0,
+        heights=[512, 768],
+        widths=[512],
+        batch_sizes=[1, 4],
+        vae_scale_factor=1,
+        batch_multiplier=1,
+    )
+    assert plan.shapes == [(768, 512, 4), (512, 512, 1), (2048, 512, 1)]
+
+
+def test_plan_warmup_maps_batch_buckets_back_to_requests():
+    # UNet batches of 2 and 4 images are padded to 6, served by 3 images per prompt
+    histogram = {(512, 512, 1): 1, (512, 512, 2): 1, (512, 512, 5): 1}
+    plan = plan_warmup(histogram, coverage=1.0, batch_sizes=[6])
+    assert plan.shapes == [(512, 512, 3), (512, 512, 5)]
+    assert plan.counts == [2, 1]
+
+
+def test_warmup_plan_save_load_and_run(tmp_path):
+    plan = plan_warmup({(512, 512, 1): 3, (768, 512, 2): 1}, coverage=1.0)
+    plan.save(str(tmp_path))
+    assert WarmupPlan.load(str(tmp_path)) == plan
+    assert WarmupPlan.load(str(tmp_path / "missing")) is None
+
+    calls = []
+
+    def pipe(**kwargs):
+        calls.append(kwargs)
+
+    timings = run_warmup_plan(pipe, plan, prompt="a photo")
+    assert list(timings) == plan.shapes
+    assert calls == [
+        dict(height=512, width=512, num_images_per_prompt=1, prompt="a photo"),
+        dict(height=768, width=512, num_images_per_prompt=2, prompt="a photo"),
+    ]
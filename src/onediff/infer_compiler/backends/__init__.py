@@ -1,3 +1,3 @@
 from .compiler import compile, oneflow_compile
 from .deployable_module import DeployableModule
-from .env_var import OneflowCompileOptions
+from .env_var import CPUCompileOptions, OneflowCompileOptions, ShapeBucketPolicy
@@ -0,0 +1 @@
+from . import cpu as _cpu_backend
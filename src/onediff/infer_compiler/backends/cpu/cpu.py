@@ -0,0 +1,64 @@
+import dataclasses
+import json
+from typing import Callable
+
+import torch
+
+from onediff.utils import logger
+
+from ..env_var import CPUCompileOptions
+from ..registry import register_backend
+from .deployable_module import CPUDeployableModule, get_deployable_module
+
+
+def _is_bf16_supported() -> bool:
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _parse_options(options) -> CPUCompileOptions:
+    if options is None:
+        return CPUCompileOptions()
+    if isinstance(options, str):
+        options = json.loads(options)
+    if isinstance(options, dict):
+        return CPUCompileOptions(**options)
+    if not isinstance(options, CPUCompileOptions):
+        raise RuntimeError(f"Unsupported options type of cpu backend: {type(options)}")
+    return dataclasses.replace(options)
+
+
+@register_backend("cpu")
+def compile(torch_module: torch.nn.Module, *, options=None):
+    # Decorator mode
+    if torch_module is None:
+
+        def fn(torch_module: Callable):
+            if torch_module is None:
+                raise RuntimeError("torch_module can't be None")
+            return compile(torch_module, options=options)
+
+        return fn
+
+    if isinstance(torch_module, CPUDeployableModule):
+        return compile(torch_module._torch_module, options=options)
+
+    options = _parse_options(options)
+    if options.autocast_dtype == "bfloat16" and not _is_bf16_supported():
+        logger.warning("bfloat16 is not supported by this CPU, fallback to float32.")
+        options.autocast_dtype = "float32"
+
+    if isinstance(torch_module, torch.nn.Module) and options.channels_last:
+        torch_module.to(memory_format=torch.channels_last)
+
+    compiled_model = torch.compile(
+        torch_module,
+        backend="inductor",
+        mode=options.mode,
+        dynamic=options.dynamic,
+        fullgraph=options.fullgraph,
+    )
+
+    return get_deployable_module(torch_module, compiled_model, options)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager, ExitStack
+from types import FunctionType
+from typing import Type, Union
+
+import torch
+from torch import nn
+
+from onediff.utils import logger
+
+from ..deployable_module import DeployableModule
+from ..env_var import CPUCompileOptions
+
+
+class CPUCompiledGraph:
+    """Tracks whether the compiled model has run, since torch.compile compiles on the first call."""
+
+    def __init__(self, compiled_model):
+        self.compiled_model = compiled_model
+        self.is_compiled = False
+
+
+@contextmanager
+def _call_context(options: CPUCompileOptions):
+    """Applies the options to a call of the compiled model only, since torch.compile compiles
+    on the first call, and restores the process-wide settings afterwards."""
+    with ExitStack() as stack:
+        stack.enter_context(torch.no_grad())
+        if options.autocast_dtype not in (None, "float32"):
+            stack.enter_context(
+                torch.autocast("cpu", dtype=getattr(torch, options.autocast_dtype))
+            )
+        if options.prepack_weights:
+            # Freezing constant folds the weights and prepacks them for oneDNN kernels
+            stack.enter_context(torch._inductor.config.patch(freezing=True))
+        if options.num_threads is not None:
+            num_threads = torch.get_num_threads()
+            torch.set_num_threads(options.num_threads)
+            stack.callback(torch.set_num_threads, num_threads)
+        yield
+
+
+_ARTIFACTS_SUFFIX = ".inductor_artifacts"
+_loaded_artifacts = set()
+
+
+def save_cache_artifacts(file_path: str) -> None:
+    """Saves the compiled artifacts next to `file_path` and a reference to them in `file_path`.
+
+    torch.compiler saves the artifacts of all models compiled in this process, so they are
+    written once per content to the directory of `file_path`, shared by the parts of a pipeline.
+    """
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        logger.warning("Saving compiled artifacts requires torch>=2.7, skip saving.")
+        return
+    result = torch.compiler.save_cache_artifacts()
+    if result is None:
+        logger.warning(f"No compiled artifacts to save to {file_path}.")
+        return
+    artifact_bytes, _ = result
+    parent_dir = os.path.dirname(file_path)
+    if parent_dir:
+        os.makedirs(parent_dir, exist_ok=True)
+    artifacts_name = hashlib.sha256(artifact_bytes).hexdigest()[:16] + _ARTIFACTS_SUFFIX
+    artifacts_path = os.path.join(parent_dir, artifacts_name)
+    if not os.path.exists(artifacts_path):
+        tmp_path = f"{artifacts_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(artifact_bytes)
+        os.replace(tmp_path, artifacts_path)
+    with open(file_path, "w") as f:
+        json.dump({"artifacts": artifacts_name}, f)
+
+
+def load_cache_artifacts(file_path: str) -> None:
+    if not hasattr(torch.compiler, "load_cache_artifacts"):
+        logger.warning("Loading compiled artifacts requires torch>=2.7, skip loading.")
+        return
+    with open(file_path, "r") as f:
+        artifacts_name = json.load(f)["artifacts"]
+    artifacts_path = os.path.join(os.path.dirname(file_path), artifacts_name)
+    if artifacts_path in _loaded_artifacts:
+        return
+    with open(artifacts_path, "rb") as f:
+        torch.compiler.load_cache_artifacts(f.read())
+    _loaded_artifacts.add(artifacts_path)
+
+
+class CPUDeployableModule(DeployableModule):
+    def __init__(self, compiled_module, torch_module, options: CPUCompileOptions):
+        torch.nn.Module.__init__(self)
+        object.__setattr__(self, "_torch_module", torch_module)
+        object.__setattr__(self, "_deployable_module_model", compiled_module)
+        object.__setattr__(self, "_deployable_module_options", options)
+        object.__setattr__(
+            self, "_deployable_module_dpl_graph", CPUCompiledGraph(compiled_module)
+        )
+        if isinstance(torch_module, nn.Module) and isinstance(
+            compiled_module, torch._dynamo.eval_frame.OptimizedModule
+        ):
+            object.__setattr__(self, "_modules", compiled_module._orig_mod._modules)
+            object.__setattr__(
+                self, "_parameters", compiled_module._orig_mod._parameters
+            )
+            object.__setattr__(self, "_buffers", compiled_module._orig_mod._buffers)
+
+    def forward(self, *args, **kwargs):
+        with _call_context(self._deployable_module_options):
+            output = self._deployable_module_model(*args, **kwargs)
+        self._deployable_module_dpl_graph.is_compiled = True
+        return output
+
+    def get_graph(self):
+        return self._deployable_module_dpl_graph
+
+    def save_graph(self, file_path):
+        save_cache_artifacts(file_path)
+
+    def load_graph(self, file_path, device=None, run_warmup=True):
+        load_cache_artifacts(file_path)
+
+    def __getattr__(self, name):
+        return getattr(self._deployable_module_model, name)
+
+
+def _create_deployable_function(
+    compiled_model, options: CPUCompileOptions
+) -> FunctionType:
+    def deploy_function(*args, **kwargs):
+        with _call_context(options):
+            return compiled_model(*args, **kwargs)
+
+    return deploy_function
+
+
+def _create_mixed_deployable_module(
+    compiled_model, torch_module: nn.Module, options: CPUCompileOptions
+) -> Type[CPUDeployableModule]:
+    module_cls = type(torch_module)
+
+    class MixedCPUDeployableModule(CPUDeployableModule, module_cls):
+        def __init__(self, compiled_module, torch_module, options):
+            super().__init__(compiled_module, torch_module, options)
+
+        def _get_name(self):
+            return f"{self.__class__.__name__}(of {module_cls.__name__})"
+
+    return MixedCPUDeployableModule(compiled_model, torch_module, options)
+
+
+def get_deployable_module(
+    torch_module: Union[nn.Module, FunctionType],
+    compiled_model,
+    options: CPUCompileOptions,
+) -> Union[Type[CPUDeployableModule], FunctionType]:
+    if not isinstance(torch_module, nn.Module):
+        return _create_deployable_function(compiled_model, options)
+    return _create_mixed_deployable_module(compiled_model, torch_module, options)
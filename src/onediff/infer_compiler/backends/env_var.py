@@ -1,20 +1,68 @@
 import dataclasses
 import os
-from typing import Optional
+from typing import Optional, Sequence, Tuple, Union
 
 import torch
 
 from onediff.utils import set_boolean_env_var, set_integer_env_var
 
 
+def _round_up(value: int, buckets: Optional[Sequence[int]]) -> int:
+    if not buckets:
+        return value
+    for bucket in sorted(buckets):
+        if bucket >= value:
+            return bucket
+    return value
+
+
+@dataclasses.dataclass
+class ShapeBucketPolicy:
+    """Round input shapes up to declared buckets so a bounded set of graphs serves all traffic.
+
+    The batch size, height and width are taken from the first 4-D tensor of the inputs.
+    Inputs are padded to the bucket shape and outputs are cropped back. A dimension that
+    has no buckets declared, or exceeds the largest bucket, is left unchanged.
+    4-D inputs are padded at their scale to the first one, e.g. ControlNet residuals, and
+    the height and width are not bucketed if some 4-D input can't be padded to the bucket.
+    `batch_args` are the positional indices or keyword names of the inputs other than 4-D
+    tensors to pad along the batch, such as the timestep and the encoder hidden states.
+    `pad_mode` is passed to `torch.nn.functional.pad` for spatial padding.
+    """
+
+    batch_sizes: Sequence[int] = None
+    heights: Sequence[int] = None
+    widths: Sequence[int] = None
+    pad_mode: str = "constant"
+    batch_args: Sequence[Union[int, str]] = None
+
+    def get_bucket_shape(self, batch_size, height, width) -> Tuple[int, int, int]:
+        return (
+            _round_up(batch_size, self.batch_sizes),
+            _round_up(height, self.heights),
+            _round_up(width, self.widths),
+        )
+
+
 @dataclasses.dataclass
 class OneflowCompileOptions:
     dynamic: bool = True
     use_graph: bool = True
     debug_level: int = -1
     max_cached_graph_size: int = 9
+    # Byte budget of the cached graphs by their estimated memory footprint, None means unlimited
+    max_cached_graph_bytes: int = None
+    # "lru" or "lfu"
+    graph_cache_policy: str = "lru"
     graph_file: str = None
     graph_file_device: torch.device = None
+    # Size budget in bytes and entry limit of the graph file directory, None means unlimited
+    graph_file_max_size: int = None
+    graph_file_max_entries: int = None
+    shape_bucket: ShapeBucketPolicy = None
+    # Run the torch module eagerly while graphs are compiled on worker threads,
+    # see ONEDIFF_BACKGROUND_COMPILE_WORKERS
+    background_compile: bool = False
     # Optimization related environment variables
     run_graph_by_vm: bool = None
     graph_delay_variable_op_execution: bool = None
@@ -47,6 +95,24 @@ class OneflowCompileOptions:
     kernel_glu_quant_enable_dual_gemm_impl: bool = None
 
 
+@dataclasses.dataclass
+class CPUCompileOptions:
+    """Options of the cpu backend, which compiles with torch inductor for CPU inference.
+
+    `autocast_dtype` is "bfloat16" or "float32", bfloat16 falls back to float32 on CPUs
+    without native support. `prepack_weights` enables inductor freezing, which constant
+    folds and prepacks the weights for the oneDNN kernels.
+    """
+
+    mode: str = None
+    dynamic: bool = None
+    fullgraph: bool = False
+    channels_last: bool = True
+    autocast_dtype: str = "float32"
+    num_threads: int = None
+    prepack_weights: bool = False
+
+
 def _set_env_vars(field2env_var, options):
     for field in dataclasses.fields(options):
         field_name = field.name
@@ -64,35 +130,37 @@ def _set_env_vars(field2env_var, options):
         set_env_var(env_var, field_value)
 
 
+ONEFLOW_FIELD2ENV_VAR = {
+    "run_graph_by_vm": "ONEFLOW_RUN_GRAPH_BY_VM",
+    "graph_delay_variable_op_execution": "ONEFLOW_GRAPH_DELAY_VARIABLE_OP_EXECUTION",
+    "mlir_cse": "ONEFLOW_MLIR_CSE",
+    "mlir_enable_inference_optimization": "ONEFLOW_MLIR_ENABLE_INFERENCE_OPTIMIZATION",
+    "mlir_enable_round_trip": "ONEFLOW_MLIR_ENABLE_ROUND_TRIP",
+    "mlir_fuse_forward_ops": "ONEFLOW_MLIR_FUSE_FORWARD_OPS",
+    "mlir_fuse_ops_with_backward_impl": "ONEFLOW_MLIR_FUSE_OPS_WITH_BACKWARD_IMPL",
+    "mlir_group_matmul": "ONEFLOW_MLIR_GROUP_MATMUL",
+    "mlir_prefer_nhwc": "ONEFLOW_MLIR_PREFER_NHWC",
+    "mlir_fuse_kernel_launch": "ONEFLOW_MLIR_FUSE_KERNEL_LAUNCH",
+    "kernel_enable_cuda_graph": "ONEFLOW_KERNEL_ENABLE_CUDA_GRAPH",
+    "kernel_enable_fused_conv_bias": "ONEFLOW_KERNEL_ENABLE_FUSED_CONV_BIAS",
+    "kernel_enable_fused_linear": "ONEFLOW_KERNEL_ENABLE_FUSED_LINEAR",
+    "kernel_conv_cutlass_impl_enable_tuning_warmup": "ONEFLOW_KERNEL_CONV_CUTLASS_IMPL_ENABLE_TUNING_WARMUP",
+    "kernel_gemm_cutlass_impl_enable_tuning_warmup": "ONEFLOW_KERNEL_GEMM_CUTLASS_IMPL_ENABLE_TUNING_WARMUP",
+    "kernel_conv_enable_cutlass_impl": "ONEFLOW_KERNEL_CONV_ENABLE_CUTLASS_IMPL",
+    "kernel_enable_conv2d_tuning_warmup": "ONEFLOW_CONV2D_KERNEL_ENABLE_TUNING_WARMUP",
+    "kernel_gemm_enable_cutlass_impl": "ONEFLOW_KERNEL_GEMM_ENABLE_CUTLASS_IMPL",
+    "kernel_glu_enable_dual_gemm_impl": "ONEFLOW_KERNEL_GLU_ENABLE_DUAL_GEMM_IMPL",
+    "kernel_glu_enable_y_gemm_impl": "ONEFLOW_KERNEL_GLU_ENABLE_Y_GEMM_IMPL",
+    "kernel_glu_quant_enable_dual_gemm_impl": "ONEFLOW_KERNEL_GLU_QUANT_ENABLE_DUAL_GEMM_IMPL",
+    "conv_allow_half_precision_accumulation": "ONEFLOW_CONV_ALLOW_HALF_PRECISION_ACCUMULATION",
+    "matmul_allow_half_precision_accumulation": "ONEFLOW_MATMUL_ALLOW_HALF_PRECISION_ACCUMULATION",
+    "attention_allow_half_precision_accumulation": "ONEFLOW_ATTENTION_ALLOW_HALF_PRECISION_ACCUMULATION",
+    "attention_allow_half_precision_score_accumulation_max_m": "ONEFLOW_ATTENTION_ALLOW_HALF_PRECISION_SCORE_ACCUMULATION_MAX_M",
+}
+
+
 def set_oneflow_env_vars(options):
-    field2env_var = {
-        "run_graph_by_vm": "ONEFLOW_RUN_GRAPH_BY_VM",
-        "graph_delay_variable_op_execution": "ONEFLOW_GRAPH_DELAY_VARIABLE_OP_EXECUTION",
-        "mlir_cse": "ONEFLOW_MLIR_CSE",
-        "mlir_enable_inference_optimization": "ONEFLOW_MLIR_ENABLE_INFERENCE_OPTIMIZATION",
-        "mlir_enable_round_trip": "ONEFLOW_MLIR_ENABLE_ROUND_TRIP",
-        "mlir_fuse_forward_ops": "ONEFLOW_MLIR_FUSE_FORWARD_OPS",
-        "mlir_fuse_ops_with_backward_impl": "ONEFLOW_MLIR_FUSE_OPS_WITH_BACKWARD_IMPL",
-        "mlir_group_matmul": "ONEFLOW_MLIR_GROUP_MATMUL",
-        "mlir_prefer_nhwc": "ONEFLOW_MLIR_PREFER_NHWC",
-        "mlir_fuse_kernel_launch": "ONEFLOW_MLIR_FUSE_KERNEL_LAUNCH",
-        "kernel_enable_cuda_graph": "ONEFLOW_KERNEL_ENABLE_CUDA_GRAPH",
-        "kernel_enable_fused_conv_bias": "ONEFLOW_KERNEL_ENABLE_FUSED_CONV_BIAS",
-        "kernel_enable_fused_linear": "ONEFLOW_KERNEL_ENABLE_FUSED_LINEAR",
-        "kernel_conv_cutlass_impl_enable_tuning_warmup": "ONEFLOW_KERNEL_CONV_CUTLASS_IMPL_ENABLE_TUNING_WARMUP",
-        "kernel_gemm_cutlass_impl_enable_tuning_warmup": "ONEFLOW_KERNEL_GEMM_CUTLASS_IMPL_ENABLE_TUNING_WARMUP",
-        "kernel_conv_enable_cutlass_impl": "ONEFLOW_KERNEL_CONV_ENABLE_CUTLASS_IMPL",
-        "kernel_enable_conv2d_tuning_warmup": "ONEFLOW_CONV2D_KERNEL_ENABLE_TUNING_WARMUP",
-        "kernel_gemm_enable_cutlass_impl": "ONEFLOW_KERNEL_GEMM_ENABLE_CUTLASS_IMPL",
-        "kernel_glu_enable_dual_gemm_impl": "ONEFLOW_KERNEL_GLU_ENABLE_DUAL_GEMM_IMPL",
-        "kernel_glu_enable_y_gemm_impl": "ONEFLOW_KERNEL_GLU_ENABLE_Y_GEMM_IMPL",
-        "kernel_glu_quant_enable_dual_gemm_impl": "ONEFLOW_KERNEL_GLU_QUANT_ENABLE_DUAL_GEMM_IMPL",
-        "conv_allow_half_precision_accumulation": "ONEFLOW_CONV_ALLOW_HALF_PRECISION_ACCUMULATION",
-        "matmul_allow_half_precision_accumulation": "ONEFLOW_MATMUL_ALLOW_HALF_PRECISION_ACCUMULATION",
-        "attention_allow_half_precision_accumulation": "ONEFLOW_ATTENTION_ALLOW_HALF_PRECISION_ACCUMULATION",
-        "attention_allow_half_precision_score_accumulation_max_m": "ONEFLOW_ATTENTION_ALLOW_HALF_PRECISION_SCORE_ACCUMULATION_MAX_M",
-    }
-    _set_env_vars(field2env_var, options)
+    _set_env_vars(ONEFLOW_FIELD2ENV_VAR, options)
 
 
 def set_oneflow_default_env_vars():
@@ -1,3 +1,4 @@
 from ..env_var import OneflowCompileOptions
 from . import oneflow as _oneflow_backend
+from .autotune_utils import autotune
 from .deployable_module import OneflowDeployableModule
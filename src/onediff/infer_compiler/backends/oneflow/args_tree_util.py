@@ -1,41 +1,139 @@
+import dataclasses
+import hashlib
+import time
+
 import torch
 import oneflow as flow  # usort: skip
 from oneflow.framework.args_tree import ArgsTree
 
-from onediff.utils import logger
+from onediff.utils import logger, metrics
 
 from .utils.hash_utils import generate_input_structure_key
 
+# Maps the layout of arguments to its input structure key, so the key is only hashed once per layout.
+_STRUCTURE_KEY_CACHE = {}
+_STRUCTURE_KEY_CACHE_SIZE = 1024
+
+
+class _UnsupportedLayout(Exception):
+    pass
+
+
+def _flatten_and_map(value, layout, leaf_fn):
+    """Appends the layout of `value` to `layout` and maps its tensors with `leaf_fn` in one pass.
+
+    Only tensors, tuples, lists and dicts are handled, other containers raise _UnsupportedLayout
+    and are handled by ArgsTree.
+    """
+    if isinstance(value, (torch.Tensor, flow.Tensor)):
+        layout.append(type(value).__name__)
+        return leaf_fn(value)
+    value_type = type(value)
+    if value_type is tuple or value_type is list:
+        layout.append((value_type.__name__, len(value)))
+        return value_type([_flatten_and_map(v, layout, leaf_fn) for v in value])
+    if value_type is dict:
+        layout.append(("dict",) + tuple(value.keys()))
+        return {k: _flatten_and_map(v, layout, leaf_fn) for k, v in value.items()}
+    if isinstance(value, (tuple, list, dict)) or dataclasses.is_dataclass(value):
+        raise _UnsupportedLayout()
+    layout.append(value_type.__name__)
+    return value
+
+
+def _get_structure_key(layout) -> str:
+    layout = tuple(layout)
+    key = _STRUCTURE_KEY_CACHE.get(layout, None)
+    if key is None:
+        if len(_STRUCTURE_KEY_CACHE) >= _STRUCTURE_KEY_CACHE_SIZE:
+            _STRUCTURE_KEY_CACHE.clear()
+        key = hashlib.sha256(repr(layout).encode("utf-8")).hexdigest()[:6]
+        _STRUCTURE_KEY_CACHE[layout] = key
+    return key
+
+
+def _identity(value):
+    return value
+
+
+def get_input_structure_key(args, kwargs) -> str:
+    """Returns the input structure key of the arguments, memoized by the argument layout."""
+    try:
+        layout = []
+        _flatten_and_map((args, kwargs), layout, _identity)
+        return _get_structure_key(layout)
+    except _UnsupportedLayout:
+        args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+        return generate_input_structure_key(args_tree)
+
+
+def get_input_signature(args, kwargs) -> str:
+    """Returns the input structure key combined with the shape, dtype and device of each tensor."""
+    tensor_meta = []
+
+    def meta_fn(value):
+        tensor_meta.append(f"{tuple(value.shape)}:{value.dtype}:{value.device}")
+        return value
+
+    try:
+        layout = []
+        _flatten_and_map((args, kwargs), layout, meta_fn)
+        structure_key = _get_structure_key(layout)
+    except _UnsupportedLayout:
+        args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+        structure_key = generate_input_structure_key(args_tree)
+        tensor_meta = []
+        for node in args_tree.iter_nodes():
+            if isinstance(node, torch.Tensor):
+                meta_fn(node)
+    return "_".join([structure_key] + tensor_meta)
+
+
+def _torch_to_oflow(value):
+    if isinstance(value, torch.Tensor):
+        # TODO: https://github.com/siliconflow/sd-team/issues/109
+        return flow.utils.tensor.from_torch(value.contiguous())
+    return value
+
+
+def _oflow_to_torch(value):
+    if isinstance(value, flow.Tensor):
+        return flow.utils.tensor.to_torch(value)
+    return value
+
 
 def input_output_processor(func):
     def process_input(*args, **kwargs):
-        def input_fn(value):
-            if isinstance(value, torch.Tensor):
-                # TODO: https://github.com/siliconflow/sd-team/issues/109
-                return flow.utils.tensor.from_torch(value.contiguous())
-            else:
-                return value
+        try:
+            layout = []
+            mapped_args, mapped_kwargs = _flatten_and_map(
+                (args, kwargs), layout, _torch_to_oflow
+            )
+            return mapped_args, mapped_kwargs, _get_structure_key(layout)
+        except _UnsupportedLayout:
+            pass
 
         args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
 
         input_structure_key = generate_input_structure_key(args_tree)
-        out = args_tree.map_leaf(input_fn)
+        out = args_tree.map_leaf(_torch_to_oflow)
         mapped_args = out[0]
         mapped_kwargs = out[1]
         return mapped_args, mapped_kwargs, input_structure_key
 
     def process_output(output):
-        def output_fn(value):
-            if isinstance(value, flow.Tensor):
-                return flow.utils.tensor.to_torch(value)
-            else:
-                return value
+        try:
+            return _flatten_and_map(output, [], _oflow_to_torch)
+        except _UnsupportedLayout:
+            pass
 
         out_tree = ArgsTree((output, None), False)
-        out = out_tree.map_leaf(output_fn)
+        out = out_tree.map_leaf(_oflow_to_torch)
         return out[0]
 
     def wrapper(self: "OneflowDeployableModule", *args, **kwargs):
+        start_time = time.perf_counter()
+        module_name = type(self._torch_module).__name__
         mapped_args, mapped_kwargs, input_structure_key = process_input(*args, **kwargs)
         if (
             self._deployable_module_options.use_graph
@@ -47,16 +145,29 @@ def input_output_processor(func):
             dpl_graph = self._deployable_module_graph_cache.get(
                 input_structure_key, None
             )
-            self._deployable_module_graph_cache.put(
+            evicted_keys = self._deployable_module_graph_cache.put(
                 self._deployable_module_input_structure_key,
                 self._deployable_module_dpl_graph,
             )
+            if evicted_keys:
+                metrics.inc(
+                    "onediff_graph_cache_evictions_total",
+                    len(evicted_keys),
+                    module=module_name,
+                )
 
             # If a cached graph is found, update the deployable module graph and input structure key
             if dpl_graph is not None:
+                metrics.inc("onediff_graph_cache_hits_total", module=module_name)
                 self._deployable_module_dpl_graph = dpl_graph
                 self._deployable_module_input_structure_key = input_structure_key
             else:
+                metrics.inc("onediff_graph_cache_misses_total", module=module_name)
+                metrics.inc(
+                    "onediff_graph_recompiles_total",
+                    module=module_name,
+                    reason="input_structure_changed",
+                )
                 logger.warning(
                     f"Input structure key {self._deployable_module_input_structure_key} to {input_structure_key} has changed. Resetting the deployable module graph. This may slow down the process."
                 )
@@ -64,7 +175,14 @@ def input_output_processor(func):
                 self._deployable_module_input_structure_key = None
                 self._load_graph_first_run = True
 
+        overhead = time.perf_counter() - start_time
         output = func(self, *mapped_args, **mapped_kwargs)
-        return process_output(output)
+        start_time = time.perf_counter()
+        output = process_output(output)
+        overhead += time.perf_counter() - start_time
+        metrics.observe(
+            "onediff_wrapper_overhead_seconds", overhead, module=module_name
+        )
+        return output
 
     return wrapper
@@ -0,0 +1,374 @@
+"""Benchmark-driven tuning of OneflowCompileOptions per module and input bucket.
+
+Example:
+    >>> import os
+    >>> os.environ["ONEDIFF_AUTOTUNE_FILE"] = "/path/to/autotune.json"
+    >>> from onediff.infer_compiler.backends.oneflow.autotune_utils import autotune
+    >>> record = autotune(pipe.unet, args, kwargs)
+    >>> pipe.unet = oneflow_compile(pipe.unet)  # builds graphs with the tuned options
+
+The winning options are persisted in the JSON file set by `ONEDIFF_AUTOTUNE_FILE`, keyed by the model
+hash and the input signature. The store is disabled when it is unset. Later compiles apply them when
+a graph is built for the same model and inputs. Only options that map to environment variables can
+be tuned, since those are read when a graph is built.
+"""
+
+import dataclasses
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, List, Optional, Sequence, Union
+
+import torch
+import oneflow as flow  # usort: skip
+
+from onediff.utils import logger
+
+from ..env_var import ONEFLOW_FIELD2ENV_VAR, OneflowCompileOptions, set_oneflow_env_vars
+from .args_tree_util import get_input_signature
+
+__all__ = ["autotune", "TuningStore", "get_tuning_store", "tuned_options_processor"]
+
+DEFAULT_SEARCH_SPACE = [
+    {},
+    {"kernel_enable_cuda_graph": True},
+    {"mlir_fuse_kernel_launch": True, "kernel_enable_cuda_graph": True},
+    {"kernel_glu_enable_dual_gemm_impl": True},
+    {
+        "attention_allow_half_precision_accumulation": True,
+        "attention_allow_half_precision_score_accumulation_max_m": -1,
+    },
+    {
+        "conv_allow_half_precision_accumulation": False,
+        "matmul_allow_half_precision_accumulation": False,
+    },
+]
+
+
+def generate_model_hash(torch_module: torch.nn.Module) -> str:
+    module_cls = type(torch_module)
+    model_str = f"{module_cls.__module__}.{module_cls.__qualname__}:{torch_module}"
+    return hashlib.sha256(model_str.encode("utf-8")).hexdigest()[:16]
+
+
+class TuningStore:
+    """TuningStore
+
+    A JSON file of the winning configuration per (model hash, input signature). The file is
+    re-read when it is modified by another process.
+
+    __init__ args:
+        `file_path`: The path of the JSON file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._records = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _reload(self) -> None:
+        try:
+            mtime = os.path.getmtime(self.file_path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.file_path, "r") as f:
+                self._records = json.load(f).get("records", {})
+            self._mtime = mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read tuning file {self.file_path}. {e=}")
+
+    def lookup(self, model_hash: str, input_signature: str) -> Optional[Dict]:
+        with self._lock:
+            self._reload()
+            return self._records.get(model_hash, {}).get(input_signature, None)
+
+    def update(self, model_hash: str, input_signature: str, record: Dict) -> None:
+        with self._lock:
+            self._reload()
+            self._records.setdefault(model_hash, {})[input_signature] = record
+            parent_dir = os.path.dirname(self.file_path)
+            if parent_dir:
+                os.makedirs(parent_dir, exist_ok=True)
+            tmp_file = f"{self.file_path}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"records": self._records}, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.file_path)
+            self._mtime = os.path.getmtime(self.file_path)
+
+
+_tuning_store = None
+# Tuned options are not applied while autotuning, so each trial runs its own options.
+_autotune_local = threading.local()
+
+
+def get_tuning_store() -> Optional[TuningStore]:
+    """Returns the store of `ONEDIFF_AUTOTUNE_FILE`, or None if it is unset."""
+    global _tuning_store
+    file_path = os.getenv("ONEDIFF_AUTOTUNE_FILE", None)
+    if not file_path:
+        return None
+    if _tuning_store is None or _tuning_store.file_path != file_path:
+        _tuning_store = TuningStore(file_path)
+    return _tuning_store
+
+
+@contextmanager
+def override_oneflow_env_vars(overrides: Dict):
+    """Sets the environment variables of the option overrides and restores them on exit."""
+    env_vars = [ONEFLOW_FIELD2ENV_VAR[k] for k in overrides]
+    saved = {env_var: os.environ.get(env_var, None) for env_var in env_vars}
+    set_oneflow_env_vars(OneflowCompileOptions(**overrides))
+    try:
+        yield
+    finally:
+        for env_var, value in saved.items():
+            if value is None:
+                os.environ.pop(env_var, None)
+            else:
+                os.environ[env_var] = value
+
+
+def tuned_options_processor(func):
+    """Builds the graph with the tuned options of the model and inputs, if any."""
+
+    @wraps(func)
+    def wrapper(self: "OneflowDeployableModule", *args, **kwargs):
+        dpl_graph = self._deployable_module_dpl_graph
+        if not self._deployable_module_options.use_graph or (
+            dpl_graph is not None and dpl_graph.is_compiled
+        ):
+            return func(self, *args, **kwargs)
+        store = get_tuning_store()
+        if store is None or getattr(_autotune_local, "tuning", False):
+            return func(self, *args, **kwargs)
+
+        record = store.lookup(
+            generate_model_hash(self._torch_module), get_input_signature(args, kwargs)
+        )
+        if record is None or record.get("backend", "oneflow") != "oneflow":
+            return func(self, *args, **kwargs)
+        logger.info(
+            f"Building the graph of {type(self._torch_module).__name__} with tuned options {record['options']}"
+        )
+        with override_oneflow_env_vars(record["options"]):
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _expand_search_space(search_space) -> List[Dict]:
+    if search_space is None:
+        return list(DEFAULT_SEARCH_SPACE)
+    if isinstance(search_space, dict):
+        # Cartesian product of field -> candidate values
+        fields = list(search_space.keys())
+        return [
+            dict(zip(fields, values))
+            for values in itertools.product(*(search_space[f] for f in fields))
+        ]
+    return list(search_space)
+
+
+def _flatten_tensors(output) -> List[torch.Tensor]:
+    if isinstance(output, torch.Tensor):
+        return [output]
+    if hasattr(output, "to_tuple"):
+        output = output.to_tuple()
+    if isinstance(output, dict):
+        output = list(output.values())
+    if isinstance(output, (tuple, list)):
+        return [t for v in output for t in _flatten_tensors(v)]
+    return []
+
+
+def _max_error(output, reference, atol: float, rtol: float):
+    """Returns the max absolute error, or None if the outputs are not within tolerance."""
+    outputs, references = _flatten_tensors(output), _flatten_tensors(reference)
+    if len(outputs) != len(references):
+        return None
+    max_error = 0.0
+    for out, ref in zip(outputs, references):
+        if out.shape != ref.shape:
+            return None
+        out, ref = out.float(), ref.float().to(out.device)
+        if not torch.allclose(out, ref, rtol=rtol, atol=atol):
+            return None
+        if out.numel() > 0:
+            max_error = max(max_error, (out - ref).abs().max().item())
+    return max_error
+
+
+def _synchronize():
+    flow._oneflow_internal.eager.Sync()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def _benchmark(fn, warmup_iters: int, iters: int):
+    output = None
+    for _ in range(warmup_iters):
+        output = fn()
+    _synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        output = fn()
+    _synchronize()
+    return output, (time.perf_counter() - start) / iters * 1000
+
+
+def _run_trials(
+    torch_module,
+    args,
+    kwargs,
+    candidates,
+    base_options,
+    reference,
+    *,
+    atol,
+    rtol,
+    warmup_iters,
+    iters,
+):
+    from ..compiler import compile
+
+    best = None
+    for backend, options in candidates:
+        try:
+            with torch.no_grad(), override_oneflow_env_vars(
+                options if backend == "oneflow" else {}
+            ):
+                if backend == "oneflow":
+                    compiled = compile(
+                        torch_module,
+                        backend=backend,
+                        options=dataclasses.replace(base_options, **options),
+                    )
+                else:
+                    compiled = compile(torch_module, backend=backend, options=options)
+                output, latency = _benchmark(
+                    lambda: compiled(*args, **kwargs), warmup_iters, iters
+                )
+        except Exception as e:
+            logger.warning(f"Autotune trial {backend} {options} failed. {e=}")
+            continue
+
+        max_error = _max_error(output, reference, atol, rtol)
+        logger.info(
+            f"Autotune trial {backend} {options}: {latency:.3f} ms, max abs error {max_error}"
+        )
+        if max_error is None:
+            continue
+        if best is None or latency < best["latency_ms"]:
+            best = {
+                "backend": backend,
+                "options": options,
+                "latency_ms": latency,
+                "max_abs_error": max_error,
+            }
+    return best
+
+
+def autotune(
+    torch_module: torch.nn.Module,
+    args: Sequence = (),
+    kwargs: Optional[Dict] = None,
+    *,
+    search_space: Union[Dict[str, Sequence], Sequence[Dict], None] = None,
+    backends: Sequence[str] = ("oneflow",),
+    base_options: Optional[OneflowCompileOptions] = None,
+    backend_options: Optional[Dict[str, Sequence]] = None,
+    atol: float = 1e-2,
+    rtol: float = 1e-2,
+    warmup_iters: int = 2,
+    iters: int = 5,
+    max_trials: Optional[int] = None,
+    store: Optional[TuningStore] = None,
+) -> Optional[Dict]:
+    """Benchmarks compile configurations of a module and persists the fastest one within tolerance.
+
+    Args:
+        torch_module: The torch module to tune, such as a UNet, a VAE or a ControlNet.
+        args, kwargs: Representative inputs. Use bucketed shapes if `shape_bucket` is used.
+        search_space: A list of OneflowCompileOptions overrides, or a dict of field to candidate
+            values whose cartesian product is searched. Only fields that map to environment
+            variables are supported. Defaults to DEFAULT_SEARCH_SPACE.
+        backends: The backends to search. Other backends than oneflow take their candidate
+            options from `backend_options[backend]`.
+        atol, rtol: The tolerance against the eager output.
+        max_trials: The maximum number of configurations to benchmark.
+        store: Where to persist the winner, defaults to `get_tuning_store()`, which is None
+            unless ONEDIFF_AUTOTUNE_FILE is set.
+
+    Returns:
+        The winning record, with the backend, options, latency_ms and max_abs_error, or None if
+        no configuration is within tolerance.
+    """
+    kwargs = kwargs if kwargs is not None else {}
+    base_options = base_options if base_options is not None else OneflowCompileOptions()
+    backend_options = backend_options if backend_options is not None else {}
+    store = store if store is not None else get_tuning_store()
+
+    candidates = []
+    for backend in backends:
+        if backend == "oneflow":
+            for overrides in _expand_search_space(search_space):
+                unsupported = set(overrides) - set(ONEFLOW_FIELD2ENV_VAR)
+                if unsupported:
+                    raise RuntimeError(f"Options {unsupported} can't be tuned")
+                candidates.append((backend, overrides))
+        else:
+            for options in backend_options.get(backend, [None]):
+                candidates.append((backend, options))
+    if max_trials is not None:
+        candidates = candidates[:max_trials]
+
+    with torch.no_grad():
+        reference, eager_latency = _benchmark(
+            lambda: torch_module(*args, **kwargs), warmup_iters, iters
+        )
+    logger.info(
+        f"Eager latency of {type(torch_module).__name__}: {eager_latency:.3f} ms"
+    )
+
+    _autotune_local.tuning = True
+    try:
+        best = _run_trials(
+            torch_module,
+            args,
+            kwargs,
+            candidates,
+            base_options,
+            reference,
+            atol=atol,
+            rtol=rtol,
+            warmup_iters=warmup_iters,
+            iters=iters,
+        )
+    finally:
+        _autotune_local.tuning = False
+
+    if best is None:
+        logger.warning(
+            f"No configuration of {type(torch_module).__name__} is within tolerance."
+        )
+        return None
+    best["eager_latency_ms"] = eager_latency
+
+    if store is not None:
+        store.update(
+            generate_model_hash(torch_module), get_input_signature(args, kwargs), best
+        )
+    else:
+        logger.warning(
+            "The autotune result is not persisted, set ONEDIFF_AUTOTUNE_FILE to apply it to later compiles."
+        )
+    return best
@@ -0,0 +1,139 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import wraps
+from typing import Dict, Optional
+
+import torch
+from oneflow.framework.args_tree import ArgsTree
+
+from onediff.utils import logger, parse_integer_from_env
+from .args_tree_util import get_input_signature
+
+__all__ = [
+    "BackgroundCompiler",
+    "background_compile_wrapper",
+    "COMPILE_PENDING",
+    "COMPILE_READY",
+    "COMPILE_FAILED",
+]
+
+COMPILE_PENDING = "pending"
+COMPILE_READY = "ready"
+COMPILE_FAILED = "failed"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # One executor is shared by all modules, so ONEDIFF_BACKGROUND_COMPILE_WORKERS
+    # bounds the number of graphs compiled concurrently in this process.
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            max_workers = parse_integer_from_env(
+                "ONEDIFF_BACKGROUND_COMPILE_WORKERS", 1
+            )
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, max_workers), thread_name_prefix="onediff_compile"
+            )
+        return _executor
+
+
+def _clone_inputs(args, kwargs):
+    def clone_fn(value):
+        if isinstance(value, torch.Tensor):
+            return value.detach().clone()
+        return value
+
+    args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+    out = args_tree.map_leaf(clone_fn)
+    return out[0], out[1]
+
+
+class BackgroundCompiler:
+    """BackgroundCompiler
+
+    Builds graphs for input signatures on a worker thread. `lock` is held while a graph is
+    compiled or run, so the graph state of the deployable module is never modified concurrently.
+    The worker threads are shared by all modules of the process, their number is set by the
+    ONEDIFF_BACKGROUND_COMPILE_WORKERS environment variable, 1 by default.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._states: Dict[str, str] = {}
+        self._futures = {}
+        self._states_lock = threading.Lock()
+
+    def get_state(self, signature: str) -> Optional[str]:
+        return self._states.get(signature, None)
+
+    def get_states(self) -> Dict[str, str]:
+        with self._states_lock:
+            return dict(self._states)
+
+    def submit(self, signature: str, compile_fn) -> None:
+        with self._states_lock:
+            if signature in self._states:
+                return
+            self._states[signature] = COMPILE_PENDING
+
+        def _run():
+            try:
+                with self.lock:
+                    compile_fn()
+                state = COMPILE_READY
+                logger.info(f"Background compilation is ready for {signature}")
+            except Exception as e:
+                state = COMPILE_FAILED
+                logger.error(f"Background compilation failed for {signature}: {e=}")
+            with self._states_lock:
+                self._states[signature] = state
+
+        future = _get_executor().submit(_run)
+        with self._states_lock:
+            self._futures[signature] = future
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Waits for all pending compilations, returns True if none of them failed."""
+        with self._states_lock:
+            futures = list(self._futures.values())
+        _, not_done = wait(futures, timeout=timeout)
+        if len(not_done) > 0:
+            return False
+        return all(state == COMPILE_READY for state in self.get_states().values())
+
+
+def background_compile_wrapper(func):
+    """Runs the torch module eagerly while the graph of a new input signature is built in background.
+
+    The eager fallback is the method of the torch module with the name of `func`, e.g. `decode`.
+    """
+
+    @wraps(func)
+    def wrapper(self: "OneflowDeployableModule", *args, **kwargs):
+        compiler = self._deployable_module_background_compiler
+        if compiler is None:
+            return func(self, *args, **kwargs)
+
+        signature = get_input_signature(args, kwargs)
+        if func.__name__ != "forward":
+            signature = f"{func.__name__}:{signature}"
+        state = compiler.get_state(signature)
+        if state == COMPILE_READY and compiler.lock.acquire(blocking=False):
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                compiler.lock.release()
+
+        if state is None:
+            compile_args, compile_kwargs = _clone_inputs(args, kwargs)
+            compiler.submit(
+                signature, lambda: func(self, *compile_args, **compile_kwargs)
+            )
+        if func.__name__ == "forward":
+            return self._torch_module(*args, **kwargs)
+        return getattr(self._torch_module, func.__name__)(*args, **kwargs)
+
+    return wrapper
@@ -5,12 +5,14 @@ import torch
 
 import oneflow as flow  # usort: skip
 
-from onediff.utils import logger
-from onediff.utils.chache_utils import LRUCache
+from onediff.utils import logger, metrics
+from onediff.utils.chache_utils import MemoryBudgetedCache
 
 from ..deployable_module import DeployableModule
 from ..env_var import OneflowCompileOptions
 from .args_tree_util import input_output_processor
+from .autotune_utils import tuned_options_processor
+from .background_compile_utils import background_compile_wrapper, BackgroundCompiler
 
 from .dual_module import DualModule, get_mixed_dual_module
 from .graph_management_utils import graph_file_management
@@ -22,6 +24,7 @@ from .param_utils import (
     parse_device,
     update_graph_with_constant_folding_info,
 )
+from .shape_bucket_util import shape_bucket_processor, ShapeBucketStats
 from .transform.builtin_transform import torch2oflow
 
 from .transform.manager import transform_mgr
@@ -43,6 +46,11 @@ def handle_deployable_exception(func):
             except Exception as e:
                 logger.error(f"Exception in {func.__name__}: {e=}")
                 logger.warning("Recompile oneflow module ...")
+                metrics.inc(
+                    "onediff_graph_recompiles_total",
+                    module=type(self._torch_module).__name__,
+                    reason="exception",
+                )
                 del self._deployable_module_model.oneflow_module
                 self._deployable_module_dpl_graph = None
                 return func(self, *args, **kwargs)
@@ -59,6 +67,16 @@ def get_oneflow_graph(model, size=9, dynamic_graph=True):
     return g
 
 
+def _take_background_compiler(instance, existing_module):
+    compiler = getattr(existing_module, "_deployable_module_background_compiler", None)
+    if compiler is None:
+        return
+    # Pending graphs are built on the existing module, wait for them before taking its graph
+    compiler.wait_ready()
+    if instance._deployable_module_background_compiler is not None:
+        instance._deployable_module_background_compiler = compiler
+
+
 class OneflowDeployableModule(DeployableModule):
     def __init__(
         self,
@@ -81,18 +99,28 @@ class OneflowDeployableModule(DeployableModule):
             options if options is not None else OneflowCompileOptions()
         )
         self._deployable_module_dpl_graph = None
-        self._deployable_module_graph_cache = LRUCache(
-            self._deployable_module_options.max_cached_graph_size
+        self._deployable_module_graph_cache = MemoryBudgetedCache(
+            self._deployable_module_options.max_cached_graph_size,
+            self._deployable_module_options.max_cached_graph_bytes,
+            self._deployable_module_options.graph_cache_policy,
+            size_fn=lambda graph: graph.memory_footprint,
         )
         self._is_raw_deployable_module = True
         self._load_graph_first_run = True
         self._deployable_module_input_structure_key = None
+        self._deployable_module_bucket_stats = ShapeBucketStats()
+        self._deployable_module_background_compiler = (
+            BackgroundCompiler()
+            if self._deployable_module_options.background_compile
+            else None
+        )
 
     @classmethod
     def from_existing(cls, existing_module, dynamic=True, options=None):
         torch_module = existing_module._deployable_module_model._torch_module
         oneflow_module = existing_module._deployable_module_model._oneflow_module
         instance = cls(torch_module, oneflow_module, dynamic, options)
+        _take_background_compiler(instance, existing_module)
         instance._deployable_module_dpl_graph = None
         if hasattr(existing_module, "_deployable_module_dpl_graph"):
             instance._deployable_module_dpl_graph = (
@@ -108,12 +136,18 @@ class OneflowDeployableModule(DeployableModule):
         instance._deployable_module_quant_config = (
             existing_module._deployable_module_quant_config
         )
+        instance._deployable_module_bucket_stats = (
+            existing_module._deployable_module_bucket_stats
+        )
 
         return instance
 
     def get_graph(self):
         if self._deployable_module_dpl_graph is not None:
             return self._deployable_module_dpl_graph
+        metrics.inc(
+            "onediff_graph_created_total", module=type(self._torch_module).__name__
+        )
         self._deployable_module_dpl_graph = get_oneflow_graph(
             self._deployable_module_model.oneflow_module,
             self._deployable_module_options.max_cached_graph_size,
@@ -128,7 +162,10 @@ class OneflowDeployableModule(DeployableModule):
             )
         return self._deployable_module_dpl_graph
 
+    @background_compile_wrapper
     @handle_deployable_exception
+    @shape_bucket_processor
+    @tuned_options_processor
     @graph_file_management
     @input_output_processor
     def apply_model(self, *args, **kwargs):
@@ -143,8 +180,11 @@ class OneflowDeployableModule(DeployableModule):
                 )
         return output
 
+    @background_compile_wrapper
     @handle_deployable_exception
     @quantize_and_deploy_wrapper
+    @shape_bucket_processor
+    @tuned_options_processor
     @graph_file_management
     @input_output_processor
     def forward(self, *args, **kwargs):
@@ -177,7 +217,10 @@ class OneflowDeployableModule(DeployableModule):
         return self
 
     # TODO(): Just for transformers VAE decoder
+    @background_compile_wrapper
     @handle_deployable_exception
+    @shape_bucket_processor
+    @tuned_options_processor
     @graph_file_management
     @input_output_processor
     def decode(self, *args, **kwargs):
@@ -211,6 +254,37 @@ class OneflowDeployableModule(DeployableModule):
     def save_graph(self, file_path, *, process_state_dict=lambda x: x):
         self.get_graph().save_graph(file_path, process_state_dict=process_state_dict)
 
+    def get_compile_states(self):
+        """Returns the background compilation state (pending, ready or failed) of each input signature."""
+        if self._deployable_module_background_compiler is None:
+            return {}
+        return self._deployable_module_background_compiler.get_states()
+
+    def wait_compile_ready(self, timeout=None) -> bool:
+        """Waits for background compilations, returns True if all of them are ready. Useful for health checks."""
+        if self._deployable_module_background_compiler is None:
+            return True
+        return self._deployable_module_background_compiler.wait_ready(timeout)
+
+    def pin_graph(self, input_structure_key=None) -> None:
+        """Keeps the graph of the input structure cached, defaults to the current input structure."""
+        key = input_structure_key or self._deployable_module_input_structure_key
+        if key is None:
+            raise RuntimeError("No graph to pin, run the module first.")
+        self._deployable_module_graph_cache.pin(key)
+
+    def unpin_graph(self, input_structure_key=None) -> None:
+        key = input_structure_key or self._deployable_module_input_structure_key
+        self._deployable_module_graph_cache.unpin(key)
+
+    def get_graph_cache_stats(self):
+        """Returns the entries, pinned keys, estimated bytes, hits, misses and evictions of the graph cache."""
+        return self._deployable_module_graph_cache.stats()
+
+    def get_shape_bucket_stats(self):
+        """Returns the counters of `options.shape_bucket`, such as bucket hits, pad overhead and new buckets."""
+        return self._deployable_module_bucket_stats.snapshot()
+
     def extra_repr(self) -> str:
         return self._deployable_module_model.extra_repr()
 
@@ -272,6 +346,7 @@ def get_mixed_deployable_module(module_cls):
             torch_module = existing_module._deployable_module_model._torch_module
             oneflow_module = existing_module._deployable_module_model._oneflow_module
             instance = cls(torch_module, oneflow_module, dynamic, options)
+            _take_background_compiler(instance, existing_module)
             instance._deployable_module_dpl_graph = None
             if hasattr(existing_module, "_deployable_module_dpl_graph"):
                 instance._deployable_module_dpl_graph = (
@@ -1,15 +1,90 @@
 import os
+import threading
 import types
-from itertools import chain
 from typing import Any
 
 import torch
 import oneflow as flow  # usort: skip
 from oneflow.utils.tensor import to_torch
 
-from onediff.utils import logger
+from onediff.utils import logger, metrics
 from .oneflow_exec_mode import oneflow_exec_mode, oneflow_exec_mode_enabled
 from .transform.builtin_transform import torch2oflow
+from .transform.manager import transform_mgr
+
+# Bumped when a submodule, parameter or buffer is replaced through any DualModule or
+# DualModuleList, since the wrappers returned by `DualModule.__getattr__` don't know the module
+# that indexed them. In-place updates of tensors keep the indexes.
+_tensor_index_version = 0
+
+
+# The torch2oflow conversion mocks classes and updates the maps of `transform_mgr`, which is not
+# thread safe, so modules converted by background compilation or warm-up threads are converted
+# one at a time. Building and running the graphs of converted modules is not serialized.
+_convert_lock = threading.RLock()
+
+
+def _invalidate_tensor_indexes():
+    global _tensor_index_version
+    _tensor_index_version += 1
+
+
+def _is_indexed(obj) -> bool:
+    """Whether replacing the object may change the tensor slots of the indexes."""
+    return isinstance(obj, (torch.nn.Module, torch.Tensor, flow.nn.Module))
+
+
+def _build_tensor_slots(module):
+    """The owner module, key, kind and owner name of each parameter and buffer of a module."""
+    tensor_slots = []
+    for name, owner in module.named_modules():
+        for is_buffer, tensors in ((False, owner._parameters), (True, owner._buffers)):
+            for key, tensor in tensors.items():
+                if tensor is not None:
+                    tensor_slots.append((owner, key, is_buffer, name))
+    return tensor_slots
+
+
+def _get_tensor(module, key, is_buffer):
+    tensors = module._buffers if is_buffer else module._parameters
+    return tensors.get(key, None)
+
+
+def _get_address(module, key, is_buffer):
+    tensor = _get_tensor(module, key, is_buffer)
+    return None if tensor is None else tensor.data_ptr()
+
+
+def _get_storage(tensor):
+    """The address and bytes of the memory of a tensor, the whole storage of torch tensors."""
+    if hasattr(tensor, "untyped_storage"):
+        storage = tensor.untyped_storage()
+        return storage.data_ptr(), storage.nbytes()
+    # oneflow tensors
+    return tensor.data_ptr(), tensor.numel() * tensor.element_size()
+
+
+def _count_moved_bytes(tensor_slots, addresses, oneflow_addresses) -> int:
+    """The bytes of the tensors whose address changed, each moved storage counted once.
+
+    A torch tensor that shares the memory of a oneflow tensor is moved if the oneflow tensor is.
+    """
+    moved_storages = {}
+    for (module, key, is_buffer, oneflow_module), address, oneflow_address in zip(
+        tensor_slots, addresses, oneflow_addresses
+    ):
+        if oneflow_address is not None:
+            tensor = _get_tensor(oneflow_module, key, is_buffer)
+            address = oneflow_address
+        else:
+            tensor = _get_tensor(module, key, is_buffer)
+        if tensor is None or tensor.data_ptr() == address:
+            continue
+        storage_address, nbytes = _get_storage(tensor)
+        moved_storages[storage_address] = max(
+            moved_storages.get(storage_address, 0), nbytes
+        )
+    return sum(moved_storages.values())
 
 
 class DualModule(torch.nn.Module):
@@ -20,15 +95,33 @@ class DualModule(torch.nn.Module):
         object.__setattr__(self, "_modules", torch_module._modules)
         object.__setattr__(self, "_parameters", torch_module._parameters)
         object.__setattr__(self, "_buffers", torch_module._buffers)
+        object.__setattr__(self, "_tensor_index", None)
+        object.__setattr__(self, "_tensor_index_version", None)
+        # The bytes moved by the last call of `to`
+        object.__setattr__(self, "last_moved_bytes", 0)
 
     @property
     def oneflow_module(self):
         if self._oneflow_module is not None:
             return self._oneflow_module
 
-        logger.debug(f"Convert {type(self._torch_module)} ...")
-        self._oneflow_module = torch2oflow(self._torch_module)
-        logger.debug(f"Convert {type(self._torch_module)} done!")
+        with _convert_lock:
+            if self._oneflow_module is not None:
+                # Converted by another thread meanwhile
+                return self._oneflow_module
+            logger.debug(f"Convert {type(self._torch_module)} ...")
+            with metrics.timer(
+                "onediff_module_convert_seconds",
+                track_memory=True,
+                module=type(self._torch_module).__name__,
+            ):
+                transform_mgr.prefetch_class_proxies(
+                    {type(m) for m in self._torch_module.modules()}
+                )
+                self._oneflow_module = torch2oflow(self._torch_module)
+                self._set_tensor_index(self._build_tensor_index())
+            transform_mgr.save_class_proxies()
+            logger.debug(f"Convert {type(self._torch_module)} done!")
 
         return self._oneflow_module
 
@@ -37,46 +130,102 @@ class DualModule(torch.nn.Module):
         if self._oneflow_module:
             del self._oneflow_module
             setattr(self, "_oneflow_module", None)
+            self._set_tensor_index(None)
 
     def to(self, *args, **kwargs):
-        if oneflow_exec_mode_enabled():
-            self._oneflow_module.to(*args, **kwargs)
+        """Moves the torch and oneflow tensors, and sets `last_moved_bytes` to the bytes moved.
+
+        The bytes of a moved storage are counted once, so the tensors that share it, e.g. the
+        torch tensors that get a view of a moved oneflow tensor, are not counted again.
+        """
+        if oneflow_exec_mode_enabled() or self._oneflow_module is None:
+            module = (
+                self._oneflow_module
+                if oneflow_exec_mode_enabled()
+                else self._torch_module
+            )
+            tensor_slots = [
+                (owner, key, is_buffer, None)
+                for owner, key, is_buffer, _ in _build_tensor_slots(module)
+            ]
+            addresses = [
+                _get_address(owner, key, is_buffer)
+                for owner, key, is_buffer, _ in tensor_slots
+            ]
+            module.to(*args, **kwargs)
+            moved_bytes = _count_moved_bytes(
+                tensor_slots, addresses, [None] * len(tensor_slots)
+            )
         else:
-            if self._oneflow_module is not None:
-                of_args = [torch2oflow(v) for v in args]
-                of_kwargs = {k: torch2oflow(v) for k, v in kwargs.items()}
-                self._oneflow_module.to(*of_args, **of_kwargs)
-                self._torch_module_to_with_check(*args, **kwargs)
-            else:
-                self._torch_module.to(*args, **kwargs)
+            tensor_index = self._get_tensor_index()
+            addresses = [
+                _get_address(torch_module, key, is_buffer)
+                for torch_module, key, is_buffer, _ in tensor_index
+            ]
+            oneflow_addresses = [
+                None
+                if oneflow_module is None
+                else _get_address(oneflow_module, key, is_buffer)
+                for _, key, is_buffer, oneflow_module in tensor_index
+            ]
+            of_args = [torch2oflow(v) for v in args]
+            of_kwargs = {k: torch2oflow(v) for k, v in kwargs.items()}
+            self._oneflow_module.to(*of_args, **of_kwargs)
+            self._torch_module_to_with_check(tensor_index, *args, **kwargs)
+            moved_bytes = _count_moved_bytes(tensor_index, addresses, oneflow_addresses)
 
-    def _torch_module_to_with_check(self, *args, **kwargs):
-        def _align_tensor(torch_module, oneflow_module):
-            oneflow_tensor_list = set(
-                [x for x, _ in oneflow_module.named_parameters()]
-                + [x for x, _ in oneflow_module.named_buffers()]
+        object.__setattr__(self, "last_moved_bytes", moved_bytes)
+        metrics.inc(
+            "onediff_dual_module_to_bytes_total",
+            moved_bytes,
+            module=type(self._torch_module).__name__,
+        )
+        logger.debug(f"Moved {moved_bytes} bytes of {type(self._torch_module)}")
+
+    def _set_tensor_index(self, tensor_index):
+        object.__setattr__(self, "_tensor_index", tensor_index)
+        object.__setattr__(self, "_tensor_index_version", _tensor_index_version)
+
+    def _build_tensor_index(self):
+        """Indexes each torch tensor with the module that owns the oneflow tensor of the same name.
+
+        Tensors are looked up by owner and key rather than by object, because `to` may replace
+        the oneflow tensor objects.
+        """
+        oneflow_modules = dict(self._oneflow_module.named_modules())
+        return [
+            (torch_module, key, is_buffer, oneflow_modules.get(name, None))
+            for torch_module, key, is_buffer, name in _build_tensor_slots(
+                self._torch_module
             )
-            for name, tensor in chain.from_iterable(
-                [
-                    torch_module.named_parameters(),
-                    torch_module.named_buffers(),
-                ]
-            ):
-                if name not in oneflow_tensor_list:
-                    tensor.data = tensor.to(*args, **kwargs)
-                else:
-                    oneflow_tensor = oneflow_module.get_parameter(name)
-                    if oneflow_tensor is None:
-                        tensor.data = tensor.to(*args, **kwargs)
-                    elif tensor.data_ptr() != oneflow_tensor.data_ptr():
-                        tensor.data = to_torch(oneflow_tensor.data)
-
-        oneflow_module_list = set([x for x, _ in self._oneflow_module.named_modules()])
-        for name, module in self._torch_module.named_modules():
-            if name not in oneflow_module_list:
-                module.to(*args, **kwargs)
-            else:
-                _align_tensor(module, self._oneflow_module.get_submodule(name))
+        ]
+
+    def _get_tensor_index(self):
+        tensor_index = self._tensor_index
+        if tensor_index is None or self._tensor_index_version != _tensor_index_version:
+            tensor_index = self._build_tensor_index()
+            # Only the module that converted the oneflow module keeps its index, the
+            # wrappers of submodules returned by `__getattr__` are thrown away.
+            if self._tensor_index is not None:
+                self._set_tensor_index(tensor_index)
+        return tensor_index
+
+    def _torch_module_to_with_check(self, tensor_index, *args, **kwargs):
+        """Moves the torch tensors in one pass, sharing the memory of the moved oneflow tensors."""
+        for torch_module, key, is_buffer, oneflow_module in tensor_index:
+            tensor = _get_tensor(torch_module, key, is_buffer)
+            if tensor is None:
+                continue
+            oneflow_tensor = None
+            if oneflow_module is not None:
+                oneflow_tensor = _get_tensor(oneflow_module, key, is_buffer)
+
+            if oneflow_tensor is None:
+                moved_tensor = tensor.to(*args, **kwargs)
+                if moved_tensor is not tensor:
+                    tensor.data = moved_tensor
+            elif tensor.data_ptr() != oneflow_tensor.data_ptr():
+                tensor.data = to_torch(oneflow_tensor.data)
 
     def __getattr__(self, name):
         if name == "_torch_module" or name == "_oneflow_module":
@@ -103,7 +252,6 @@ class DualModule(torch.nn.Module):
         if name in ["_torch_module", "_oneflow_module"]:
             super().__setattr__(name, value)
         else:  # TODO: aviod memory up when set attr
-
             module = self._torch_module
             if (
                 hasattr(module, "_disable_param_update")
@@ -114,8 +262,11 @@ class DualModule(torch.nn.Module):
             torch_obj = getattr(module, name)
 
             if hasattr(torch_obj, "copy_"):
+                # In place, the tensor stays in its slot
                 torch_obj.copy_(value)
             else:
+                if _is_indexed(torch_obj) or _is_indexed(value):
+                    _invalidate_tensor_indexes()
                 setattr(module, name, value)
 
     def extra_repr(self) -> str:
@@ -143,6 +294,7 @@ class DualModuleList(torch.nn.ModuleList):
         self += dual_modules
 
     def __setitem__(self, idx: int, module: DualModule):
+        _invalidate_tensor_indexes()
         idx = self._get_abs_string_index(idx)
         setattr(self._torch_modules, str(idx), module._torch_module)
         setattr(self._oneflow_modules, str(idx), module._oneflow_module)
@@ -151,12 +303,15 @@ class DualModuleList(torch.nn.ModuleList):
     def __setattr__(self, key, value):
         if key in ("_torch_modules", "_oneflow_modules"):
             return object.__setattr__(self, key, value)
+        if _is_indexed(value) or _is_indexed(getattr(self._torch_modules, key, None)):
+            _invalidate_tensor_indexes()
         if isinstance(value, DualModule):
             setattr(self._torch_modules, key, value._torch_module)
             setattr(self._oneflow_modules, key, value._oneflow_module)
         else:
             setattr(self._torch_modules, key, value)
-            value = torch2oflow(value)
+            with _convert_lock:
+                value = torch2oflow(value)
             setattr(self._oneflow_modules, key, value)
         return object.__setattr__(self, key, value)
 
@@ -1,16 +1,82 @@
+import threading
+from contextlib import contextmanager
+
+import torch
 import oneflow as flow  # usort: skip
 
-from onediff.utils import logger
+from onediff.utils import logger, metrics
+from onediff.utils.metrics_utils import _get_host_memory_used
 from .transform.builtin_transform import reverse_proxy_class
 from .transform.manager import transform_mgr
 from .utils.cost_util import cost_cnt
 
 
+def _get_device_memory_used() -> int:
+    # cudaMemGetInfo also accounts for the memory allocated by oneflow
+    if not torch.cuda.is_available():
+        return 0
+    free, total = torch.cuda.mem_get_info()
+    return total - free
+
+
+def _get_state_dict_bytes(state_dict) -> int:
+    if isinstance(state_dict, flow.Tensor):
+        return state_dict.nelement() * state_dict.element_size()
+    if isinstance(state_dict, dict):
+        return sum(_get_state_dict_bytes(value) for value in state_dict.values())
+    if isinstance(state_dict, (list, tuple)):
+        return sum(_get_state_dict_bytes(value) for value in state_dict)
+    return 0
+
+
+class _Measurement:
+    def __init__(self):
+        self.max_concurrency = 1
+
+
+# The builds and loads being measured, they run concurrently on worker threads
+_measurements = set()
+_measurements_lock = threading.Lock()
+
+
+@contextmanager
+def _measure_memory_footprint(graph, fallback_fn=None):
+    """Adds the growth of the used host and device memory to `graph.memory_footprint`.
+
+    The footprint is approximate: the process-wide memory also grows with the activations of
+    the first run and the allocations of other threads, e.g. eager calls, and shrinks when the
+    allocators reuse cached blocks, in which case `fallback_fn()` is counted if given. The
+    growth while several builds or loads overlap is shared evenly among them, so concurrent
+    builds are not counted twice, without serializing them.
+    """
+    measurement = _Measurement()
+    with _measurements_lock:
+        _measurements.add(measurement)
+        for other in _measurements:
+            other.max_concurrency = max(other.max_concurrency, len(_measurements))
+    host_memory = _get_host_memory_used()
+    device_memory = _get_device_memory_used()
+    try:
+        yield
+    finally:
+        host_memory = max(0, _get_host_memory_used() - host_memory)
+        device_memory = max(0, _get_device_memory_used() - device_memory)
+        with _measurements_lock:
+            _measurements.discard(measurement)
+        footprint = (host_memory + device_memory) // measurement.max_concurrency
+        if footprint == 0 and fallback_fn is not None:
+            footprint = fallback_fn()
+        graph.memory_footprint += footprint
+
+
 class OneflowGraph(flow.nn.Graph):
     @flow.nn.Graph.with_dynamic_input_shape()
     def __init__(self, model):
         super().__init__(enable_get_runtime_state_dict=True)
         self.model = model
+        # Approximate device and host memory used by building or loading this graph,
+        # see _measure_memory_footprint
+        self.memory_footprint = 0
         logger.info(f"Building a graph for {model.__class__.__name__} ...")
         # self.config.enable_cudnn_conv_heuristic_search_algo(False)
         self.config.allow_fuse_add_to_output(True)
@@ -18,6 +84,16 @@ class OneflowGraph(flow.nn.Graph):
     def build(self, *args, **kwargs):
         return self.model(*args, **kwargs)
 
+    def __call__(self, *args, **kwargs):
+        if self.is_compiled:
+            return super().__call__(*args, **kwargs)
+        with _measure_memory_footprint(self), metrics.timer(
+            "onediff_graph_build_seconds",
+            track_memory=True,
+            module=type(self.model).__name__,
+        ):
+            return super().__call__(*args, **kwargs)
+
     @cost_cnt(transform_mgr.debug_mode)
     def load_graph(self, file_path, device=None, run_warmup=True, *, state_dict=None):
         state_dict = state_dict if state_dict is not None else flow.load(file_path)
@@ -26,10 +102,24 @@ class OneflowGraph(flow.nn.Graph):
         if device is not None:
             state_dict = flow.nn.Graph.runtime_state_dict_to(state_dict, device)
 
-        self.load_runtime_state_dict(state_dict, warmup_with_run=run_warmup)
+        # The allocators may reuse cached blocks, count the loaded tensors instead
+        with _measure_memory_footprint(
+            self, lambda: _get_state_dict_bytes(state_dict)
+        ), metrics.timer(
+            "onediff_graph_load_seconds",
+            track_memory=True,
+            module=type(self.model).__name__,
+        ):
+            self.load_runtime_state_dict(state_dict, warmup_with_run=run_warmup)
 
     @cost_cnt(transform_mgr.debug_mode)
     def save_graph(self, file_path, *, process_state_dict: lambda x: x):
+        with metrics.timer(
+            "onediff_graph_save_seconds", module=type(self.model).__name__
+        ):
+            self._save_graph(file_path, process_state_dict=process_state_dict)
+
+    def _save_graph(self, file_path, *, process_state_dict: lambda x: x):
         if hasattr(self, "graph_state_dict"):
             flow.save(self.graph_state_dict, file_path)
             return
@@ -1,3 +1,4 @@
+import dataclasses
 import importlib
 import os
 from typing import Dict
@@ -9,13 +10,29 @@ from pathlib import Path
 
 from oneflow.framework.args_tree import ArgsTree
 
-from onediff.utils import logger
+import onediff
+from onediff.utils import logger, metrics
 from ..env_var import OneflowCompileOptions
+from .args_tree_util import get_input_structure_key
 from .transform.builtin_transform import torch2oflow
 from .transform.manager import transform_mgr
 from .utils.cost_util import cost_time
+from .utils.graph_repository import generate_content_key, GraphRepository
 from .utils.hash_utils import generate_input_structure_key, generate_model_structure_key
 
+# Options that don't change the compiled graph, so they are excluded from the graph key.
+_GRAPH_KEY_IGNORED_OPTIONS = (
+    "debug_level",
+    "max_cached_graph_size",
+    "max_cached_graph_bytes",
+    "graph_cache_policy",
+    "graph_file",
+    "graph_file_max_size",
+    "graph_file_max_entries",
+    "shape_bucket",
+    "background_compile",
+)
+
 
 def _prepare_file_path(file_path):
     if isinstance(file_path, Path):
@@ -36,6 +53,29 @@ def generate_graph_file_name(file_path, deployable_module, args, kwargs):
     return f"{file_path}_{cache_key}.graph"
 
 
+def generate_graph_key(deployable_module, args_tree, input_structure_key):
+    """Generate a content-addressed key of the graph compiled for the inputs."""
+    tensor_meta = [
+        f"{node.dtype}@{node.device.type}"
+        for node in args_tree.iter_nodes()
+        if isinstance(node, torch.Tensor)
+    ]
+    options = deployable_module._deployable_module_options
+    options_key = {
+        field.name: getattr(options, field.name)
+        for field in dataclasses.fields(options)
+        if field.name not in _GRAPH_KEY_IGNORED_OPTIONS
+    }
+    return generate_content_key(
+        input_structure_key,
+        generate_model_structure_key(deployable_module),
+        tensor_meta,
+        onediff.__version__,
+        flow.__version__,
+        options_key,
+    )
+
+
 def graph_file_management(func):
     @wraps(func)
     def wrapper(self: "OneflowDeployableModule", *args, **kwargs):
@@ -48,21 +88,26 @@ def graph_file_management(func):
         is_first_load = self._load_graph_first_run and graph_file is not None
 
         if self._deployable_module_input_structure_key is None:
-            args_tree = ArgsTree(
-                (args, kwargs), gen_name=False, tensor_type=torch.Tensor
-            )
-            self._deployable_module_input_structure_key = generate_input_structure_key(
-                args_tree
+            self._deployable_module_input_structure_key = get_input_structure_key(
+                args, kwargs
             )
 
         if is_first_load:
             self._load_graph_first_run = False
-            input_structure_key = self._deployable_module_input_structure_key
-            model_structure_key = generate_model_structure_key(deployable_module=self)
+            args_tree = ArgsTree(
+                (args, kwargs), gen_name=False, tensor_type=torch.Tensor
+            )
             file_path = _prepare_file_path(graph_file)
-            graph_file = (
-                f"{file_path}_{input_structure_key}_{model_structure_key}.graph"
+            repository = GraphRepository(
+                os.path.dirname(file_path),
+                max_size=compile_options.graph_file_max_size,
+                max_entries=compile_options.graph_file_max_entries,
+            )
+            graph_key = generate_graph_key(
+                self, args_tree, self._deployable_module_input_structure_key
             )
+            graph_file_prefix = os.path.basename(file_path)
+            graph_file = repository.get_file_path(graph_key, graph_file_prefix)
 
         def process_state_dict_before_saving(state_dict: Dict):
             nonlocal self, args, kwargs, graph_file
@@ -80,11 +125,18 @@ def graph_file_management(func):
             if not is_first_load:
                 return
 
-            if not os.path.exists(graph_file):
+            cached_graph_file = repository.lookup(graph_key, graph_file_prefix)
+            metrics.inc(
+                "onediff_graph_file_hits_total"
+                if cached_graph_file is not None
+                else "onediff_graph_file_misses_total"
+            )
+            if cached_graph_file is None:
                 logger.info(
                     f"Graph file {graph_file} does not exist! Generating graph."
                 )
             else:
+                graph_file = cached_graph_file
                 graph_device = compile_options.graph_file_device
                 state_dict = flow.load(graph_file)
                 self.load_graph(
@@ -98,17 +150,13 @@ def graph_file_management(func):
             if not is_first_load:
                 return
 
-            parent_dir = os.path.dirname(graph_file)
-            if parent_dir != "":
-                os.makedirs(parent_dir, exist_ok=True)
-
-            # Avoid graph file conflicts
-            if os.path.exists(graph_file):
-                raise FileExistsError(f"File {graph_file} exists!")
             try:
-
-                self.save_graph(
-                    graph_file, process_state_dict=process_state_dict_before_saving
+                graph_file = repository.commit(
+                    graph_key,
+                    lambda file_path: self.save_graph(
+                        file_path, process_state_dict=process_state_dict_before_saving
+                    ),
+                    prefix=graph_file_prefix,
                 )
                 logger.info(f"Saved graph file: {graph_file}")
 
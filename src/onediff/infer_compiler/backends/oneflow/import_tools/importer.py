@@ -1,6 +1,7 @@
 import importlib
 import os
 import sys
+import threading
 from functools import lru_cache
 from importlib.metadata import requires
 from inspect import ismodule
@@ -69,6 +70,10 @@ class LazyMocker:
         self.tmp_dir = tmp_dir
         self.mocked_packages = set()
         self.cleanup_list = []
+        # Mocked modules by module path, so each package and module is only mocked once.
+        self._mock_modules = {}
+        # Mocking patches the import system of the whole process, so it is done by one thread at a time.
+        self._lock = threading.RLock()
 
     def mock_package(self, package: str):
         pass
@@ -92,7 +97,41 @@ class LazyMocker:
             >>> mocker.mock_entity(cls_obj)
             <class 'mock_models_of.DemoModel'>
         """
-        return self.load_entity_with_mock(entity)
+        with self._lock:
+            return self.load_entity_with_mock(entity)
+
+    def mock_entity_at(self, entity: str, module_name: str, qualname: str):
+        """Mock the entity by importing the module that defines it, in the mock context of its package.
+
+        It skips resolving the attributes on the way to the entity, see `load_entity_with_mock`.
+        Returns None if the import doesn't give a mocked entity.
+        """
+        main_pkg = entity.split(".")[0]
+        if main_pkg == "__main__":
+            return None
+        with self._lock:
+            mock_pkg = self._get_mock_package(main_pkg)
+            with mock_pkg._main_pkg_enable():
+                mock_obj = importlib.import_module(module_name)
+                for name in qualname.split("."):
+                    mock_obj = getattr(mock_obj, name)
+        obj = importlib.import_module(module_name)
+        for name in qualname.split("."):
+            obj = getattr(obj, name, None)
+        if mock_obj is obj:
+            # The unmocked module was imported
+            return None
+        return mock_obj
+
+    def _get_mock_package(self, main_pkg: str) -> DynamicMockModule:
+        mock_pkg = self._mock_modules.get(main_pkg, None)
+        if mock_pkg is None:
+            # add package path to sys.path to avoid mock error
+            self.add_mocked_package(main_pkg)
+
+            mock_pkg = DynamicMockModule.from_package(main_pkg, verbose=False)
+            self._mock_modules[main_pkg] = mock_pkg
+        return mock_pkg
 
     def add_mocked_package(self, package: str):
         if package in self.mocked_packages:
@@ -125,10 +164,15 @@ class LazyMocker:
                 mock_main = getattr(mock_main, name)
             return mock_main
 
-        # add package path to sys.path to avoid mock error
-        self.add_mocked_package(attrs[0])
-
-        mock_pkg = DynamicMockModule.from_package(attrs[0], verbose=False)
+        mock_pkg = self._get_mock_package(attrs[0])
+        path = attrs[0]
         for name in attrs[1:]:
+            path = f"{path}.{name}"
+            mock_module = self._mock_modules.get(path, None)
+            if mock_module is not None:
+                mock_pkg = mock_module
+                continue
             mock_pkg = getattr(mock_pkg, name)
+            if isinstance(mock_pkg, DynamicMockModule):
+                self._mock_modules[path] = mock_pkg
         return mock_pkg
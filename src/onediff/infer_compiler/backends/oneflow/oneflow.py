@@ -17,8 +17,23 @@ def compile(torch_module: torch.nn.Module, *, options=None):
         - 'use_graph' whether to optimize with oneflow.nn.Graph, default True.
         - 'debug' which config the nn.Graph debug level, default -1(no debug info), max 3(max debug info).
         - 'size' which config the cache size when cache is enabled. Note that after onediff v0.12, cache is default disabled.
+        - 'max_cached_graph_bytes' (None) the byte budget of the graphs cached per input structure, by their approximate
+                     device and host memory footprint, the process memory growth while a graph is built or
+                     loaded, shared among the concurrent builds, see graph.py. Pinned graphs are never evicted, see `pin_graph`.
+        - 'graph_cache_policy' ("lru") the eviction policy of the graph cache, "lru" or "lfu".
         - 'graph_file' (None) generates a compilation cache file. If the file exists, loading occurs; if not, the compilation result is saved after the first run.
         - 'graph_file_device' (None) sets the device for the graph file, default None.  If set, the compilation result will be converted to the specified device.
+        - 'graph_file_max_size' (None) the size budget in bytes of the graph file directory. Least recently used graph files are evicted when exceeded.
+        - 'graph_file_max_entries' (None) the maximum number of graph files kept in the graph file directory.
+        - 'shape_bucket' (None) a ShapeBucketPolicy. If set, the batch size, height and width of inputs are rounded up to
+                     the declared buckets, inputs are padded and outputs are cropped, so a bounded set of graphs serves all traffic.
+        - 'background_compile' (False) if True, a call with a new input signature runs the torch module eagerly while
+                     the graph is built on a worker thread, later calls use the graph once it is ready.
+                     The graphs are built by ONEDIFF_BACKGROUND_COMPILE_WORKERS (1) threads shared by the process,
+                     for `forward`, `apply_model` and `decode`.
+    Options tuned by `autotune` for the module and inputs are applied when a graph is built, see autotune_utils.
+    Set ONEDIFF_CONVERT_WORKERS above 1 to convert the independent subtrees of the torch module on that many threads.
+    Set ONEDIFF_CLASS_PROXY_CACHE_FILE to persist the resolved class proxies across runs, see class_proxy_cache.
     """
     from ..env_var import (
         OneflowCompileOptions,
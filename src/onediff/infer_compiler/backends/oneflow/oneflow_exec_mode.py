@@ -1,4 +1,8 @@
-_ONEFLOW_EXEC_MODE = False
+import threading
+
+# Per thread, so a graph built on a background thread doesn't switch the attributes of the
+# DualModules used by the eager calls of other threads to oneflow.
+_ONEFLOW_EXEC_MODE = threading.local()
 
 
 class oneflow_exec_mode(object):
@@ -11,20 +15,17 @@ class oneflow_exec_mode(object):
     def __enter__(self):
         import oneflow as flow  # usort: skip
 
-        global _ONEFLOW_EXEC_MODE
-        self.prev_mode = _ONEFLOW_EXEC_MODE
-        _ONEFLOW_EXEC_MODE = self.enabled
+        self.prev_mode = oneflow_exec_mode_enabled()
+        _ONEFLOW_EXEC_MODE.enabled = self.enabled
         self.prev_grad_mode = flow.is_grad_enabled()
         _ = flow.set_grad_enabled(False)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         import oneflow as flow  # usort: skip
 
-        global _ONEFLOW_EXEC_MODE
-        _ONEFLOW_EXEC_MODE = self.prev_mode
+        _ONEFLOW_EXEC_MODE.enabled = self.prev_mode
         _ = flow.set_grad_enabled(self.prev_grad_mode)
 
 
 def oneflow_exec_mode_enabled():
-    global _ONEFLOW_EXEC_MODE
-    return _ONEFLOW_EXEC_MODE
+    return getattr(_ONEFLOW_EXEC_MODE, "enabled", False)
@@ -183,6 +183,10 @@ def forward_generate_constant_folding_info_hook(module, args, output):
     if module._deployable_module_dpl_graph is None:
         return
 
+    # The graph may still be building in background, see `background_compile`.
+    if not module._deployable_module_dpl_graph.is_compiled:
+        return
+
     if getattr(module, CONSTANT_FOLDING_INFO_ATTR, None) is not None:
         return
 
@@ -0,0 +1,264 @@
+import collections
+from fractions import Fraction
+from functools import wraps
+from typing import Dict, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from oneflow.framework.args_tree import ArgsTree
+
+from onediff.utils import logger
+
+
+class ShapeBucketStats:
+    """Counters for tuning bucket sets from production traffic."""
+
+    def __init__(self):
+        self.bucket_hits = collections.Counter()
+        self.shape_hits = collections.Counter()
+        # Buckets seen for the first time, each needs a graph, which may be cached or loaded
+        self.new_buckets = 0
+        # Calls run at their own shape, since some inputs can't be padded to the bucket
+        self.unbucketed = collections.Counter()
+        self.input_elements = 0
+        self.pad_elements = 0
+
+    def record(self, shape, bucket, input_elements, pad_elements):
+        if bucket not in self.bucket_hits:
+            self.new_buckets += 1
+        self.bucket_hits[bucket] += 1
+        self.shape_hits[shape] += 1
+        self.input_elements += input_elements
+        self.pad_elements += pad_elements
+
+    def record_unbucketed(self, reason: str) -> None:
+        if reason not in self.unbucketed:
+            logger.warning(f"Shape bucketing is skipped: {reason}")
+        self.unbucketed[reason] += 1
+
+    def snapshot(self) -> Dict:
+        total = self.input_elements + self.pad_elements
+        return {
+            "bucket_hits": {
+                "x".join(map(str, k)): v for k, v in self.bucket_hits.items()
+            },
+            "shape_hits": {
+                "x".join(map(str, k)): v for k, v in self.shape_hits.items()
+            },
+            "new_buckets": self.new_buckets,
+            "unbucketed": dict(self.unbucketed),
+            "pad_elements": self.pad_elements,
+            "pad_overhead": self.pad_elements / total if total > 0 else 0.0,
+        }
+
+
+def _find_reference_tensor(args_tree: ArgsTree):
+    for node in args_tree.iter_nodes():
+        if isinstance(node, torch.Tensor) and node.ndim == 4:
+            return node
+    return None
+
+
+def _scale_of(size: Tuple[int, int], reference: Tuple[int, int]) -> Optional[Fraction]:
+    """The spatial scale of `size` to `reference`, e.g. 1/8 for a ControlNet residual."""
+    h, w = size
+    ref_h, ref_w = reference
+    scale = Fraction(h, ref_h)
+    if Fraction(w, ref_w) != scale:
+        return None
+    return scale
+
+
+def _scaled(size: int, scale: Fraction) -> Optional[int]:
+    value = size * scale
+    return int(value) if value.denominator == 1 else None
+
+
+def _pad_batch(tensor: torch.Tensor, batch_size: int) -> torch.Tensor:
+    pad = batch_size - tensor.shape[0]
+    last = tensor[-1:].expand(pad, *tensor.shape[1:])
+    return torch.cat([tensor, last], dim=0)
+
+
+def _batch_arg_tensor_ids(args, kwargs, batch_args) -> set:
+    ids = set()
+    for name in batch_args:
+        if isinstance(name, int):
+            value = args[name] if name < len(args) else None
+        else:
+            value = kwargs.get(name, None)
+        value_tree = ArgsTree((value, None), False, tensor_type=torch.Tensor)
+        ids.update(
+            id(node)
+            for node in value_tree.iter_nodes()
+            if isinstance(node, torch.Tensor)
+        )
+    return ids
+
+
+def plan_bucket(policy, args, kwargs, stats: Optional[ShapeBucketStats] = None):
+    """Returns the input shape, the bucket shape and the ids of the tensors padded along the
+    batch, or None if the inputs have no 4-D tensor.
+
+    Every 4-D tensor is padded spatially at its scale to the first 4-D tensor, e.g. 1/2 to
+    1/8 for the ControlNet residuals of a latent. If a 4-D tensor has no such scale, or its
+    padded size is fractional, the height and width are not bucketed. Along the batch, the
+    4-D tensors and the tensors of `policy.batch_args` whose dim 0 is the batch size are
+    padded. Without `batch_args`, the batch is not bucketed if other tensors have the batch
+    size as their dim 0, since they can't be told apart from unrelated tensors.
+    """
+    args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+    reference = _find_reference_tensor(args_tree)
+    if reference is None:
+        return None
+
+    batch_size, height, width = (
+        reference.shape[0],
+        reference.shape[2],
+        reference.shape[3],
+    )
+    bucket_batch_size, bucket_height, bucket_width = policy.get_bucket_shape(
+        batch_size, height, width
+    )
+    tensors = [
+        node for node in args_tree.iter_nodes() if isinstance(node, torch.Tensor)
+    ]
+
+    if (bucket_height, bucket_width) != (height, width):
+        for tensor in tensors:
+            if tensor.ndim != 4:
+                continue
+            scale = _scale_of(tensor.shape[2:], (height, width))
+            if (
+                scale is None
+                or _scaled(bucket_height, scale) is None
+                or _scaled(bucket_width, scale) is None
+            ):
+                if stats is not None:
+                    stats.record_unbucketed(
+                        f"input of shape {tuple(tensor.shape)} has no integer size in bucket {bucket_height}x{bucket_width}"
+                    )
+                bucket_height, bucket_width = height, width
+                break
+
+    batch_ids = set()
+    if bucket_batch_size != batch_size:
+        batch_ids = {id(t) for t in tensors if t.ndim == 4 and t.shape[0] == batch_size}
+        batch_args = getattr(policy, "batch_args", None)
+        if batch_args is not None:
+            batch_ids |= _batch_arg_tensor_ids(args, kwargs, batch_args)
+        elif any(
+            t.ndim > 0 and t.ndim != 4 and t.shape[0] == batch_size for t in tensors
+        ):
+            if stats is not None:
+                stats.record_unbucketed(
+                    "the batch of inputs other than 4-D tensors is ambiguous, set ShapeBucketPolicy.batch_args"
+                )
+            bucket_batch_size = batch_size
+            batch_ids = set()
+
+    return (
+        (batch_size, height, width),
+        (bucket_batch_size, bucket_height, bucket_width),
+        batch_ids,
+    )
+
+
+def pad_inputs(policy, args, kwargs, shape, bucket, batch_ids):
+    """Pads the inputs planned by `plan_bucket`, returns args, kwargs and the padded elements."""
+    batch_size, height, width = shape
+    bucket_batch_size, bucket_height, bucket_width = bucket
+    pad_elements = 0
+
+    def pad_fn(value):
+        nonlocal pad_elements
+        if not isinstance(value, torch.Tensor):
+            return value
+        numel = value.numel()
+        if id(value) in batch_ids:
+            value = _pad_batch(value, bucket_batch_size)
+        if value.ndim == 4 and (bucket_height, bucket_width) != (height, width):
+            scale = _scale_of(value.shape[2:], (height, width))
+            pad_h = _scaled(bucket_height, scale) - value.shape[2]
+            pad_w = _scaled(bucket_width, scale) - value.shape[3]
+            if pad_h > 0 or pad_w > 0:
+                value = F.pad(value, (0, pad_w, 0, pad_h), mode=policy.pad_mode)
+        pad_elements += value.numel() - numel
+        return value
+
+    args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+    out = args_tree.map_leaf(pad_fn)
+    return out[0], out[1], pad_elements
+
+
+def crop_outputs(output, shape, bucket):
+    """Crops the outputs of padded inputs back to the input shape, at the scale of each."""
+    batch_size, height, width = shape
+    bucket_batch_size, bucket_height, bucket_width = bucket
+
+    def crop_fn(value):
+        if not isinstance(value, torch.Tensor):
+            return value
+        if (
+            value.ndim > 0
+            and value.shape[0] == bucket_batch_size
+            and bucket_batch_size != batch_size
+        ):
+            value = value[:batch_size]
+        if value.ndim == 4 and (bucket_height, bucket_width) != (height, width):
+            scale = _scale_of(value.shape[2:], (bucket_height, bucket_width))
+            if scale is not None:
+                out_h, out_w = _scaled(height, scale), _scaled(width, scale)
+                if out_h is not None and out_w is not None:
+                    value = value[:, :, :out_h, :out_w]
+        return value
+
+    out_tree = ArgsTree((output, None), False, tensor_type=torch.Tensor)
+    return out_tree.map_leaf(crop_fn)[0]
+
+
+def shape_bucket_processor(func):
+    """Pad torch inputs to the bucket shape of `options.shape_bucket` and crop the outputs."""
+
+    @wraps(func)
+    def wrapper(self: "OneflowDeployableModule", *args, **kwargs):
+        policy = self._deployable_module_options.shape_bucket
+        if policy is None:
+            return func(self, *args, **kwargs)
+
+        stats = self._deployable_module_bucket_stats
+        plan = plan_bucket(policy, args, kwargs, stats)
+        if plan is None:
+            return func(self, *args, **kwargs)
+        shape, bucket, batch_ids = plan
+
+        args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+        input_elements = sum(
+            node.numel()
+            for node in args_tree.iter_nodes()
+            if isinstance(node, torch.Tensor)
+        )
+        pad_elements = 0
+        if bucket != shape:
+            args, kwargs, pad_elements = pad_inputs(
+                policy, args, kwargs, shape, bucket, batch_ids
+            )
+
+        num_buckets = len(stats.bucket_hits)
+        stats.record(shape, bucket, input_elements, pad_elements)
+        if len(stats.bucket_hits) > num_buckets:
+            logger.info(f"New shape bucket {bucket} for input shape {shape}")
+            if (
+                len(stats.bucket_hits)
+                > self._deployable_module_options.max_cached_graph_size
+            ):
+                logger.warning(
+                    f"The number of shape buckets {len(stats.bucket_hits)} exceeds max_cached_graph_size, graphs will be rebuilt."
+                )
+
+        output = func(self, *args, **kwargs)
+        if bucket == shape:
+            return output
+        return crop_outputs(output, shape, bucket)
+
+    return wrapper
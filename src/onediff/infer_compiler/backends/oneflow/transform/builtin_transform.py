@@ -2,17 +2,20 @@
 
 import importlib
 import os
+import threading
 import traceback
 import types
 from collections import OrderedDict
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial, singledispatch
 from typing import Any, Union
 
 import torch
 import oneflow as flow  # usort: skip
 
-from onediff.utils import logger
+from onediff.utils import logger, parse_integer_from_env
 from ..import_tools.importer import is_need_mock
 from .manager import transform_mgr
 
@@ -193,6 +196,91 @@ def default_converter(obj, verbose=False, *, proxy_cls=None, bypass_check=False)
         return obj
 
 
+_convert_local = threading.local()
+
+
+def _plan_subtrees(mod: torch.nn.Module, num_workers: int) -> list:
+    """Splits the module tree into disjoint subtrees of at most 1 / (2 * num_workers) of its modules.
+
+    Subtrees such as the down and up blocks of a UNet are independent, so they can be converted
+    concurrently. Modules that appear more than once in the tree and the small modules left
+    between the subtrees are converted by the calling thread.
+    """
+    sizes, counts = {}, {}
+
+    def count(module):
+        counts[id(module)] = counts.get(id(module), 0) + 1
+        if id(module) in sizes:
+            return sizes[id(module)]
+        sizes[id(module)] = 1 + sum(
+            count(child) for child in module._modules.values() if child is not None
+        )
+        return sizes[id(module)]
+
+    target = count(mod) / (2 * num_workers)
+    subtrees, frontier = [], [mod]
+    while frontier:
+        for child in frontier.pop()._modules.values():
+            if child is None or counts[id(child)] > 1:
+                continue
+            if sizes[id(child)] > target and child._modules:
+                frontier.append(child)
+            elif sizes[id(child)] > 1:
+                subtrees.append(child)
+    return subtrees
+
+
+@contextmanager
+def _convert_subtrees_concurrently(mod: torch.nn.Module):
+    """Converts the independent subtrees of `mod` in a thread pool while the tree is converted.
+
+    The number of threads is set by ONEDIFF_CONVERT_WORKERS (default 1, which converts serially).
+    It is opt-in, since the workers share the maps of `transform_mgr` without a lock. Class
+    proxies should be resolved in advance by `transform_mgr.prefetch_class_proxies`,
+    since mocking is serialized.
+    """
+    num_workers = parse_integer_from_env("ONEDIFF_CONVERT_WORKERS", 1)
+    if (
+        num_workers <= 1
+        or getattr(_convert_local, "futures", None) is not None
+        or getattr(_convert_local, "in_worker", False)
+    ):
+        yield
+        return
+    subtrees = _plan_subtrees(mod, num_workers)
+    if len(subtrees) <= 1:
+        yield
+        return
+
+    def convert(module):
+        _convert_local.in_worker = True
+        try:
+            return torch2oflow(module)
+        finally:
+            _convert_local.in_worker = False
+
+    with ThreadPoolExecutor(
+        max_workers=min(num_workers, len(subtrees)),
+        thread_name_prefix="onediff_convert",
+    ) as executor:
+        _convert_local.futures = {
+            id(module): executor.submit(convert, module) for module in subtrees
+        }
+        try:
+            yield
+        finally:
+            _convert_local.futures = None
+
+
+def _convert_submodules(modules: OrderedDict) -> OrderedDict:
+    """Converts the children of a module, or takes those converted by a worker thread."""
+    futures = getattr(_convert_local, "futures", None) or {}
+    return OrderedDict(
+        (n, futures[id(m)].result() if id(m) in futures else torch2oflow(m))
+        for n, m in modules.items()
+    )
+
+
 @torch2oflow.register
 def _(mod: torch.nn.Module, verbose=False):
     proxy_md = ProxySubmodule(mod)
@@ -210,8 +298,7 @@ def _(mod: torch.nn.Module, verbose=False):
             self._parameters[n] = torch2oflow(p)
         for n, b in list(proxy_md.named_buffers("", False)):
             self._buffers[n] = flow.utils.tensor.from_torch(b.data)
-        for n, m in proxy_md._modules.items():
-            self._modules[n] = torch2oflow(m)
+        self._modules = _convert_submodules(proxy_md._modules)
 
         for k, _ in proxy_md.__dict__.items():
             if k not in self.__dict__:
@@ -240,7 +327,8 @@ def _(mod: torch.nn.Module, verbose=False):
     of_mod_cls = type(
         str(new_md_cls), (new_md_cls,), {"__init__": init, "__getattr__": proxy_getattr}
     )
-    of_mod = of_mod_cls()
+    with _convert_subtrees_concurrently(mod):
+        of_mod = of_mod_cls()
 
     if of_mod.training:
         of_mod.training = False
@@ -0,0 +1,137 @@
+"""Persist where the mocked classes of torch packages are defined across runs.
+
+Resolving a mocked class walks its module path through `DynamicMockModule`, which inspects the
+attributes of every module on the way with and without mocking. The defining module and the
+qualified name of each resolved class are recorded instead, so the next run imports that module
+in the mock context of its package and skips the walk. The entries of a package are only valid
+for the versions of torch, oneflow, onediff and the package they were recorded with.
+
+The cache is disabled unless `ONEDIFF_CLASS_PROXY_CACHE_FILE` is set.
+"""
+
+import json
+import os
+import threading
+from importlib.metadata import version
+from typing import Dict, Optional, Tuple
+
+from onediff.utils import logger
+
+__all__ = ["ClassProxyCache", "get_class_proxy_cache"]
+
+_CACHE_VERSION = 1
+
+
+def _get_package_version(package: str) -> Optional[str]:
+    try:
+        return version(package)
+    except Exception:
+        # packages may lack metadata
+        return None
+
+
+def _package_versions(package: str) -> Dict[str, Optional[str]]:
+    packages = {package, "onediff", "oneflow", "torch"}
+    return {pkg: _get_package_version(pkg) for pkg in sorted(packages)}
+
+
+class ClassProxyCache:
+    """ClassProxyCache
+
+    The defining module and qualified name of the mocked entities, by mock entity name and
+    grouped by their main package.
+
+    __init__ args:
+        `file_path`: The path of the JSON file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._packages = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict:
+        if self._packages is not None:
+            return self._packages
+        self._packages = {}
+        if not os.path.exists(self.file_path):
+            return self._packages
+        try:
+            with open(self.file_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read class proxy cache {self.file_path}. {e=}")
+            return self._packages
+        if data.get("version") != _CACHE_VERSION:
+            return self._packages
+        for pkg, entry in data.get("packages", {}).items():
+            if entry.get("versions") != _package_versions(pkg):
+                logger.info(f"Class proxy cache of {pkg} is outdated, ignore it.")
+                continue
+            self._packages[pkg] = entry
+        return self._packages
+
+    def lookup(self, entity_name: str) -> Optional[Tuple[str, str]]:
+        """Returns the defining module and qualified name of a mocked entity, if recorded."""
+        pkg = entity_name.split(".")[0]
+        with self._lock:
+            location = self._load().get(pkg, {}).get("entities", {}).get(entity_name)
+        return None if location is None else tuple(location)
+
+    def add(self, entity_name: str, module_name: str, qualname: str) -> None:
+        pkg = entity_name.split(".")[0]
+        if pkg == "__main__" or "<locals>" in qualname:
+            return
+        with self._lock:
+            entry = self._load().setdefault(
+                pkg, {"versions": _package_versions(pkg), "entities": {}}
+            )
+            if entry["entities"].get(entity_name) == [module_name, qualname]:
+                return
+            entry["entities"][entity_name] = [module_name, qualname]
+            self._dirty = True
+
+    def discard(self, entity_name: str) -> None:
+        pkg = entity_name.split(".")[0]
+        with self._lock:
+            entities = self._load().get(pkg, {}).get("entities", {})
+            if entities.pop(entity_name, None) is not None:
+                self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                parent_dir = os.path.dirname(self.file_path)
+                if parent_dir:
+                    os.makedirs(parent_dir, exist_ok=True)
+                tmp_file = f"{self.file_path}.{os.getpid()}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(
+                        {"version": _CACHE_VERSION, "packages": self._packages},
+                        f,
+                        indent=2,
+                        sort_keys=True,
+                    )
+                os.replace(tmp_file, self.file_path)
+                self._dirty = False
+            except OSError as e:
+                logger.warning(
+                    f"Failed to save class proxy cache {self.file_path}. {e=}"
+                )
+
+
+_class_proxy_cache = None
+
+
+def get_class_proxy_cache() -> Optional[ClassProxyCache]:
+    """Returns the cache of `ONEDIFF_CLASS_PROXY_CACHE_FILE`, or None if it is unset."""
+    global _class_proxy_cache
+    file_path = os.getenv("ONEDIFF_CLASS_PROXY_CACHE_FILE", None)
+    if not file_path:
+        return None
+    if _class_proxy_cache is None or _class_proxy_cache.file_path != file_path:
+        _class_proxy_cache = ClassProxyCache(file_path)
+    return _class_proxy_cache
@@ -6,8 +6,9 @@ import warnings
 from pathlib import Path
 from typing import Dict, List, Union
 
-from onediff.utils import logger
+from onediff.utils import logger, metrics
 from ..import_tools.importer import LazyMocker
+from .class_proxy_cache import get_class_proxy_cache
 
 __all__ = ["transform_mgr"]
 
@@ -57,12 +58,33 @@ class TransformManager:
         self.logger.debug(debug_message)
 
     def _transform_entity(self, entity):
-        # TODO: Optimize _transform_entity for faster SDXL conversion (1.47s)
-        result = self.mocker.mock_entity(entity)
+        proxy_cache = get_class_proxy_cache() if isinstance(entity, str) else None
+        with metrics.timer("onediff_transform_entity_seconds"):
+            result = None
+            location = None if proxy_cache is None else proxy_cache.lookup(entity)
+            if location is not None:
+                try:
+                    result = self.mocker.mock_entity_at(entity, *location)
+                except Exception as e:
+                    self.logger.debug(f"Failed to mock {entity} at {location}. {e=}")
+                if result is None:
+                    proxy_cache.discard(entity)
+                else:
+                    metrics.inc("onediff_class_proxy_persistent_hits_total")
+            if result is None:
+                result = self.mocker.mock_entity(entity)
+                if proxy_cache is not None and isinstance(result, type):
+                    proxy_cache.add(entity, result.__module__, result.__qualname__)
         if result is None:
             RuntimeError(f"Failed to transform entity: {entity}")
         return result
 
+    def save_class_proxies(self):
+        """Persists the locations of the resolved class proxies, see `get_class_proxy_cache`."""
+        proxy_cache = get_class_proxy_cache()
+        if proxy_cache is not None:
+            proxy_cache.save()
+
     def get_transformed_entity_name(self, entity):
         return self.mocker.get_mock_entity_name(entity)
 
@@ -73,7 +95,9 @@ class TransformManager:
 
         # transform cache
         if mock_full_cls_name in self._torch_to_oflow_cls_map:
+            metrics.inc("onediff_class_proxy_cache_hits_total")
             return self._torch_to_oflow_cls_map[mock_full_cls_name]
+        metrics.inc("onediff_class_proxy_cache_misses_total")
 
         # transform
         if cls.__module__.startswith("torch."):
@@ -87,6 +111,18 @@ class TransformManager:
         self._oflow_to_torch_cls_map[mock_full_cls_name] = cls
         return mock_cls
 
+    def prefetch_class_proxies(self, classes=()):
+        """Resolve the class proxies of `classes`, e.g. of the module being converted, in one batch.
+
+        Resolving all classes before converting a module lets independent submodules be
+        converted concurrently, because mocking is not thread safe.
+        """
+        for cls in classes:
+            try:
+                self.transform_cls(cls)
+            except Exception as e:
+                self.logger.debug(f"Failed to prefetch class proxy of {cls}. {e=}")
+
     def reverse_transform_cls(self, cls):
         full_cls_name = cls.__module__ + "." + cls.__qualname__
         mock_full_cls_name = self.get_transformed_entity_name(full_cls_name)
@@ -0,0 +1,218 @@
+"""A content-addressed, size-bounded on-disk store of compiled graph files.
+
+Layout of a repository directory::
+
+    <root_dir>/
+        graph_index.json        # entries and hit/miss statistics
+        graph_index.lock        # cross-process lock file
+        <prefix>_<key>.graph    # compiled graph files
+
+Graph files are written to a temporary file first and renamed into place,
+so readers never observe a partially written graph. The index is only
+modified while holding an exclusive lock on the lock file, which makes it
+safe to share one repository directory between several workers.
+"""
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from onediff.utils import logger
+
+try:
+    import fcntl
+except ImportError:  # fcntl is not available on Windows
+    fcntl = None
+
+__all__ = ["GraphRepository", "generate_content_key"]
+
+INDEX_FILE_NAME = "graph_index.json"
+LOCK_FILE_NAME = "graph_index.lock"
+_INDEX_VERSION = 1
+
+
+def generate_content_key(*parts) -> str:
+    """Generate a stable key from JSON serializable parts."""
+    content = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def _empty_index() -> Dict:
+    return {
+        "version": _INDEX_VERSION,
+        "entries": {},
+        "stats": {"hits": 0, "misses": 0, "saves": 0, "evictions": 0},
+    }
+
+
+class GraphRepository:
+    """GraphRepository
+
+    __init__ args:
+        `root_dir`: The directory to store graph files and the index.
+        `max_size`: The size budget in bytes of all graph files, None means unlimited.
+        `max_entries`: The maximum number of graph files, None means unlimited.
+    """
+
+    def __init__(
+        self,
+        root_dir: str,
+        max_size: Optional[int] = None,
+        max_entries: Optional[int] = None,
+    ):
+        self.root_dir = str(root_dir) if root_dir else "."
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.index_path = os.path.join(self.root_dir, INDEX_FILE_NAME)
+        self.lock_path = os.path.join(self.root_dir, LOCK_FILE_NAME)
+
+    @contextmanager
+    def lock(self):
+        os.makedirs(self.root_dir, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_index(self) -> Dict:
+        if not os.path.exists(self.index_path):
+            return _empty_index()
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Failed to read graph index {self.index_path}, reset it. {e=}"
+            )
+            return _empty_index()
+        if index.get("version") != _INDEX_VERSION:
+            return _empty_index()
+        return index
+
+    def _write_index(self, index: Dict) -> None:
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def get_file_path(self, key: str, prefix: str = "") -> str:
+        file_name = f"{prefix}_{key}.graph" if prefix else f"{key}.graph"
+        return os.path.join(self.root_dir, file_name)
+
+    def _new_entry(self, file_path: str) -> Dict:
+        now = time.time()
+        return {
+            "file": os.path.basename(file_path),
+            "size": os.path.getsize(file_path),
+            "created": now,
+            "last_access": now,
+            "hits": 0,
+        }
+
+    def lookup(self, key: str, prefix: str = "") -> Optional[str]:
+        """Returns the graph file path of `key` if it is cached, otherwise None.
+
+        A graph file of `key` and `prefix` that is not in the index, e.g. copied without it,
+        is added to the index.
+        """
+        with self.lock():
+            index = self._read_index()
+            entry = index["entries"].get(key, None)
+            file_path = None
+            if entry is not None:
+                file_path = os.path.join(self.root_dir, entry["file"])
+                if not os.path.exists(file_path):
+                    # The file was removed behind our back, forget it.
+                    del index["entries"][key]
+                    file_path = None
+                    entry = None
+            if entry is None and os.path.exists(self.get_file_path(key, prefix)):
+                file_path = self.get_file_path(key, prefix)
+                entry = self._new_entry(file_path)
+                index["entries"][key] = entry
+
+            if file_path is None:
+                index["stats"]["misses"] += 1
+            else:
+                index["stats"]["hits"] += 1
+                entry["hits"] = entry.get("hits", 0) + 1
+                entry["last_access"] = time.time()
+            self._write_index(index)
+        return file_path
+
+    def commit(self, key: str, save_fn: Callable[[str], None], prefix: str = "") -> str:
+        """Saves a graph with `save_fn(file_path)` and adds it to the repository.
+
+        If the graph file of the same key exists, e.g. committed by another process, the
+        graph is not saved again.
+        """
+        file_path = self.get_file_path(key, prefix)
+        if os.path.exists(file_path):
+            with self.lock():
+                index = self._read_index()
+                if key not in index["entries"]:
+                    index["entries"][key] = self._new_entry(file_path)
+                    self._write_index(index)
+            logger.info(f"Graph file {file_path} is already saved by another worker.")
+            return file_path
+
+        os.makedirs(self.root_dir, exist_ok=True)
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        try:
+            save_fn(tmp_path)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock():
+            index = self._read_index()
+            index["entries"][key] = self._new_entry(file_path)
+            index["stats"]["saves"] += 1
+            self._evict(index, keep=key)
+            self._write_index(index)
+        return file_path
+
+    def _evict(self, index: Dict, keep: Optional[str] = None) -> None:
+        entries = index["entries"]
+        total_size = sum(entry["size"] for entry in entries.values())
+        # least recently used first
+        candidates = sorted(
+            (k for k in entries if k != keep), key=lambda k: entries[k]["last_access"]
+        )
+        for key in candidates:
+            over_size = self.max_size is not None and total_size > self.max_size
+            over_entries = (
+                self.max_entries is not None and len(entries) > self.max_entries
+            )
+            if not over_size and not over_entries:
+                break
+            entry = entries.pop(key)
+            total_size -= entry["size"]
+            index["stats"]["evictions"] += 1
+            file_path = os.path.join(self.root_dir, entry["file"])
+            try:
+                os.remove(file_path)
+                logger.info(f"Evicted graph file: {file_path}")
+            except FileNotFoundError:
+                pass
+
+    def evict(self) -> None:
+        with self.lock():
+            index = self._read_index()
+            self._evict(index)
+            self._write_index(index)
+
+    def stats(self) -> Dict:
+        with self.lock():
+            index = self._read_index()
+        stats = dict(index["stats"])
+        stats["entries"] = len(index["entries"])
+        stats["size"] = sum(entry["size"] for entry in index["entries"].values())
+        return stats
@@ -5,3 +5,4 @@ from .env_var import (
     set_integer_env_var,
 )
 from .log_utils import logger
+from .metrics_utils import metrics
@@ -19,3 +19,123 @@ class LRUCache(collections.OrderedDict):
         self.move_to_end(key)
         if len(self) > self.LEN:
             self.popitem(last=False)
+
+
+class MemoryBudgetedCache:
+    """MemoryBudgetedCache
+
+    Evicts by entry count and by the total estimated bytes of the values. Pinned keys are
+    never evicted, even if the cache is over budget.
+
+    __init__ args:
+        `capacity`: The maximum number of entries, None means unlimited.
+        `max_bytes`: The byte budget of all entries, None means unlimited.
+        `policy`: "lru" evicts the least recently used entry, "lfu" evicts the least
+            frequently used entry, the least recently used one on ties.
+        `size_fn`: Estimates the bytes of a value.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 9,
+        max_bytes: int = None,
+        policy: str = "lru",
+        size_fn=None,
+    ):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unsupported cache policy {policy}")
+        self.LEN = capacity
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size_fn = size_fn if size_fn is not None else (lambda value: 0)
+        self._entries = collections.OrderedDict()
+        self._sizes = {}
+        self._frequencies = collections.Counter()
+        self._pinned = set()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def get(self, key: str, default=None) -> any:
+        if key in self._entries:
+            self.hits += 1
+            self._frequencies[key] += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return default
+
+    def peek(self, key: str, default=None) -> any:
+        """Returns the value without counting a hit or a miss, or refreshing its recency."""
+        return self._entries.get(key, default)
+
+    def put(self, key: str, value: any) -> list:
+        """Inserts the value and returns the keys evicted to stay within budget."""
+        if key in self._entries:
+            self.total_bytes -= self._sizes[key]
+        size = self.size_fn(value)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._sizes[key] = size
+        self._frequencies[key] += 1
+        self.total_bytes += size
+        return self._evict()
+
+    def pop(self, key: str, default=None) -> any:
+        if key not in self._entries:
+            return default
+        self.total_bytes -= self._sizes.pop(key)
+        self._frequencies.pop(key, None)
+        return self._entries.pop(key)
+
+    def pin(self, key: str) -> None:
+        self._pinned.add(key)
+
+    def unpin(self, key: str) -> None:
+        self._pinned.discard(key)
+        self._evict()
+
+    def _over_budget(self) -> bool:
+        if self.LEN is not None and len(self._entries) > self.LEN:
+            return True
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes
+
+    def _select_victim(self):
+        candidates = [k for k in self._entries if k not in self._pinned]
+        if not candidates:
+            return None
+        if self.policy == "lfu":
+            # min keeps the first, i.e. the least recently used, on ties
+            return min(candidates, key=lambda k: self._frequencies[k])
+        return candidates[0]
+
+    def _evict(self) -> list:
+        evicted = []
+        while self._over_budget():
+            victim = self._select_victim()
+            if victim is None:
+                break
+            self.pop(victim)
+            self.evictions += 1
+            evicted.append(victim)
+        return evicted
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "pinned": sorted(self._pinned),
+            "total_bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,226 @@
+"""Always-on, low-overhead metrics of the compiler and runtime.
+
+Example:
+    >>> from onediff.utils import metrics
+    >>> with metrics.timer("onediff_graph_build_seconds", module="UNet2DConditionModel"):
+    ...     build()
+    >>> metrics.inc("onediff_graph_cache_hits_total")
+    >>> print(metrics.to_prometheus())
+
+Set `ONEDIFF_METRICS=0` to disable recording.
+"""
+
+import json
+import os
+import threading
+import time
+from functools import wraps
+from typing import Dict, Optional
+
+from .env_var import parse_boolean_from_env
+
+__all__ = ["MetricsRegistry", "metrics"]
+
+
+def _get_host_memory_used() -> int:
+    """Returns the resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    content = ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels)
+    return "{" + content + "}"
+
+
+class _Timer:
+    def __init__(self, registry, name, track_memory, labels):
+        self.registry = registry
+        self.name = name
+        self.track_memory = track_memory
+        self.labels = labels
+
+    def __enter__(self):
+        if self.track_memory:
+            self.start_memory = _get_host_memory_used()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end_time = time.perf_counter()
+        self.registry._observe(self.name, end_time - self.start_time, self.labels)
+        self.registry._add_trace_event(
+            self.name, self.start_time, end_time, self.labels
+        )
+        if self.track_memory:
+            memory_delta = _get_host_memory_used() - self.start_memory
+            name = self.name.replace("_seconds", "") + "_host_memory_delta_bytes"
+            self.registry._observe(name, memory_delta, self.labels)
+
+    def __call__(self, func):
+        @wraps(func)
+        def clocked(*args, **kwargs):
+            with _Timer(self.registry, self.name, self.track_memory, self.labels):
+                return func(*args, **kwargs)
+
+        return clocked
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def __call__(self, func):
+        return func
+
+
+class MetricsRegistry:
+    """MetricsRegistry
+
+    Counters are monotonically increasing values. Summaries record the count, sum, min
+    and max of observed values, such as durations.
+
+    __init__ args:
+        `enabled`: Whether to record metrics.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters: Dict = {}
+        self._summaries: Dict = {}
+        self._trace_events = None
+        self._trace_start = time.perf_counter()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        self._observe(name, value, tuple(sorted(labels.items())))
+
+    def _observe(self, name, value, labels) -> None:
+        key = (name, labels)
+        with self._lock:
+            summary = self._summaries.get(key, None)
+            if summary is None:
+                self._summaries[key] = [1, value, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = min(summary[2], value)
+                summary[3] = max(summary[3], value)
+
+    def timer(self, name: str, *, track_memory: bool = False, **labels):
+        """Times a code range as a context manager or a decorator."""
+        if not self.enabled:
+            return _NullTimer()
+        return _Timer(self, name, track_memory, tuple(sorted(labels.items())))
+
+    def enable_trace(self) -> None:
+        """Records every timed range as a Chrome trace event."""
+        with self._lock:
+            if self._trace_events is None:
+                self._trace_events = []
+
+    def disable_trace(self) -> None:
+        with self._lock:
+            self._trace_events = None
+
+    def _add_trace_event(self, name, start_time, end_time, labels) -> None:
+        if self._trace_events is None:
+            return
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start_time - self._trace_start) * 1e6,
+            "dur": (end_time - start_time) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": dict(labels),
+        }
+        with self._lock:
+            if self._trace_events is not None:
+                self._trace_events.append(event)
+
+    def dump_chrome_trace(self, file_path: str) -> None:
+        """Writes the recorded trace events, which can be opened in chrome://tracing or Perfetto."""
+        with self._lock:
+            events = list(self._trace_events or [])
+        with open(file_path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            summaries = {k: list(v) for k, v in self._summaries.items()}
+
+        result = {"counters": {}, "summaries": {}}
+        for (name, labels), value in counters.items():
+            result["counters"][name + _format_labels(labels)] = value
+        for (name, labels), (count, total, min_value, max_value) in summaries.items():
+            result["summaries"][name + _format_labels(labels)] = {
+                "count": count,
+                "sum": total,
+                "min": min_value,
+                "max": max_value,
+            }
+        return result
+
+    def to_json(self, indent: Optional[int] = None) -> str:
+        return json.dumps(self.snapshot(), indent=indent, sort_keys=True)
+
+    def to_prometheus(self) -> str:
+        """Exports metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items())
+
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (count, total, _, _) in summaries:
+            if name not in declared:
+                lines.append(f"# TYPE {name} summary")
+                declared.add(name)
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+            if self._trace_events is not None:
+                self._trace_events = []
+
+
+metrics = MetricsRegistry(enabled=parse_boolean_from_env("ONEDIFF_METRICS", True))
@@ -0,0 +1,81 @@
+import dataclasses
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("oneflow")
+
+from onediff.infer_compiler.backends import compiler  # usort: skip
+from onediff.infer_compiler.backends.oneflow import autotune_utils
+from onediff.infer_compiler.backends.oneflow.args_tree_util import get_input_signature
+from onediff.infer_compiler.backends.oneflow.autotune_utils import (
+    autotune,
+    generate_model_hash,
+    get_tuning_store,
+    TuningStore,
+)
+
+
+def test_tuning_store_round_trip(tmp_path):
+    file_path = str(tmp_path / "autotune.json")
+    store = TuningStore(file_path)
+    assert store.lookup("model", "inputs") is None
+
+    record = {"backend": "oneflow", "options": {"mlir_cse": True}}
+    store.update("model", "inputs", record)
+    assert store.lookup("model", "inputs") == record
+    # Another process sees the update
+    other = TuningStore(file_path)
+    assert other.lookup("model", "inputs") == record
+    other.update("model", "other_inputs", record)
+    os.utime(file_path, (0, 0))
+    assert store.lookup("model", "other_inputs") == record
+
+
+def test_tuning_store_is_opt_in(monkeypatch, tmp_path):
+    monkeypatch.delenv("ONEDIFF_AUTOTUNE_FILE", raising=False)
+    assert get_tuning_store() is None
+    file_path = str(tmp_path / "autotune.json")
+    monkeypatch.setenv("ONEDIFF_AUTOTUNE_FILE", file_path)
+    assert get_tuning_store().file_path == file_path
+
+
+class FakeCompiled:
+    def __init__(self, torch_module, options):
+        self.torch_module = torch_module
+        self.options = options
+
+    def __call__(self, x):
+        output = self.torch_module(x)
+        # A configuration that is fast but out of tolerance
+        if self.options.kernel_enable_cuda_graph:
+            output = output + 1
+        return output
+
+
+def test_autotune_picks_the_fastest_within_tolerance(monkeypatch, tmp_path):
+    module = torch.nn.Linear(4, 4)
+    x = torch.randn(2, 4)
+    search_space = [{}, {"kernel_enable_cuda_graph": True}, {"mlir_cse": True}]
+    # The eager reference first, then the trials in order
+    latencies = [10.0, 8.0, 2.0, 5.0]
+
+    def fake_benchmark(fn, warmup_iters, iters):
+        return fn(), latencies.pop(0)
+
+    def fake_compile(torch_module, *, backend, options):
+        assert dataclasses.is_dataclass(options)
+        return FakeCompiled(torch_module, options)
+
+    monkeypatch.setattr(autotune_utils, "_benchmark", fake_benchmark)
+    monkeypatch.setattr(compiler, "compile", fake_compile)
+    store = TuningStore(str(tmp_path / "autotune.json"))
+
+    best = autotune(module, (x,), search_space=search_space, store=store)
+    assert best["options"] == {"mlir_cse": True}
+    assert best["latency_ms"] == 5.0
+    assert best["eager_latency_ms"] == 10.0
+    assert store.lookup(generate_model_hash(module), get_input_signature((x,), {}))[
+        "options"
+    ] == {"mlir_cse": True}
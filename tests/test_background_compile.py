@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("oneflow")
+
+from onediff.infer_compiler.backends.oneflow import (  # usort: skip
+    background_compile_utils,
+)
+from onediff.infer_compiler.backends.oneflow.background_compile_utils import (
+    background_compile_wrapper,
+    BackgroundCompiler,
+    COMPILE_FAILED,
+    COMPILE_PENDING,
+    COMPILE_READY,
+)
+
+
+@pytest.fixture(autouse=True)
+def _new_executor(monkeypatch):
+    monkeypatch.setattr(background_compile_utils, "_executor", None)
+
+
+class FakeTorchModule:
+    def __call__(self, x):
+        return ("eager", "forward", x)
+
+    def decode(self, x):
+        return ("eager", "decode", x)
+
+
+class FakeDeployableModule:
+    def __init__(self):
+        self._deployable_module_background_compiler = BackgroundCompiler()
+        self._torch_module = FakeTorchModule()
+        self.compiled = []
+        self.release = threading.Event()
+
+    @background_compile_wrapper
+    def forward(self, x):
+        self.release.wait()
+        self.compiled.append(("forward", tuple(x.shape)))
+        return ("graph", "forward", x)
+
+    @background_compile_wrapper
+    def decode(self, x):
+        self.release.wait()
+        self.compiled.append(("decode", tuple(x.shape)))
+        return ("graph", "decode", x)
+
+
+def test_background_compiler_states():
+    compiler = BackgroundCompiler()
+    release = threading.Event()
+    compiler.submit("a", release.wait)
+    compiler.submit("b", lambda: 1 / 0)
+    assert compiler.get_state("a") == COMPILE_PENDING
+    assert not compiler.wait_ready(timeout=0.05)
+
+    release.set()
+    assert not compiler.wait_ready(timeout=5)
+    assert compiler.get_states() == {"a": COMPILE_READY, "b": COMPILE_FAILED}
+
+
+def test_background_compile_wrapper_falls_back_to_eager(monkeypatch):
+    monkeypatch.setenv("ONEDIFF_BACKGROUND_COMPILE_WORKERS", "2")
+    module = FakeDeployableModule()
+    x = torch.zeros(1, 4)
+
+    assert module.forward(x)[:2] == ("eager", "forward")
+    assert module.decode(x)[:2] == ("eager", "decode")
+    # The same inputs of another method are compiled separately
+    assert len(module._deployable_module_background_compiler.get_states()) == 2
+    assert background_compile_utils._executor._max_workers == 2
+
+    module.release.set()
+    assert module._deployable_module_background_compiler.wait_ready(timeout=5)
+    assert sorted(module.compiled) == [("decode", (1, 4)), ("forward", (1, 4))]
+    assert module.forward(x)[:2] == ("graph", "forward")
+    assert module.decode(x)[:2] == ("graph", "decode")
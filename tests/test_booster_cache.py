@@ -0,0 +1,175 @@
+import types
+from collections import OrderedDict
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("comfy")
+
+from onediff_comfy_nodes.modules import booster_cache  # usort: skip
+from onediff_comfy_nodes.modules.booster_cache import BoosterCacheService, CacheKey
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    unloaded = []
+    model_management = types.SimpleNamespace(
+        current_loaded_models=[],
+        unet_offload_device=lambda: torch.device("cpu"),
+        soft_empty_cache=lambda: None,
+    )
+    monkeypatch.setattr(booster_cache, "model_management", model_management)
+    monkeypatch.setattr(
+        booster_cache,
+        "_unload_from_comfy",
+        lambda module, offload=True: unloaded.append(module),
+    )
+    monkeypatch.setattr(BoosterCacheService, "_device_cache", OrderedDict())
+    monkeypatch.setattr(BoosterCacheService, "_host_cache", OrderedDict())
+    monkeypatch.setattr(
+        BoosterCacheService, "_stats", dict.fromkeys(BoosterCacheService._stats, 0)
+    )
+    monkeypatch.setattr(BoosterCacheService, "_limits", None)
+    BoosterCacheService.configure(max_entries=2, max_host_entries=1)
+    service = BoosterCacheService()
+    service.unloaded = unloaded
+    return service
+
+
+def _key(checkpoint, architecture="sd15"):
+    return CacheKey("ModelPatcher", architecture, checkpoint, ())
+
+
+def _entry(nbytes=16):
+    return booster_cache._CacheEntry(torch.nn.Linear(2, 2), nbytes)
+
+
+def test_pop_entry_hits_or_switches_within_the_family(cache):
+    a, b = _entry(), _entry()
+    cache._device_cache[_key("a")] = a
+    assert cache._pop_entry(_key("a"), model=None) == (_key("a"), a)
+    cache._host_cache[_key("a")] = a
+    assert cache._pop_entry(_key("a"), model=None) == (_key("a"), a)
+
+    cache._device_cache[_key("a")] = a
+    # Room for another compiled model
+    assert cache._pop_entry(_key("c"), model=None) == (None, None)
+    cache._device_cache[_key("b", architecture="sdxl")] = b
+    assert cache._pop_entry(_key("c"), model=None) == (_key("a"), a)
+    assert cache._pop_entry(_key("d"), model=None) == (None, None)
+    assert cache._stats["hits"] == 1
+    assert cache._stats["host_hits"] == 1
+    assert cache._stats["switches"] == 1
+
+
+def test_pop_entry_does_not_switch_entries_with_a_live_owner(cache):
+    from comfy.sd import VAE
+
+    a, b = _entry(), _entry()
+    cache._device_cache[_key("a")] = a
+    cache._device_cache[_key("b", architecture="sdxl")] = b
+    # The output of another loader node, still using the model of "a"
+    owner = VAE.__new__(VAE)
+    owner.first_stage_model = a.model
+    a.owners.add(owner)
+    assert cache._pop_entry(_key("c"), model=None) == (None, None)
+
+    # The owner switched to another model
+    owner.first_stage_model = torch.nn.Linear(2, 2)
+    assert cache._pop_entry(_key("c"), model=None) == (_key("a"), a)
+
+    cache._device_cache[_key("a")] = a
+    owner.first_stage_model = a.model
+    del owner
+    assert cache._pop_entry(_key("c"), model=None) == (_key("a"), a)
+    assert cache._stats["switches"] == 2
+
+
+def test_evict_offloads_to_the_host_and_drops_oneflow_models(cache, monkeypatch):
+    entries = {checkpoint: _entry() for checkpoint in "abcd"}
+    oneflow_model = entries["b"].model
+    monkeypatch.setattr(
+        booster_cache, "_is_oneflow_compiled", lambda module: module is oneflow_model
+    )
+    for checkpoint, entry in entries.items():
+        cache._device_cache[_key(checkpoint)] = entry
+    cache._evict()
+
+    assert list(cache._device_cache) == [_key("c"), _key("d")]
+    # "a" is offloaded to the host, "b" is dropped from the device
+    assert list(cache._host_cache) == [_key("a")]
+    assert entries["a"].model.weight.device.type == "cpu"
+    assert cache.unloaded == [entries["a"].model, oneflow_model]
+    assert (cache._stats["offloads"], cache._stats["evictions"]) == (1, 1)
+
+    cache._device_cache[_key("e")] = _entry()
+    cache._evict()
+    # "c" is offloaded, and "a" dropped from the host
+    assert list(cache._host_cache) == [_key("c")]
+    assert cache.unloaded[-2:] == [entries["c"].model, entries["a"].model]
+    assert (cache._stats["offloads"], cache._stats["evictions"]) == (2, 2)
+
+
+def test_evict_drops_entries_with_a_live_owner(cache):
+    from comfy.sd import VAE
+
+    entries = {checkpoint: _entry() for checkpoint in "abc"}
+    owner = VAE.__new__(VAE)
+    owner.first_stage_model = entries["a"].model
+    entries["a"].owners.add(owner)
+    for checkpoint, entry in entries.items():
+        cache._device_cache[_key(checkpoint)] = entry
+    cache._evict()
+
+    # The weights of "a" are neither offloaded nor unloaded under its owner
+    assert list(cache._device_cache) == [_key("b"), _key("c")]
+    assert list(cache._host_cache) == []
+    assert cache.unloaded == []
+    assert (cache._stats["offloads"], cache._stats["evictions"]) == (0, 1)
+
+
+def test_unload_from_comfy_matches_the_weights_of_switched_models(monkeypatch):
+    class LoadedModel:
+        def __init__(self, model):
+            self.model = model
+            self.unloaded = False
+
+        def model_unload(self):
+            self.unloaded = True
+
+    diffusion_model = torch.nn.Linear(2, 2)
+    # A ModelPatcher switched to the cached diffusion model, and another one
+    switched = LoadedModel(
+        types.SimpleNamespace(
+            model=types.SimpleNamespace(diffusion_model=diffusion_model)
+        )
+    )
+    other = LoadedModel(
+        types.SimpleNamespace(
+            model=types.SimpleNamespace(diffusion_model=torch.nn.Linear(2, 2))
+        )
+    )
+    model_management = types.SimpleNamespace(current_loaded_models=[switched, other])
+    monkeypatch.setattr(booster_cache, "model_management", model_management)
+
+    booster_cache._unload_from_comfy(diffusion_model)
+    assert model_management.current_loaded_models == [other]
+    assert switched.unloaded and not other.unloaded
+
+
+def test_copy_changed_weights_updates_the_fingerprints_of_the_destination():
+    dst, src = torch.nn.Linear(2, 2), torch.nn.Linear(2, 2)
+    with torch.no_grad():
+        dst.bias.copy_(src.bias)
+    booster_cache.get_tensor_fingerprints(dst)
+
+    # Only the weight differs
+    report = booster_cache.copy_changed_weights(dst, src)
+    assert report.copied_tensors == 1
+    assert report.copied_bytes == src.weight.numel() * src.weight.element_size()
+    assert report.total_tensors == 2
+    assert torch.equal(dst.weight, src.weight)
+    assert booster_cache.get_tensor_fingerprints(
+        dst
+    ) == booster_cache.compute_tensor_fingerprints(src)
+    assert booster_cache.copy_changed_weights(dst, src).copied_tensors == 0
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("oneflow")
+
+from onediff.infer_compiler.backends.oneflow.transform import (  # usort: skip
+    builtin_transform,
+    class_proxy_cache,
+)
+from onediff.infer_compiler.backends.oneflow.transform.builtin_transform import (
+    torch2oflow,
+)
+from onediff.infer_compiler.backends.oneflow.transform.class_proxy_cache import (
+    ClassProxyCache,
+    get_class_proxy_cache,
+)
+
+ENTITY = "diffusers.models.unets.unet_2d_blocks.CrossAttnDownBlock2D"
+LOCATION = ("diffusers.models.unets.unet_2d_blocks", "CrossAttnDownBlock2D")
+
+
+def test_class_proxy_cache_round_trip(tmp_path):
+    file_path = str(tmp_path / "class_proxies.json")
+    cache = ClassProxyCache(file_path)
+    assert cache.lookup(ENTITY) is None
+    cache.add(ENTITY, *LOCATION)
+    cache.add("__main__.Net", "__main__", "Net")
+    cache.save()
+
+    cache = ClassProxyCache(file_path)
+    assert cache.lookup(ENTITY) == LOCATION
+    assert cache.lookup("__main__.Net") is None
+    cache.discard(ENTITY)
+    cache.save()
+    assert ClassProxyCache(file_path).lookup(ENTITY) is None
+
+
+def test_class_proxy_cache_is_keyed_by_package_versions(tmp_path):
+    file_path = str(tmp_path / "class_proxies.json")
+    cache = ClassProxyCache(file_path)
+    cache.add(ENTITY, *LOCATION)
+    cache.save()
+    with open(file_path) as f:
+        data = json.load(f)
+    data["packages"]["diffusers"]["versions"]["torch"] = "0.0.1"
+    with open(file_path, "w") as f:
+        json.dump(data, f)
+
+    assert ClassProxyCache(file_path).lookup(ENTITY) is None
+
+
+def test_class_proxy_cache_is_opt_in(monkeypatch, tmp_path):
+    monkeypatch.delenv("ONEDIFF_CLASS_PROXY_CACHE_FILE", raising=False)
+    assert get_class_proxy_cache() is None
+    file_path = str(tmp_path / "class_proxies.json")
+    monkeypatch.setenv("ONEDIFF_CLASS_PROXY_CACHE_FILE", file_path)
+    assert get_class_proxy_cache().file_path == file_path
+
+
+class Stage(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList(
+            [
+                torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.SiLU())
+                for _ in range(3)
+            ]
+        )
+
+
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv_in = torch.nn.Linear(4, 4)
+        self.down_blocks = torch.nn.ModuleList([Stage() for _ in range(4)])
+        self.up_blocks = torch.nn.ModuleList([Stage() for _ in range(4)])
+
+
+def test_subtrees_are_converted_concurrently(monkeypatch):
+    net = Net()
+    subtrees = builtin_transform._plan_subtrees(net, num_workers=4)
+    assert set(map(id, subtrees)) == {
+        id(stage) for stage in list(net.down_blocks) + list(net.up_blocks)
+    }
+
+    monkeypatch.setenv("ONEDIFF_CONVERT_WORKERS", "4")
+    of_net = torch2oflow(net)
+    assert [name for name, _ in of_net.named_modules()] == [
+        name for name, _ in net.named_modules()
+    ]
+    for (name, param), (_, of_param) in zip(
+        net.named_parameters(), of_net.named_parameters()
+    ):
+        assert param.data_ptr() == of_param.data_ptr(), name
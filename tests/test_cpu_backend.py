@@ -0,0 +1,54 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+if not hasattr(torch, "compile"):
+    pytest.skip("The cpu backend requires torch>=2.1", allow_module_level=True)
+
+from onediff.infer_compiler import compile, CPUCompileOptions  # usort: skip
+
+
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 4, 3, padding=1)
+        self.linear = torch.nn.Linear(8, 8)
+
+    def forward(self, x):
+        return self.linear(torch.relu(self.conv(x)))
+
+
+def _eager(net, x):
+    with torch.no_grad():
+        return net(x)
+
+
+def test_cpu_backend_matches_eager():
+    torch.manual_seed(0)
+    net = Net().eval()
+    x = torch.randn(2, 3, 8, 8)
+    expected = _eager(net, x)
+
+    compiled = compile(net, backend="cpu", options={"dynamic": False})
+    assert not compiled.get_graph().is_compiled
+    output = compiled(x)
+    assert compiled.get_graph().is_compiled
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_cpu_backend_saves_and_loads_graphs(tmp_path):
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        pytest.skip("Saving compiled artifacts requires torch>=2.7")
+    options = CPUCompileOptions(dynamic=False)
+    x = torch.randn(2, 3, 8, 8)
+    compiled = compile(Net().eval(), backend="cpu", options=options)
+    compiled(x)
+    file_path = tmp_path / "net.graph"
+    compiled.save_graph(str(file_path))
+    artifacts = [p for p in tmp_path.iterdir() if p.suffix == ".inductor_artifacts"]
+    assert len(artifacts) == 1
+
+    torch._dynamo.reset()
+    net = Net().eval()
+    loaded = compile(net, backend="cpu", options=options)
+    loaded.load_graph(str(file_path))
+    assert torch.allclose(loaded(x), _eager(net, x), atol=1e-5)
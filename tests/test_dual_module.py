@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("oneflow")
+
+from onediff.infer_compiler.backends.oneflow import dual_module  # usort: skip
+from onediff.infer_compiler.backends.oneflow.dual_module import get_mixed_dual_module
+from onediff.infer_compiler.backends.oneflow.oneflow_exec_mode import (
+    oneflow_exec_mode,
+    oneflow_exec_mode_enabled,
+)
+from onediff.infer_compiler.backends.oneflow.transform.builtin_transform import (
+    torch2oflow,
+)
+
+
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(4, 4) for _ in range(2)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def _dual_module(torch_module, oneflow_module=None):
+    return get_mixed_dual_module(type(torch_module))(torch_module, oneflow_module)
+
+
+def test_dual_module_to_after_replacing_a_submodule():
+    net = Net()
+    dual = _dual_module(net)
+    dual.oneflow_module
+    assert dual._tensor_index is not None
+
+    new_layer = torch.nn.Linear(4, 4)
+    dual.layers[1] = _dual_module(new_layer, torch2oflow(new_layer))
+    assert net.layers[1] is new_layer
+
+    dual.to(torch.float64)
+    for param in net.parameters():
+        assert param.dtype == torch.float64
+    oneflow_layer = dual._oneflow_module.layers[1]
+    assert new_layer.weight.data_ptr() == oneflow_layer.weight.data_ptr()
+
+
+def test_dual_module_wrappers_of_submodules_keep_no_index():
+    net = Net()
+    dual = _dual_module(net)
+    dual.oneflow_module
+
+    layers = dual.layers
+    layers[0].to(torch.float64)
+    assert net.layers[0].weight.dtype == torch.float64
+    assert layers[0]._tensor_index is None
+
+
+def test_dual_module_in_place_updates_keep_the_indexes():
+    net = Net()
+    dual = _dual_module(net)
+    dual.oneflow_module
+    version = dual_module._tensor_index_version
+
+    dual.layers[0].weight = torch.zeros(4, 4)
+    dual.training = False
+    assert torch.equal(net.layers[0].weight, torch.zeros(4, 4))
+    assert dual_module._tensor_index_version == version
+
+    new_layer = torch.nn.Linear(4, 4)
+    dual.layers[0] = _dual_module(new_layer, torch2oflow(new_layer))
+    assert dual_module._tensor_index_version > version
+
+
+def _nbytes(module):
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
+
+def test_dual_module_to_reports_the_moved_bytes():
+    net = Net()
+    dual = _dual_module(net)
+    dual.oneflow_module
+
+    # The torch tensors that view the moved oneflow tensors are not counted again
+    dual.to(torch.float64)
+    assert dual.last_moved_bytes == _nbytes(net)
+    dual.to(torch.float64)
+    assert dual.last_moved_bytes == 0
+
+    tied = Net()
+    tied.layers[1].weight = tied.layers[0].weight
+    torch_only = _dual_module(tied)
+    torch_only.to(torch.float64)
+    assert torch_only.last_moved_bytes == _nbytes(tied)
+
+
+def test_oneflow_exec_mode_is_per_thread():
+    layer = torch.nn.Linear(4, 4)
+    dual = _dual_module(layer, torch2oflow(layer))
+    entered, exited = threading.Event(), threading.Event()
+    seen = []
+
+    def build():
+        # As a graph built on a background thread
+        with oneflow_exec_mode():
+            seen.append((oneflow_exec_mode_enabled(), dual.weight is layer.weight))
+            entered.set()
+            assert exited.wait(10)
+
+    worker = threading.Thread(target=build)
+    worker.start()
+    assert entered.wait(10)
+    # The eager calls of this thread still see the torch attributes
+    assert not oneflow_exec_mode_enabled()
+    assert dual.weight is layer.weight
+    with oneflow_exec_mode():
+        assert dual.weight is not layer.weight
+    exited.set()
+    worker.join(10)
+    assert seen == [(True, False)]
@@ -0,0 +1,58 @@
+import pytest
+
+from onediff.utils.chache_utils import MemoryBudgetedCache
+
+
+def test_memory_budgeted_cache_evicts_by_bytes_and_keeps_pinned():
+    cache = MemoryBudgetedCache(capacity=9, max_bytes=100, size_fn=lambda v: v)
+    assert cache.put("a", 40) == []
+    assert cache.put("b", 40) == []
+    cache.pin("a")
+
+    assert cache.put("c", 40) == ["b"]
+    assert "a" in cache and "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("a") == 40
+
+    stats = cache.stats()
+    assert stats["total_bytes"] == 80
+    assert stats["pinned"] == ["a"]
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 1)
+
+
+def test_memory_budgeted_cache_lfu_policy():
+    cache = MemoryBudgetedCache(capacity=2, policy="lfu")
+    cache.put("x", 1)
+    cache.get("x")
+    cache.put("y", 1)
+    assert cache.put("z", 1) == ["y"]
+    assert list(cache.keys()) == ["x", "z"]
+
+
+def test_memory_budgeted_cache_without_capacity():
+    cache = MemoryBudgetedCache(capacity=None, max_bytes=1000, size_fn=lambda v: v)
+    for i in range(20):
+        assert cache.put(i, 10) == []
+    assert len(cache) == 20
+    assert cache.put("large", 900) == [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+
+
+def test_loaded_graph_counts_toward_the_cache_budget(tmp_path):
+    pytest.importorskip("torch")
+    flow = pytest.importorskip("oneflow")
+    from onediff.infer_compiler.backends.oneflow.graph import OneflowGraph
+
+    model = flow.nn.Linear(64, 64)
+    graph = OneflowGraph(model)
+    graph(flow.randn(2, 64))
+    file_path = str(tmp_path / "linear.graph")
+    graph.save_graph(file_path, process_state_dict=lambda x: x)
+
+    loaded_graph = OneflowGraph(model)
+    assert loaded_graph.memory_footprint == 0
+    loaded_graph.load_graph(file_path, run_warmup=False)
+    assert loaded_graph.memory_footprint > 0
+
+    cache = MemoryBudgetedCache(size_fn=lambda graph: graph.memory_footprint)
+    cache.put("loaded", loaded_graph)
+    assert cache.total_bytes == loaded_graph.memory_footprint
@@ -0,0 +1,93 @@
+import importlib.util
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("oneflow")
+pytest.importorskip("folder_paths")
+
+_GRAPH_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "onediff_comfy_nodes",
+    "modules",
+    "oneflow",
+    "utils",
+    "graph_path.py",
+)
+
+
+def _load_graph_path():
+    spec = importlib.util.spec_from_file_location("graph_path", _GRAPH_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+graph_path = _load_graph_path()
+
+
+class FakeBaseModel(torch.nn.Module):
+    def __init__(self, dim=4):
+        super().__init__()
+        self.diffusion_model = torch.nn.Linear(dim, dim)
+
+
+def _save_graph_file(index, name):
+    file_path = index.get_graph_path(f"{name}_0123456789.graph")
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path.write_bytes(b"graph")
+
+
+def test_graph_path_index_lists_saved_graphs(monkeypatch, tmp_path):
+    monkeypatch.setenv("COMFYUI_ONEDIFF_SAVE_GRAPH_DIR", str(tmp_path))
+    model = FakeBaseModel()
+    file_path = graph_path.generate_graph_path("sd15.safetensors", model)
+    assert file_path.parent == tmp_path / "graphs" / "FakeBaseModel"
+    # The same model gets the same path
+    assert graph_path.generate_graph_path("sd15.safetensors", model) == file_path
+
+    index = graph_path.GraphPathIndex()
+    (name,) = index.read()
+    assert index.read()[name]["kind"] == "unet"
+    assert index.list() == {}
+    assert list(index.list(saved_only=False)) == [name]
+
+    _save_graph_file(index, name)
+    assert list(index.list(kind="unet")) == [name]
+    assert index.list(kind="vae") == {}
+
+
+def test_graph_path_index_finds_compatible_graphs(monkeypatch, tmp_path):
+    monkeypatch.setenv("COMFYUI_ONEDIFF_SAVE_GRAPH_DIR", str(tmp_path))
+    index = graph_path.GraphPathIndex()
+    quant_patches = {"quantization": {"conv_mae_threshold": 0.1}}
+    names = {}
+    for ckpt_name, patches in [("a", None), ("b", None), ("a", quant_patches)]:
+        file_path = graph_path.generate_graph_path(
+            ckpt_name, FakeBaseModel(), patches=patches
+        )
+        names[ckpt_name, bool(patches)] = name = os.path.relpath(
+            file_path, index.graph_dir
+        )
+        _save_graph_file(index, name)
+    graph_path.generate_graph_path("c", FakeBaseModel(dim=8))
+
+    # The most recently used first, other patches and shapes are incompatible
+    assert index.find_compatible(FakeBaseModel()) == [
+        names["b", False],
+        names["a", False],
+    ]
+    assert index.find_compatible(FakeBaseModel(), patches=quant_patches) == [
+        names["a", True]
+    ]
+    assert index.find_compatible(FakeBaseModel(dim=8)) == []
+
+
+def test_graph_path_index_resets_a_corrupted_index(tmp_path):
+    index = graph_path.GraphPathIndex(tmp_path)
+    index.register("FakeBaseModel/a_0", {"kind": "unet"})
+    assert list(index.read()) == ["FakeBaseModel/a_0"]
+    index.index_path.write_text("{")
+    assert index.read() == {}
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+pytest.importorskip("oneflow")
+
+from onediff.infer_compiler.backends.oneflow.utils.graph_repository import (  # usort: skip
+    generate_content_key,
+    GraphRepository,
+)
+
+
+def _save_bytes(size):
+    def save_fn(file_path):
+        with open(file_path, "wb") as f:
+            f.write(b"0" * size)
+
+    return save_fn
+
+
+def test_graph_repository_lookup_and_commit(tmp_path):
+    repository = GraphRepository(tmp_path)
+    key = generate_content_key("unet", "float16@cuda")
+
+    assert repository.lookup(key) is None
+    file_path = repository.commit(key, _save_bytes(8), prefix="unet")
+    assert os.path.basename(file_path) == f"unet_{key}.graph"
+    assert repository.lookup(key) == file_path
+    # A second commit of the same key is skipped.
+    assert repository.commit(key, _save_bytes(16), prefix="unet") == file_path
+    assert os.path.getsize(file_path) == 8
+
+    stats = repository.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["saves"] == 1
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+
+def test_graph_repository_evicts_least_recently_used(tmp_path):
+    repository = GraphRepository(tmp_path, max_size=20)
+    keys = [generate_content_key("unet", i) for i in range(3)]
+
+    repository.commit(keys[0], _save_bytes(8))
+    repository.commit(keys[1], _save_bytes(8))
+    assert repository.lookup(keys[0]) is not None
+    repository.commit(keys[2], _save_bytes(8))
+
+    assert repository.lookup(keys[1]) is None
+    assert repository.lookup(keys[0]) is not None
+    assert repository.lookup(keys[2]) is not None
+    assert repository.stats()["evictions"] == 1
+    assert repository.stats()["size"] == 16
+
+
+def test_graph_repository_adopts_files_without_index(tmp_path):
+    key = generate_content_key("unet", "float16@cuda")
+    file_path = GraphRepository(tmp_path).get_file_path(key, prefix="unet")
+    # A graph file shipped without the index
+    _save_bytes(8)(file_path)
+
+    repository = GraphRepository(tmp_path)
+    assert repository.lookup(key, prefix="unet") == file_path
+    assert repository.commit(key, _save_bytes(16), prefix="unet") == file_path
+    assert os.path.getsize(file_path) == 8
+    assert repository.stats()["entries"] == 1
@@ -0,0 +1,171 @@
+import importlib.util
+import os
+import weakref
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("comfy")
+
+_CROSS_ATTENTION_PATCH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "onediff_comfy_nodes",
+    "modules",
+    "oneflow",
+    "infer_compiler_registry",
+    "register_comfy",
+    "CrossAttentionPatch.py",
+)
+
+
+def _load_cross_attention_patch():
+    spec = importlib.util.spec_from_file_location(
+        "CrossAttentionPatch", _CROSS_ATTENTION_PATCH
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeIPLayers(torch.nn.Module):
+    def __init__(self, module_key, dim, cross_dim):
+        super().__init__()
+        self.to_kvs = torch.nn.ModuleDict(
+            {
+                f"{module_key}_to_k_ip": torch.nn.Linear(cross_dim, dim, bias=False),
+                f"{module_key}_to_v_ip": torch.nn.Linear(cross_dim, dim, bias=False),
+            }
+        )
+
+
+class FakeIPAdapter:
+    def __init__(self, module_key, dim=64, cross_dim=32):
+        self.ip_layers = FakeIPLayers(module_key, dim, cross_dim)
+        self.num_projections = 0
+        for layer in self.ip_layers.to_kvs.values():
+            layer.register_forward_hook(self._count)
+
+    def _count(self, module, inputs, output):
+        self.num_projections += 1
+
+
+def _extra_options(attn2, batch_prompt=2):
+    return {
+        "n_heads": 4,
+        "sigmas": 1.0,
+        "cond_or_uncond": [1, 0],
+        "block": ("input", 4),
+        "transformer_index": 0,
+        "original_shape": [2 * batch_prompt, 4, 8, 8],
+        "_attn2": {attn2.forward_patch_key: [attn2.inputs]},
+    }
+
+
+def _attn2_replace(patch, ipadapter, cond, uncond):
+    attn2 = patch.Attn2Replace(
+        patch.ipadapter_attention,
+        module_key="4",
+        ipadapter=ipadapter,
+        sigma_start=999.0,
+        sigma_end=0.0,
+    )
+    attn2.inputs = {"cond": cond, "uncond": uncond, "weight": torch.tensor(0.8)}
+    return attn2
+
+
+def test_ipadapter_kv_cache_reuses_projections():
+    patch = _load_cross_attention_patch()
+    torch.manual_seed(0)
+    ipadapter = FakeIPAdapter("4")
+    cond, uncond = torch.randn(1, 4, 32), torch.zeros(1, 4, 32)
+    attn2 = _attn2_replace(patch, ipadapter, cond, uncond)
+    q, k, v = (torch.randn(4, 64, 64) for _ in range(3))
+    extra_options = _extra_options(attn2)
+
+    with torch.no_grad():
+        outputs = [attn2(q, k, v, extra_options) for _ in range(3)]
+        assert ipadapter.num_projections == 4
+        attn2.kv_cache = None
+        expected = attn2(q, k, v, extra_options)
+    for out in outputs:
+        assert torch.equal(out, expected)
+    assert ipadapter.num_projections == 8
+
+
+def test_ipadapter_kv_cache_invalidates_on_changes():
+    patch = _load_cross_attention_patch()
+    torch.manual_seed(0)
+    ipadapter = FakeIPAdapter("4")
+    cond, uncond = torch.randn(1, 4, 32), torch.zeros(1, 4, 32)
+    attn2 = _attn2_replace(patch, ipadapter, cond, uncond)
+    q, k, v = (torch.randn(4, 64, 64) for _ in range(3))
+    extra_options = _extra_options(attn2)
+
+    with torch.no_grad():
+        attn2(q, k, v, extra_options)
+        # New embeddings
+        attn2.inputs["cond"] = torch.randn(1, 4, 32)
+        new_embeds_out = attn2(q, k, v, extra_options)
+        assert ipadapter.num_projections == 8
+        # Weights updated in place
+        ipadapter.ip_layers.to_kvs["4_to_k_ip"].weight.mul_(2)
+        new_weights_out = attn2(q, k, v, extra_options)
+        assert ipadapter.num_projections == 12
+        # Another batch layout
+        q3, k3, v3 = (torch.randn(6, 64, 64) for _ in range(3))
+        attn2(q3, k3, v3, _extra_options(attn2, batch_prompt=3))
+        assert ipadapter.num_projections == 16
+        assert attn2.kv_cache.hits == 0
+
+    assert not torch.equal(new_embeds_out, new_weights_out)
+
+
+def test_ipadapter_kv_cache_under_inference_mode():
+    patch = _load_cross_attention_patch()
+    torch.manual_seed(0)
+    with torch.inference_mode():
+        # Inference tensors, without a version counter
+        ipadapter = FakeIPAdapter("4")
+        cond, uncond = torch.randn(1, 4, 32), torch.zeros(1, 4, 32)
+        attn2 = _attn2_replace(patch, ipadapter, cond, uncond)
+        q, k, v = (torch.randn(4, 64, 64) for _ in range(3))
+        extra_options = _extra_options(attn2)
+
+        attn2(q, k, v, extra_options)
+        attn2(q, k, v, dict(extra_options, sigmas=0.5))
+        assert ipadapter.num_projections == 4
+        assert attn2.kv_cache.hits == 1
+        # Weights updated in place before the next sampling, whose sigma is higher
+        ipadapter.ip_layers.to_kvs["4_to_k_ip"].weight.mul_(2)
+        attn2(q, k, v, extra_options)
+        assert ipadapter.num_projections == 8
+        # Another sampling, identified by its sigmas
+        attn2(q, k, v, dict(extra_options, sample_sigmas=torch.ones(2)))
+        attn2(q, k, v, dict(extra_options, sample_sigmas=torch.ones(2)))
+        assert ipadapter.num_projections == 16
+
+    kv_cache = patch.IPAdapterKVCache()
+    sources = [torch.zeros(2), torch.ones(2)]
+    kv_cache.get("key", sources, lambda: 1)
+    # Fewer sources than the cached entry
+    assert kv_cache.get("key", sources[:1], lambda: 2) == 2
+    assert kv_cache.misses == 2
+
+
+def test_ipadapter_kv_cache_does_not_keep_replaced_tensors_alive():
+    patch = _load_cross_attention_patch()
+    ipadapter = FakeIPAdapter("4")
+    cond, uncond = torch.randn(1, 4, 32), torch.zeros(1, 4, 32)
+    attn2 = _attn2_replace(patch, ipadapter, cond, uncond)
+    q, k, v = (torch.randn(4, 64, 64) for _ in range(3))
+    extra_options = _extra_options(attn2)
+
+    with torch.no_grad():
+        attn2(q, k, v, extra_options)
+        cond_ref = weakref.ref(cond)
+        del cond
+        attn2.inputs["cond"] = torch.randn(1, 4, 32)
+        attn2(q, k, v, extra_options)
+    assert cond_ref() is None
+    assert ipadapter.num_projections == 8
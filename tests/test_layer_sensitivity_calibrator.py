@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("comfy")
+pytest.importorskip("oneflow")
+pytest.importorskip("onediff_quant")
+
+from onediff_comfy_nodes.modules.oneflow.utils import (  # usort: skip
+    quant_ksampler_tools,
+)
+from onediff_comfy_nodes.modules.oneflow.utils.quant_ksampler_tools import (
+    LayerSensitivityCalibrator,
+)
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def sampled_groups(monkeypatch):
+    """Replaces the quantization by a context yielding the quantized layers."""
+    groups = []
+
+    @contextmanager
+    def fake_quantized_model_patcher(model_patcher, layers, bits):
+        groups.append(list(layers))
+        yield layers
+
+    monkeypatch.setattr(
+        quant_ksampler_tools, "quantized_model_patcher", fake_quantized_model_patcher
+    )
+    return groups
+
+
+def _sample(layers, interrupt_at=None, groups=None):
+    if interrupt_at is not None and len(groups) == interrupt_at:
+        raise Interrupted()
+    # Each quantized layer adds 1.0 to the MSE against a zero reference
+    return torch.full((4,), float(len(layers)) ** 0.5)
+
+
+def _calibrator(model, **kwargs):
+    layers = {str(i): layer for i, layer in enumerate(model)}
+    calibrator = LayerSensitivityCalibrator(None, layers, **kwargs)
+    with calibrator.record_activations(), torch.no_grad():
+        model(torch.randn(2, 4))
+    return calibrator
+
+
+def test_calibrator_measures_each_layer_with_group_size_one(sampled_groups):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(*[torch.nn.Linear(4, 4) for _ in range(4)])
+    calibrator = _calibrator(model, sample_fn=_sample, group_size=1)
+
+    results = calibrator.calibrate(torch.zeros(4))
+    assert results == {str(i): 1.0 for i in range(4)}
+    assert calibrator.num_samplings == 4
+    assert sorted(sampled_groups) == [[str(i)] for i in range(4)]
+
+
+def test_calibrator_orders_layers_by_activation_score():
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+    calibrator = _calibrator(
+        model, sample_fn=_sample, group_size=1, activation_score_threshold=0.5
+    )
+    scores = {"a": 3.0, "b": 0.1, "c": 2.0, "d": 0.2}
+    # The layers under the threshold start in one group
+    assert calibrator.groups(scores) == [["b", "d"], ["c"], ["a"]]
+
+
+def test_calibrator_resumes_without_resampling_finished_groups(
+    sampled_groups, tmp_path
+):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(*[torch.nn.Linear(4, 4) for _ in range(4)])
+    checkpoint_file = str(tmp_path / "calibration.json")
+    kwargs = dict(
+        group_size=4, group_mse_threshold=1.5, checkpoint_file=checkpoint_file
+    )
+
+    # The group of 4 layers is split in halves, then in single layers
+    calibrator = _calibrator(
+        model,
+        sample_fn=lambda layers: _sample(layers, 6, sampled_groups),
+        **kwargs,
+    )
+    with pytest.raises(Interrupted):
+        calibrator.calibrate(torch.zeros(4))
+    first_half, second_half = sampled_groups[1], sampled_groups[4]
+    assert len(calibrator.results["layers"]) == 2
+    assert sampled_groups == [
+        first_half + second_half,
+        first_half,
+        [first_half[0]],
+        [first_half[1]],
+        second_half,
+        [second_half[0]],
+    ]
+
+    sampled_groups.clear()
+    resumed = _calibrator(model, sample_fn=_sample, **kwargs)
+    results = resumed.calibrate(torch.zeros(4))
+    assert results == {str(i): 1.0 for i in range(4)}
+    # The second half is not sampled again, only its single layers
+    assert sampled_groups == [[second_half[0]], [second_half[1]]]
+    assert resumed.num_samplings == 2
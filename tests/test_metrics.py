@@ -0,0 +1,62 @@
+import json
+
+from onediff.utils import metrics
+from onediff.utils.metrics_utils import MetricsRegistry
+
+
+def test_metrics_is_the_registry():
+    assert isinstance(metrics, MetricsRegistry)
+
+
+def test_metrics_counters_and_summaries():
+    registry = MetricsRegistry()
+    registry.inc("onediff_graph_created_total", module="UNet")
+    registry.inc("onediff_graph_created_total", 2, module="UNet")
+    registry.observe("onediff_graph_build_seconds", 1.5, module="UNet")
+    with registry.timer("onediff_graph_build_seconds", module="UNet"):
+        pass
+
+    snapshot = registry.snapshot()
+    assert snapshot["counters"]['onediff_graph_created_total{module="UNet"}'] == 3
+    summary = snapshot["summaries"]['onediff_graph_build_seconds{module="UNet"}']
+    assert summary["count"] == 2
+    assert summary["max"] == 1.5
+    assert json.loads(registry.to_json()) == snapshot
+
+    registry.reset()
+    assert registry.snapshot() == {"counters": {}, "summaries": {}}
+
+
+def test_metrics_disabled():
+    registry = MetricsRegistry(enabled=False)
+    registry.inc("onediff_graph_created_total")
+    with registry.timer("onediff_graph_build_seconds"):
+        pass
+    assert registry.snapshot() == {"counters": {}, "summaries": {}}
+
+
+def test_metrics_prometheus_escapes_label_values():
+    registry = MetricsRegistry()
+    registry.inc("onediff_graph_recompiles_total", reason='a "quoted"\\path\nline')
+    registry.observe("onediff_graph_build_seconds", 2.0)
+
+    assert registry.to_prometheus() == (
+        "# TYPE onediff_graph_recompiles_total counter\n"
+        'onediff_graph_recompiles_total{reason="a \\"quoted\\"\\\\path\\nline"} 1\n'
+        "# TYPE onediff_graph_build_seconds summary\n"
+        "onediff_graph_build_seconds_count 1\n"
+        "onediff_graph_build_seconds_sum 2.0\n"
+    )
+
+
+def test_metrics_chrome_trace(tmp_path):
+    registry = MetricsRegistry()
+    registry.enable_trace()
+    with registry.timer("onediff_graph_build_seconds", module="UNet"):
+        pass
+    trace_path = tmp_path / "trace.json"
+    registry.dump_chrome_trace(str(trace_path))
+
+    events = json.loads(trace_path.read_text())["traceEvents"]
+    assert [e["name"] for e in events] == ["onediff_graph_build_seconds"]
+    assert events[0]["args"] == {"module": "UNet"}
@@ -0,0 +1,80 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("oneflow")
+
+import torch.nn.functional as F  # usort: skip
+from onediff.infer_compiler import ShapeBucketPolicy
+from onediff.infer_compiler.backends.oneflow.shape_bucket_util import (
+    crop_outputs,
+    pad_inputs,
+    plan_bucket,
+    ShapeBucketStats,
+)
+
+
+def _unet_like(sample, timestep, encoder_hidden_states, down_residuals):
+    """Pointwise in the spatial dims, so the padding doesn't change the cropped outputs."""
+    out = sample * 2 + timestep.view(-1, 1, 1, 1)
+    out = out + encoder_hidden_states.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+    for residual in down_residuals:
+        scale = sample.shape[2] // residual.shape[2]
+        out = out + F.interpolate(residual, scale_factor=scale, mode="nearest")
+    return out, F.avg_pool2d(out, 2)
+
+
+def _inputs(batch_size, height, width):
+    sample = torch.randn(batch_size, 4, height, width)
+    kwargs = {
+        "timestep": torch.arange(batch_size, dtype=torch.float32),
+        "encoder_hidden_states": torch.randn(batch_size, 77, 8),
+        "down_residuals": tuple(
+            torch.randn(batch_size, 4, height // s, width // s) for s in (2, 4, 8)
+        ),
+    }
+    return (sample,), kwargs
+
+
+def _run_bucketed(policy, args, kwargs):
+    shape, bucket, batch_ids = plan_bucket(policy, args, kwargs)
+    padded_args, padded_kwargs, _ = pad_inputs(
+        policy, args, kwargs, shape, bucket, batch_ids
+    )
+    output = _unet_like(*padded_args, **padded_kwargs)
+    return bucket, crop_outputs(output, shape, bucket)
+
+
+def test_shape_bucket_pad_and_crop_round_trip():
+    torch.manual_seed(0)
+    policy = ShapeBucketPolicy(
+        batch_sizes=[4],
+        heights=[64],
+        widths=[96],
+        batch_args=["timestep", "encoder_hidden_states"],
+    )
+    args, kwargs = _inputs(3, 48, 80)
+    bucket, outputs = _run_bucketed(policy, args, kwargs)
+
+    assert bucket == (4, 64, 96)
+    expected = _unet_like(*args, **kwargs)
+    assert [o.shape for o in outputs] == [e.shape for e in expected]
+    for out, ref in zip(outputs, expected):
+        assert torch.allclose(out, ref)
+
+
+def test_shape_bucket_skips_inputs_that_cannot_be_padded():
+    policy = ShapeBucketPolicy(batch_sizes=[4], heights=[64], widths=[64])
+    stats = ShapeBucketStats()
+    sample = torch.randn(3, 4, 40, 40)
+    # An odd downsampled size, 40 -> 20 -> 10 -> 5 -> 3
+    residual = torch.randn(3, 4, 3, 3)
+    timestep = torch.zeros(3)
+
+    shape, bucket, batch_ids = plan_bucket(
+        policy, (sample, timestep), {"residual": residual}, stats
+    )
+    assert shape == (3, 40, 40)
+    # Neither the spatial size nor the batch, since the timestep batch is ambiguous
+    assert bucket == (3, 40, 40)
+    assert not batch_ids
+    assert len(stats.snapshot()["unbucketed"]) == 2